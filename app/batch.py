@@ -0,0 +1,232 @@
+"""Generation of a batch of invoices streamed back as a ZIP file.
+
+The request body (a JSON array or NDJSON, one invoice per line) is spooled
+to a temporary file, then parsed incrementally: the invoices are sent to the
+process pool a few at a time, and each PDF is written to the ZIP stream as
+soon as it is ready. The memory used by a batch doesn't depend on its size.
+The last member of the ZIP file is ``manifest.json``: the status of each
+invoice of the batch, in the order of the request.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import codecs
+import json
+import logging
+import re
+import zipfile
+from time import localtime
+from typing import IO, Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from pydantic import ValidationError
+
+from .metrics import observe_profile, output_size, profiled_call
+from .pool import InvoicePool, PoolSaturated
+
+logger = logging.getLogger(__name__)
+
+JSON_MEDIA_TYPES = ("application/json",)
+NDJSON_MEDIA_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+SPOOL_MAX_SIZE = 1024 * 1024
+_WHITESPACE = re.compile(r"\s*")
+_UNSAFE_FILENAME_CHARS = re.compile(r"[^\w.-]+")
+
+
+def iter_json_array(stream: IO[bytes], chunk_size: int = 64 * 1024) -> Iterator[Any]:
+    """Yield the items of the JSON array of ``stream`` without loading it all.
+
+    Raise ValueError if the stream is not a JSON array.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer, pos, eof = "", 0, False
+    expect = "start"  # then "item_or_end", "item" or "separator"
+    while True:
+        pos = _WHITESPACE.match(buffer, pos).end()
+        need_more = pos == len(buffer)
+        if not need_more:
+            char = buffer[pos]
+            if expect == "start":
+                if char != "[":
+                    raise ValueError("The request body must be a JSON array of invoices")
+                pos += 1
+                expect = "item_or_end"
+            elif expect == "separator" or (expect == "item_or_end" and char == "]"):
+                pos += 1
+                if char == "]":
+                    return
+                if char != "," or expect != "separator":
+                    raise ValueError(f"Invalid JSON array: unexpected {char!r}")
+                expect = "item"
+            else:
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError as exc:
+                    if eof:
+                        raise ValueError(f"Invalid JSON array: {exc}")
+                    need_more = True
+                else:
+                    # a number may be cut at the end of the buffer
+                    need_more = end == len(buffer) and not eof
+                    if not need_more:
+                        pos = end
+                        expect = "separator"
+                        yield item
+        if need_more:
+            if eof:
+                raise ValueError("Unexpected end of the JSON array")
+            chunk = stream.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + text_decoder.decode(chunk, final=eof)
+            pos = 0
+
+
+def iter_ndjson(stream: IO[bytes]) -> Iterator[Any]:
+    """Yield the items of an NDJSON stream. An invalid line gives a
+    ValueError item, so that only this invoice is rejected."""
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as exc:
+            yield ValueError(f"Invalid JSON line: {exc}")
+
+
+def generate_from_payload(payload: Any) -> Tuple[str, Optional[str], Any]:
+    """Validate and generate one invoice of a batch (runs in a worker).
+
+    Return (status, invoice number, PDF bytes or error). The status is
+    "ok" or "invalid": the pydantic errors are returned as data because
+    ValidationError can't be sent back from a worker process.
+    """
+    from .models import Invoice
+    from .utils import generate_facturx_pdf
+
+    number = payload.get("invoice_number") if isinstance(payload, dict) else None
+    try:
+        invoice = Invoice.model_validate(payload)
+    except ValidationError as exc:
+        return "invalid", number, json.loads(exc.json(include_url=False))
+    return "ok", invoice.invoice_number, generate_facturx_pdf(invoice)
+
+
+async def _run_item(pool: InvoicePool, index: int, payload: Any) -> Tuple[Dict[str, Any], Optional[bytes]]:
+    entry: Dict[str, Any] = {"index": index, "invoice_number": None}
+    if isinstance(payload, ValueError):
+        entry.update(status="invalid", error=str(payload))
+        return entry, None
+    delay = 0.01
+    while True:
+        try:
+            (status, number, result), profile = await pool.run(profiled_call, generate_from_payload, payload)
+        except PoolSaturated as exc:
+            if exc.draining:
+                entry.update(status="error", error=str(exc))
+                return entry, None
+            # The invoices of a batch wait for a free slot instead of failing
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+            continue
+        except Exception as exc:
+            logger.warning("Invoice %d of the batch failed: %s", index, exc)
+            entry.update(status="error", error=str(exc))
+            return entry, None
+        break
+    entry["invoice_number"] = number
+    entry["status"] = status
+    if status != "ok":
+        entry["error"] = result
+        return entry, None
+    observe_profile(profile)
+    output_size.observe(len(result), kind="pdf")
+    return entry, result
+
+
+class _ZipSink:
+    """Write-only file object that keeps what zipfile writes until taken."""
+
+    def __init__(self) -> None:
+        self.chunks: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def invoice_filename(number: Optional[str], index: int, names: set) -> str:
+    """Return the name of the PDF file of an invoice in a ZIP file or a
+    directory, unique among ``names``, to which it is added."""
+    name = f"invoice-{_UNSAFE_FILENAME_CHARS.sub('_', number or str(index))}.pdf"
+    if name in names:
+        name = f"{name[:-4]}-{index}.pdf"
+    names.add(name)
+    return name
+
+
+async def stream_zip(payloads: Iterator[Any], pool: InvoicePool, concurrency: int) -> AsyncIterator[bytes]:
+    """Generate the invoices of ``payloads`` and yield the ZIP file by chunks.
+
+    At most ``concurrency`` invoices are in progress at a time. The PDF
+    files are not compressed again, to keep the event loop free.
+    """
+    sink = _ZipSink()
+    archive = zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED)
+    manifest: List[Dict[str, Any]] = []
+    names: set = set()
+    in_progress: set = set()
+    count = 0
+    exhausted = False
+    while True:
+        while not exhausted and len(in_progress) < concurrency:
+            try:
+                payload = next(payloads)
+            except StopIteration:
+                exhausted = True
+                break
+            except ValueError as exc:
+                # The rest of the JSON array can't be parsed
+                manifest.append({"index": count, "invoice_number": None, "status": "error", "error": str(exc)})
+                exhausted = True
+                break
+            in_progress.add(asyncio.ensure_future(_run_item(pool, count, payload)))
+            count += 1
+        if not in_progress:
+            break
+        done, in_progress = await asyncio.wait(in_progress, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            entry, pdf_bytes = task.result()
+            if pdf_bytes is not None:
+                entry["file"] = invoice_filename(entry["invoice_number"], entry["index"], names)
+                entry["size"] = len(pdf_bytes)
+                archive.writestr(zipfile.ZipInfo(entry["file"], localtime()[:6]), pdf_bytes)
+            manifest.append(entry)
+        data = sink.take()
+        if data:
+            yield data
+    manifest.sort(key=lambda entry: entry["index"])
+    archive.writestr(
+        zipfile.ZipInfo("manifest.json", localtime()[:6]),
+        json.dumps(manifest, indent=1),
+        compress_type=zipfile.ZIP_DEFLATED,
+    )
+    archive.close()
+    yield sink.take()
+
+
+__all__ = [
+    "generate_from_payload",
+    "invoice_filename",
+    "iter_json_array",
+    "iter_ndjson",
+    "stream_zip",
+]
@@ -0,0 +1,358 @@
+"""Bulk import of invoices from flat accounting exports.
+
+The input is a CSV file (with a header row) or NDJSON with one row per line
+item; the rows of an invoice follow each other and repeat its header
+fields. The columns are those of :class:`app.models.Invoice`, the parties
+being flattened with a ``seller_`` or ``buyer_`` prefix::
+
+    invoice_number,issue_date,seller_name,seller_street,...,buyer_name,...,
+    description,quantity,unit_price,vat_rate
+
+The import is a pipeline whose stages run at the same time::
+
+    read and group rows -> worker processes -> write files and manifest
+      (main thread)        (validation, XML,     (writer thread)
+                            XSD, rendering,
+                            embedding)
+
+The input is streamed: the main thread groups the rows into invoices and
+sends them to the workers by chunks, with at most ``max_pending`` chunks in
+progress; the results go to the writer thread through a queue of the same
+size, so the memory used doesn't depend on the size of the input. Each
+invoice goes through all its stages in the same worker, because sending the
+XML or the PDF being rendered to another process costs more than the
+stages themselves. The writer puts the chunks back in the order of the input
+and writes the PDF files to a directory (directly from the workers) or to
+a ZIP file, with a ``manifest.jsonl`` file that gives the status of each
+invoice::
+
+    python -m app.bulk export.csv -o invoices.zip --workers 16
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import heapq
+import io
+import itertools
+import json
+import logging
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import IO, Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from .batch import generate_from_payload, invoice_filename
+from .pool import warm_up_worker
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("csv", "ndjson")
+HEADER_FIELDS = (
+    "invoice_number",
+    "issue_date",
+    "due_date",
+    "currency",
+    "payment_reference",
+    "payment_means_code",
+    "seller_bank_iban",
+)
+PARTY_FIELDS = ("name", "vat_identifier", "tax_registration_id", "email")
+ADDRESS_FIELDS = ("street", "postal_code", "city", "country_code")
+LINE_FIELDS = ("description", "quantity", "unit_price", "vat_rate")
+_INVOICE_FIELDS = HEADER_FIELDS + tuple(
+    f"{party}_{name}" for party in ("seller", "buyer") for name in PARTY_FIELDS + ADDRESS_FIELDS
+)
+
+# (index, file name, rows, error found while grouping the rows)
+Job = Tuple[int, str, List[Dict[str, Any]], Optional[str]]
+# (manifest entry, PDF bytes when they are not written by the worker)
+Result = Tuple[Dict[str, Any], Optional[bytes]]
+
+
+def iter_rows(stream: IO[bytes], fmt: str) -> Iterator[Dict[str, Any]]:
+    """Yield the rows of a CSV or NDJSON stream as dicts."""
+    if fmt == "csv":
+        yield from csv.DictReader(io.TextIOWrapper(stream, encoding="utf-8-sig", newline=""))
+    elif fmt == "ndjson":
+        for number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as exc:
+                raise ValueError(f"Invalid JSON on line {number}: {exc}")
+            if not isinstance(row, dict):
+                raise ValueError(f"Line {number} is not a JSON object")
+            yield row
+    else:
+        raise ValueError(f"Unknown format {fmt!r}, expected one of {', '.join(FORMATS)}")
+
+
+def group_invoices(rows: Iterable[Dict[str, Any]]) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+    """Group the consecutive rows of the same invoice number."""
+    for number, group in itertools.groupby(rows, key=lambda row: row.get("invoice_number") or ""):
+        yield str(number), list(group)
+
+
+def _value(row: Dict[str, Any], name: str) -> Any:
+    # An empty CSV cell is a missing value, so that the defaults apply
+    value = row.get(name)
+    return None if value == "" else value
+
+
+def rows_to_invoice(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Build the invoice payload of app.models.Invoice from its rows.
+
+    Raise ValueError if the rows don't have the same header fields.
+    """
+    first = rows[0]
+    header = tuple(_value(first, name) for name in _INVOICE_FIELDS)
+    for row in rows[1:]:
+        if tuple(_value(row, name) for name in _INVOICE_FIELDS) != header:
+            different = [name for name in _INVOICE_FIELDS if _value(row, name) != _value(first, name)]
+            raise ValueError(f"The rows of the invoice have different values of {', '.join(different)}")
+    invoice: Dict[str, Any] = {name: _value(first, name) for name in HEADER_FIELDS if _value(first, name) is not None}
+    for party in ("seller", "buyer"):
+        values = {name: _value(first, f"{party}_{name}") for name in PARTY_FIELDS}
+        values["address"] = {name: _value(first, f"{party}_{name}") for name in ADDRESS_FIELDS}
+        invoice[party] = values
+    invoice["line_items"] = [{name: _value(row, name) for name in LINE_FIELDS} for row in rows]
+    return invoice
+
+
+def generate_chunk(jobs: List[Job], output_dir: Optional[str]) -> List[Result]:
+    """Generate the invoices of a chunk (runs in a worker).
+
+    With ``output_dir``, the PDF files are written there and not returned.
+    """
+    results = []
+    for index, filename, rows, error in jobs:
+        entry: Dict[str, Any] = {"index": index, "invoice_number": rows[0].get("invoice_number"), "lines": len(rows)}
+        pdf_bytes = None
+        try:
+            if error:
+                raise ValueError(error)
+            status, _, result = generate_from_payload(rows_to_invoice(rows))
+        except ValueError as exc:
+            status, result = "invalid", str(exc)
+        except Exception as exc:
+            logger.warning("Invoice %s failed: %s", entry["invoice_number"], exc)
+            status, result = "error", str(exc)
+        entry["status"] = status
+        if status == "ok":
+            entry.update(file=filename, size=len(result))
+            if output_dir:
+                (Path(output_dir) / filename).write_bytes(result)
+            else:
+                pdf_bytes = result
+        else:
+            entry["error"] = result
+        results.append((entry, pdf_bytes))
+    return results
+
+
+class _Writer(threading.Thread):
+    """Last stage: write the results in the order of the input."""
+
+    def __init__(self, output: Path, to_zip: bool, max_pending: int):
+        super().__init__(name="bulk-writer", daemon=True)
+        self.results: "queue.Queue[Optional[Tuple[int, List[Result]]]]" = queue.Queue(max_pending)
+        self.summary: Dict[str, Any] = {"count": 0, "ok": 0, "invalid": 0, "error": 0, "bytes": 0}
+        self.exception: Optional[BaseException] = None
+        self._output = output
+        self._to_zip = to_zip
+
+    def run(self) -> None:
+        try:
+            self._write()
+        except BaseException as exc:
+            # The producer checks it before each put()
+            self.exception = exc
+
+    def _write(self) -> None:
+        archive = None
+        if self._to_zip:
+            archive = zipfile.ZipFile(self._output, "w", compression=zipfile.ZIP_STORED)
+            # zipfile writes one member at a time: the manifest is spooled
+            # until the last PDF file is written
+            manifest: IO[str] = tempfile.TemporaryFile("w+", encoding="utf-8")
+        else:
+            manifest = open(self._output / "manifest.jsonl", "w", encoding="utf-8")
+        waiting: List[Tuple[int, List[Result]]] = []
+        expected = 0
+        try:
+            while True:
+                item = self.results.get()
+                if item is None:
+                    break
+                heapq.heappush(waiting, item)
+                while waiting and waiting[0][0] == expected:
+                    _, results = heapq.heappop(waiting)
+                    expected += 1
+                    for entry, pdf_bytes in results:
+                        if archive is not None and pdf_bytes is not None:
+                            archive.writestr(zipfile.ZipInfo(entry["file"], time.localtime()[:6]), pdf_bytes)
+                        manifest.write(json.dumps(entry) + "\n")
+                        self.summary["count"] += 1
+                        self.summary[entry["status"]] += 1
+                        self.summary["bytes"] += entry.get("size", 0)
+            if archive is not None:
+                manifest.seek(0)
+                with archive.open("manifest.jsonl", "w", force_zip64=True) as member:
+                    for line in manifest:
+                        member.write(line.encode("utf-8"))
+        finally:
+            manifest.close()
+            if archive is not None:
+                archive.close()
+
+
+def _chunks(jobs: Iterator[Job], size: int) -> Iterator[List[Job]]:
+    while True:
+        chunk = list(itertools.islice(jobs, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _jobs(rows: Iterable[Dict[str, Any]]) -> Iterator[Job]:
+    numbers: Set[str] = set()
+    names: Set[str] = set()
+    for index, (number, group) in enumerate(group_invoices(rows)):
+        error = None
+        if not number:
+            error = "Missing invoice_number"
+        elif number in numbers:
+            error = f"The rows of invoice {number} are not consecutive"
+        numbers.add(number)
+        yield index, invoice_filename(number, index, names), group, error
+
+
+def import_invoices(
+    rows: Iterable[Dict[str, Any]],
+    output: str | Path,
+    workers: Optional[int] = None,
+    chunk_size: int = 8,
+    max_pending: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Generate the Factur-X PDF of the invoices of ``rows`` in ``output``,
+    a directory or a file whose name ends with ``.zip``.
+
+    With 0 workers, everything runs in this process (for tests and
+    debugging). Return a summary: number of invoices, by status, and bytes.
+    """
+    output_path = Path(output)
+    to_zip = output_path.suffix.lower() == ".zip"
+    if not to_zip:
+        output_path.mkdir(parents=True, exist_ok=True)
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    max_pending = max_pending or 4 * max(workers, 1)
+    writer = _Writer(output_path, to_zip, max_pending)
+    writer.start()
+    output_dir = None if to_zip else str(output_path)
+    chunks = enumerate(_chunks(_jobs(rows), chunk_size))
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=warm_up_worker) if workers else None
+    pending: Set[Future] = set()
+    sequences: Dict[Future, int] = {}
+
+    def put(item: Optional[Tuple[int, List[Result]]]) -> None:
+        while True:
+            if writer.exception is not None:
+                raise writer.exception
+            try:
+                writer.results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    try:
+        for sequence, chunk in chunks:
+            if executor is None:
+                put((sequence, generate_chunk(chunk, output_dir)))
+                continue
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    put((sequences.pop(future), future.result()))
+            future = executor.submit(generate_chunk, chunk, output_dir)
+            sequences[future] = sequence
+            pending.add(future)
+        for future in pending:
+            put((sequences.pop(future), future.result()))
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        # On an error, the output has the invoices done before it
+        if writer.exception is None:
+            writer.results.put(None)
+    writer.join()
+    if writer.exception is not None:
+        raise writer.exception
+    return writer.summary
+
+
+def _format(path: str, fmt: Optional[str]) -> str:
+    if fmt:
+        return fmt
+    suffix = Path(path).suffix.lower()
+    if suffix in (".ndjson", ".jsonl"):
+        return "ndjson"
+    if suffix == ".csv":
+        return "csv"
+    raise ValueError(f"Can't guess the format of {path}: use --format")
+
+
+def main(args: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Generate the Factur-X PDF invoices of a CSV or NDJSON export.")
+    parser.add_argument("input", help="CSV or NDJSON file, one row per line item ('-' for stdin).")
+    parser.add_argument(
+        "-o", "--output", required=True, help="Output directory, or ZIP file if the name ends with .zip."
+    )
+    parser.add_argument("-f", "--format", choices=FORMATS, help="Format of the input. Default: from its extension.")
+    parser.add_argument(
+        "-w", "--workers", type=int, default=None, help="Number of worker processes. Default: number of CPUs."
+    )
+    parser.add_argument("--chunk-size", type=int, default=8, help="Invoices sent to a worker at a time. Default: 8.")
+    args = parser.parse_args(args)
+    try:
+        fmt = _format(args.input, args.format)
+    except ValueError as exc:
+        parser.error(str(exc))
+    start = time.perf_counter()
+    stream = sys.stdin.buffer if args.input == "-" else open(args.input, "rb")
+    try:
+        summary = import_invoices(iter_rows(stream, fmt), args.output, workers=args.workers, chunk_size=args.chunk_size)
+    except ValueError as exc:
+        sys.exit(f"{args.input}: {exc}")
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+    duration = time.perf_counter() - start
+    print(
+        f"{summary['count']} invoices ({summary['ok']} generated, {summary['invalid']} invalid, "
+        f"{summary['error']} errors, {summary['bytes'] / 1024 / 1024:.1f} MiB) written in {args.output} "
+        f"in {duration:.1f}s ({summary['count'] / max(duration, 1e-9):.0f} invoices/s)"
+    )
+    if summary["invalid"] or summary["error"]:
+        sys.exit(1)
+
+
+__all__ = [
+    "FORMATS",
+    "group_invoices",
+    "import_invoices",
+    "iter_rows",
+    "rows_to_invoice",
+]
+
+
+if __name__ == "__main__":
+    main()
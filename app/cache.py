@@ -0,0 +1,243 @@
+"""Cache of the generated documents of the invoice API.
+
+The documents are keyed by a hash of the canonical JSON of the validated
+invoice (and of the kind of document), so a retry or a reprint of the same
+invoice is served without generating it again. The key also contains
+:data:`CACHE_VERSION` and the version of the factur-x lib, so that the
+documents generated by a previous version of the code are not served (nor
+their ETag matched) after a deploy. The cache has two tiers:
+
+* an in-memory LRU limited to a number of bytes,
+* an optional directory where the documents are stored under their key
+  (content-addressed), shared by all the processes and kept across restarts.
+  The documents that were not written nor read for ``max_age`` seconds are
+  deleted from it, by a thread that scans the directory every
+  :data:`PRUNE_INTERVAL` seconds.
+
+It also remembers the ``Idempotency-Key`` headers already received, to
+detect a key reused for another invoice of the same endpoint. The cache is
+configured with environment variables:
+
+* ``FACTURX_CACHE_MAX_BYTES``: size of the in-memory tier (default: 64 MiB,
+  0 to disable it),
+* ``FACTURX_CACHE_DIR``: directory of the on-disk tier (default: no disk tier),
+* ``FACTURX_CACHE_MAX_AGE``: time in seconds after which an unused document
+  is deleted from the directory (default: 7 days, 0 to never delete them;
+  then clean the directory with a cron job).
+
+The cache is meant to be used from the event loop only: it is not thread-safe.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, Optional, Tuple
+
+from pydantic import BaseModel
+
+from facturx import __version__ as FACTURX_VERSION
+
+from .config import env_int
+
+logger = logging.getLogger(__name__)
+
+# Bump it whenever the generated documents change (rendering, amounts,
+# fonts, XML): the documents cached by the previous code are then ignored
+CACHE_VERSION = 3
+_KEY_PREFIX = f"{CACHE_VERSION}/{FACTURX_VERSION}"
+
+IDEMPOTENCY_KEYS_MAX = 10000
+PRUNE_INTERVAL = 600
+
+
+def result_key(invoice: BaseModel, kind: str) -> str:
+    """Return the cache key of a document generated from ``invoice``.
+
+    ``kind`` must change whenever the options change the generated document.
+    """
+    canonical = json.dumps(invoice.model_dump(mode="json"), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(f"{_KEY_PREFIX}\n{kind}\n{canonical}".encode("utf-8")).hexdigest()
+
+
+def content_key(kind: str, *parts: bytes) -> str:
+    """Return the cache key of a document generated from raw request data,
+    for the inputs that are only parsed in the workers (app.columns)."""
+    digest = hashlib.sha256(f"{_KEY_PREFIX}\n{kind}\n".encode("utf-8"))
+    for part in parts:
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Two-tier cache of generated documents with single-flight creation."""
+
+    def __init__(
+        self, max_bytes: int = 64 * 1024 * 1024, directory: Optional[str | Path] = None, max_age: int = 7 * 86400
+    ):
+        self.max_bytes = max_bytes
+        self.directory = Path(directory) if directory else None
+        self.max_age = max_age
+        self._next_prune = 0.0
+        self._pruning = False
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._in_flight: dict = {}
+        self._idempotency_keys: "OrderedDict[str, str]" = OrderedDict()
+
+    @classmethod
+    def from_env(cls) -> "ResultCache":
+        return cls(
+            max_bytes=env_int("FACTURX_CACHE_MAX_BYTES", 64 * 1024 * 1024),
+            directory=os.environ.get("FACTURX_CACHE_DIR") or None,
+            max_age=env_int("FACTURX_CACHE_MAX_AGE", 7 * 86400),
+        )
+
+    def _path(self, key: str) -> Path:
+        assert self.directory is not None
+        return self.directory / key[:2] / key[2:]
+
+    def get(self, key: str) -> Optional[bytes]:
+        data = self._entries.get(key)
+        if data is not None:
+            self._entries.move_to_end(key)
+            return data
+        if self.directory is not None:
+            path = self._path(key)
+            try:
+                if self.max_age and path.stat().st_mtime <= time.time() - self.max_age:
+                    return None
+                data = path.read_bytes()
+                # The documents that are read are kept longer
+                os.utime(path)
+            except FileNotFoundError:
+                return None
+            except OSError as exc:
+                logger.warning("Cannot read %s in the cache directory: %s", key, exc)
+                return None
+            self._put_memory(key, data)
+        return data
+
+    def _put_memory(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous)
+        self._entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def put(self, key: str, data: bytes) -> None:
+        self._put_memory(key, data)
+        if self.directory is not None:
+            path = self._path(key)
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                # Write then rename, so that other processes never read a
+                # partial file
+                tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+                tmp_path.write_bytes(data)
+                os.replace(tmp_path, path)
+            except OSError as exc:
+                logger.warning("Cannot write %s in the cache directory: %s", key, exc)
+            self._schedule_prune()
+
+    def prune(self, now: Optional[float] = None) -> int:
+        """Delete the documents of the directory that are older than
+        ``max_age`` (and the temporary files left by a crash). Return their
+        number."""
+        if self.directory is None or not self.max_age:
+            return 0
+        limit = (time.time() if now is None else now) - self.max_age
+        deleted = 0
+        for path in self.directory.glob("*/*"):
+            try:
+                if path.stat().st_mtime <= limit:
+                    path.unlink()
+                    deleted += 1
+            except OSError:
+                # Deleted by another process in the meantime
+                continue
+        return deleted
+
+    def _schedule_prune(self) -> None:
+        if not self.max_age or self._pruning or time.monotonic() < self._next_prune:
+            return
+        self._next_prune = time.monotonic() + PRUNE_INTERVAL
+        self._pruning = True
+
+        def prune() -> None:
+            try:
+                deleted = self.prune()
+                if deleted:
+                    logger.info("%d old documents deleted from the cache directory", deleted)
+            finally:
+                self._pruning = False
+
+        # Scanning a large directory must not block the event loop
+        threading.Thread(target=prune, name="facturx-cache-prune", daemon=True).start()
+
+    async def get_or_create(self, key: str, create: Callable[[], Awaitable[bytes]]) -> Tuple[bytes, bool]:
+        """Return (document, True if it was in the cache).
+
+        If the same document is already being created for another request,
+        wait for it instead of creating it twice. If that request is
+        cancelled (its client went away), a waiting request creates the
+        document itself.
+        """
+        data = self.get(key)
+        while data is None and key in self._in_flight:
+            # None: the request that created it was cancelled
+            data = await asyncio.shield(self._in_flight[key])
+        if data is not None:
+            self.hits += 1
+            return data, True
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            data = await create()
+        except BaseException as exc:
+            if isinstance(exc, asyncio.CancelledError):
+                # The cancellation of this request is not the one of the
+                # requests that wait for the document
+                future.set_result(None)
+            else:
+                future.set_exception(exc)
+                future.exception()  # don't log it if nobody else waits for it
+            raise
+        finally:
+            del self._in_flight[key]
+        self.put(key, data)
+        future.set_result(data)
+        return data, False
+
+    def check_idempotency_key(self, idempotency_key: str, key: str, scope: str = "") -> bool:
+        """Remember the document of an Idempotency-Key header. Return False
+        if the header was already used for another document in the same
+        ``scope`` (the endpoint): the same key may be used for the PDF and
+        the XML of an invoice."""
+        idempotency_key = f"{scope}\n{idempotency_key}"
+        previous = self._idempotency_keys.get(idempotency_key)
+        if previous is not None and previous != key:
+            return False
+        self._idempotency_keys[idempotency_key] = key
+        self._idempotency_keys.move_to_end(idempotency_key)
+        if len(self._idempotency_keys) > IDEMPOTENCY_KEYS_MAX:
+            self._idempotency_keys.popitem(last=False)
+        return True
+
+
+__all__ = ["CACHE_VERSION", "ResultCache", "content_key", "result_key"]
@@ -0,0 +1,321 @@
+"""Columnar line items, validated and totalled with NumPy.
+
+An :class:`app.models.Invoice` validates one pydantic ``LineItem`` per line,
+which is the most expensive part of an invoice of many thousand lines. The
+columnar input gives the lines as four parallel columns instead::
+
+    {"description": ["Consulting", ...], "quantity": ["2", ...],
+     "unit_price": ["150", ...], "vat_rate": ["20", ...]}
+
+as JSON, CSV (with a header row) or NDJSON (one object per line). The
+numbers are parsed as exact scaled integers in NumPy arrays (quantity in
+thousandths, unit price in ten-thousandths, VAT rate in hundredths) and the
+amounts are computed on the whole columns, with the rounding rules of
+app.totals:
+
+* line net amount in cents = quantity x unit price, rounded half up,
+* line VAT = net amount x rate, rounded half up,
+* VAT breakdown: the net amounts summed by rate, the VAT rounded on the sum.
+
+The multiplications fall back to Python integers when int64 could
+overflow, so the amounts are exact whatever the inputs. The XML builder and
+the renderer read the columns as formatted text, without any Python object
+per line but the strings they write.
+
+NumPy is imported by the functions that use it, when the first columnar
+invoice is read: the XML builder and the renderer import this module, and
+the processes that only generate invoices of pydantic lines don't load it.
+"""
+
+from __future__ import annotations
+
+import csv
+import io
+import json
+from decimal import Decimal
+from typing import IO, TYPE_CHECKING, Any, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+from .totals import VatGroup
+
+if TYPE_CHECKING:
+    import numpy as np
+
+COLUMNS = ("description", "quantity", "unit_price", "vat_rate")
+CSV_MEDIA_TYPES = ("text/csv",)
+QUANTITY_DECIMALS = 3
+PRICE_DECIMALS = 4
+RATE_DECIMALS = 2
+# Digits before the decimal point: the scaled values fit in int64
+MAX_INTEGER_DIGITS = 12
+_INT64_LIMIT = 2 ** 62
+_DIGITS = "0123456789"
+
+
+def _decimal_text(values: np.ndarray) -> np.ndarray:
+    import numpy as np
+
+    if values.dtype.kind != "U":
+        # JSON numbers: repr() of a float is its shortest exact text
+        values = values.astype(str)
+    return np.char.strip(values)
+
+
+def parse_decimal_column(values: Sequence[Any], decimals: int, name: str, positive: bool = False) -> np.ndarray:
+    """Parse a column of decimal numbers ("12", "12.5", 12.5...) as integers
+    scaled by 10 ** decimals.
+
+    Raise ValueError, with the first invalid line, for a negative number, an
+    exponent, more than ``decimals`` significant decimals or a zero when
+    ``positive``.
+    """
+    import numpy as np
+
+    text = _decimal_text(np.asarray(values))
+    parts = np.char.partition(text, ".")
+    integer = np.char.lstrip(parts[:, 0], "0")
+    fraction = np.char.rstrip(parts[:, 2], "0")
+    integer_len = np.char.str_len(integer)
+    fraction_len = np.char.str_len(fraction)
+    valid = (
+        (np.char.str_len(text) > 0) &
+        (text != ".") &
+        # only ASCII digits: str.isdigit() also accepts other scripts
+        (np.char.str_len(np.char.strip(integer, _DIGITS)) == 0) &
+        (np.char.str_len(np.char.strip(fraction, _DIGITS)) == 0) &
+        (integer_len <= MAX_INTEGER_DIGITS) &
+        (fraction_len <= decimals)
+    )
+    _check(valid, values, f"{name} must be a decimal number >= 0 with at most {decimals} decimals")
+    scaled = np.where(integer_len > 0, integer, "0").astype(np.int64) * 10 ** decimals
+    scaled += np.char.ljust(fraction, decimals, "0").astype(np.int64)
+    if positive:
+        _check(scaled > 0, values, f"{name} must be greater than 0")
+    return scaled
+
+
+def _check(valid: np.ndarray, values: Sequence[Any], message: str) -> None:
+    import numpy as np
+
+    invalid = np.flatnonzero(~valid)
+    if invalid.size:
+        index = int(invalid[0])
+        value = values[index]
+        if isinstance(value, np.generic):
+            value = value.item()
+        others = f" (and {invalid.size - 1} other lines)" if invalid.size > 1 else ""
+        raise ValueError(f"Line {index + 1}: {message}, got {value!r}{others}")
+
+
+def _product(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """a * b, on Python integers if int64 could overflow."""
+    if a.size and int(a.max()) * int(b.max()) >= _INT64_LIMIT:
+        return a.astype(object) * b.astype(object)
+    return a * b
+
+
+def _divide_half_up(values: np.ndarray, decimals: int) -> np.ndarray:
+    """Divide values >= 0 by 10 ** decimals, rounded half up."""
+    unit = 10 ** decimals
+    return (values + unit // 2) // unit
+
+
+def format_scaled(values: np.ndarray, decimals: int) -> np.ndarray:
+    """Format integers >= 0 scaled by 10 ** decimals: (1234, 2) -> "12.34"."""
+    import numpy as np
+
+    # no np.divmod(): it doesn't support the object arrays of _product()
+    units, fraction = values // 10 ** decimals, values % 10 ** decimals
+    text = np.char.add(np.asarray(units).astype(str), ".")
+    return np.char.add(text, np.char.zfill(np.asarray(fraction).astype(str), decimals))
+
+
+class ColumnTotals:
+    """Amounts of columnar lines, with the interface of
+    app.totals.InvoiceTotals used by the XML builder and the renderer."""
+
+    def __init__(self, net: np.ndarray, tax: np.ndarray, vat_groups: List[VatGroup]):
+        self.net = net  # cents, by line
+        self.tax = tax  # cents, by line
+        self.vat_groups = vat_groups
+        self.line_count = len(net)
+        self.line_total = int(net.sum())
+        self.tax_total = sum(group.tax for group in vat_groups)
+
+    @property
+    def grand_total(self) -> int:
+        return self.line_total + self.tax_total
+
+
+class LineColumns:
+    """The lines of an invoice as parallel columns.
+
+    The constructor validates the columns; use :meth:`from_mapping`,
+    :meth:`from_csv` or :meth:`from_ndjson` to read them.
+    """
+
+    def __init__(
+        self,
+        description: Sequence[str],
+        quantity: Sequence[Any],
+        unit_price: Sequence[Any],
+        vat_rate: Sequence[Any],
+    ):
+        import numpy as np
+
+        lengths = {len(description), len(quantity), len(unit_price), len(vat_rate)}
+        if len(lengths) > 1:
+            raise ValueError("The line columns must have the same length")
+        if not len(description):
+            raise ValueError("An invoice must have at least one line")
+        self.description = np.asarray(description)
+        if self.description.dtype.kind != "U":
+            raise ValueError("description must be a column of strings")
+        _check(np.char.str_len(self.description) > 0, description, "description must not be empty")
+        self.quantity = parse_decimal_column(quantity, QUANTITY_DECIMALS, "quantity", positive=True)
+        self.unit_price = parse_decimal_column(unit_price, PRICE_DECIMALS, "unit_price")
+        self.vat_rate = parse_decimal_column(vat_rate, RATE_DECIMALS, "vat_rate")
+        # The PDF shows the numbers as they were sent
+        self.quantity_text = _decimal_text(np.asarray(quantity))
+        self.unit_price_text = _decimal_text(np.asarray(unit_price))
+
+    def __len__(self) -> int:
+        return len(self.description)
+
+    @classmethod
+    def from_mapping(cls, columns: Mapping[str, Sequence[Any]]) -> "LineColumns":
+        """Read the columns of a JSON object (a dict of lists)."""
+        if not isinstance(columns, Mapping):
+            raise ValueError(f"The lines must be an object with the columns {', '.join(COLUMNS)}")
+        missing = [name for name in COLUMNS if not isinstance(columns.get(name), list)]
+        if missing:
+            raise ValueError(f"Missing line columns (lists): {', '.join(missing)}")
+        return cls(*(columns[name] for name in COLUMNS))
+
+    @classmethod
+    def from_csv(cls, stream: IO[bytes]) -> "LineColumns":
+        """Read a UTF-8 CSV file whose header row names the columns (in any
+        order, other columns are ignored)."""
+        import numpy as np
+
+        reader = csv.reader(io.TextIOWrapper(stream, encoding="utf-8-sig", newline=""))
+        header = next(reader, None) or []
+        positions = {name.strip(): position for position, name in enumerate(header)}
+        missing = [name for name in COLUMNS if name not in positions]
+        if missing:
+            raise ValueError(f"Missing CSV columns: {', '.join(missing)}")
+        rows = [row for row in reader if row]
+        if any(len(row) != len(header) for row in rows):
+            raise ValueError(f"Every CSV row must have {len(header)} fields")
+        if not rows:
+            return cls([], [], [], [])
+        fields = np.array(rows, dtype=str)
+        return cls(*(fields[:, positions[name]] for name in COLUMNS))
+
+    @classmethod
+    def from_ndjson(cls, stream: IO[bytes]) -> "LineColumns":
+        """Read one JSON object per line, with the keys of the columns."""
+        columns: Dict[str, List[Any]] = {name: [] for name in COLUMNS}
+        for number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                for name in COLUMNS:
+                    columns[name].append(item[name])
+            except (ValueError, KeyError, TypeError) as exc:
+                raise ValueError(f"NDJSON line {number}: expected an object with {', '.join(COLUMNS)} ({exc})")
+        return cls.from_mapping(columns)
+
+    def totals(self) -> ColumnTotals:
+        import numpy as np
+
+        net = _divide_half_up(_product(self.quantity, self.unit_price), QUANTITY_DECIMALS + PRICE_DECIMALS - 2)
+        tax = _divide_half_up(_product(net, self.vat_rate), RATE_DECIMALS + 2)
+        rates, first, inverse = np.unique(self.vat_rate, return_index=True, return_inverse=True)
+        bases = np.zeros(len(rates), dtype=net.dtype)
+        if net.dtype != object and int(net.max()) * len(net) >= _INT64_LIMIT:
+            bases = bases.astype(object)
+        np.add.at(bases, inverse, net)
+        vat_groups = []
+        # In the order of the first line of each rate, as InvoiceTotals
+        for group in np.argsort(first, kind="stable"):
+            rate, basis = int(rates[group]), int(bases[group])
+            group_tax = (basis * rate + 5000) // 10000
+            vat_groups.append(VatGroup(Decimal(rate).scaleb(-RATE_DECIMALS), basis, group_tax))
+        return ColumnTotals(net, tax, vat_groups)
+
+    def xml_rows(self, totals: ColumnTotals) -> Iterator[Tuple[str, str, str, str, str, str]]:
+        """Yield the text of the lines in the XML: (description, unit price,
+        quantity, VAT rate, net amount, VAT amount)."""
+        return zip(
+            self.description.tolist(),
+            format_scaled(_divide_half_up(self.unit_price, PRICE_DECIMALS - 2), 2).tolist(),
+            format_scaled(self.quantity, QUANTITY_DECIMALS).tolist(),
+            format_scaled(self.vat_rate, RATE_DECIMALS).tolist(),
+            format_scaled(totals.net, 2).tolist(),
+            format_scaled(totals.tax, 2).tolist(),
+        )
+
+    def display_rows(self, totals: ColumnTotals) -> Iterator[Tuple[str, str, str, int]]:
+        """Yield the lines of the PDF: (description, quantity, unit price,
+        net amount in cents)."""
+        return zip(
+            self.description.tolist(),
+            self.quantity_text.tolist(),
+            self.unit_price_text.tolist(),
+            totals.net.tolist(),
+        )
+
+
+def read_line_columns(data: bytes, media_type: str) -> LineColumns:
+    """Read the lines of a CSV or NDJSON upload."""
+    from .batch import NDJSON_MEDIA_TYPES
+
+    if media_type in CSV_MEDIA_TYPES:
+        return LineColumns.from_csv(io.BytesIO(data))
+    if media_type in NDJSON_MEDIA_TYPES:
+        return LineColumns.from_ndjson(io.BytesIO(data))
+    raise ValueError(f"Unsupported media type for the lines: {media_type}")
+
+
+def generate_from_columns(data: bytes, media_type: str, header: Optional[str] = None) -> bytes:
+    """Validate a columnar invoice and render its Factur-X PDF (runs in a
+    worker).
+
+    ``data`` is either the JSON invoice with its ``lines`` as columns, or
+    the lines as CSV or NDJSON and ``header`` the JSON invoice without its
+    lines. Raise ValueError for an invalid invoice.
+    """
+    from pydantic import ValidationError
+
+    from .models import InvoiceHeader
+    from .utils import generate_facturx_pdf_from_columns
+
+    try:
+        if header is None:
+            payload = json.loads(data)
+            if not isinstance(payload, dict):
+                raise ValueError("The invoice must be a JSON object")
+            columns = LineColumns.from_mapping(payload.pop("lines", None))
+            invoice = InvoiceHeader.model_validate(payload)
+        else:
+            columns = read_line_columns(data, media_type)
+            invoice = InvoiceHeader.model_validate_json(header)
+    except ValidationError as exc:
+        # ValidationError can't be sent back from a worker process
+        raise ValueError(str(exc)) from None
+    except UnicodeDecodeError as exc:
+        raise ValueError(f"The lines must be encoded in UTF-8 ({exc})") from None
+    return generate_facturx_pdf_from_columns(invoice, columns)
+
+
+__all__ = [
+    "COLUMNS",
+    "CSV_MEDIA_TYPES",
+    "ColumnTotals",
+    "LineColumns",
+    "format_scaled",
+    "generate_from_columns",
+    "parse_decimal_column",
+    "read_line_columns",
+]
@@ -0,0 +1,39 @@
+"""Settings of the invoice API read from environment variables.
+
+An unset or empty variable gives the default value; an invalid value
+raises ValueError with the name of the variable, so that a typo in the
+configuration stops the API at start-up instead of being ignored.
+"""
+
+from __future__ import annotations
+
+import os
+
+
+def env_int(name: str, default: int) -> int:
+    """Read an integer >= 0 from the environment variable ``name``."""
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer, got {value!r}")
+    if number < 0:
+        raise ValueError(f"{name} must be positive, got {number}")
+    return number
+
+
+def env_float(name: str, default: float) -> float:
+    """Read a number of seconds (or a ratio) from the environment variable
+    ``name``."""
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a number, got {value!r}")
+
+
+__all__ = ["env_float", "env_int"]
@@ -0,0 +1,410 @@
+"""Synthetic invoice corpus generator for load and scaling tests.
+
+The corpus is built on :class:`app.models.Invoice` and
+:func:`app.xml_builder.build_facturx_xml`. Each document only depends on the
+seed and on its index, so a corpus is reproducible whatever the number of
+worker processes, and any document can be regenerated on its own::
+
+    python -m app.corpus /tmp/corpus --count 10000 --seed 42 --mode facturx \\
+        --levels en16931,basic --invalid-ratio 0.05 --workers 8
+
+The documents are written to the output directory as soon as they are
+generated, with a ``manifest.jsonl`` file that describes each of them (level,
+number of lines, attachments, expected validity and defect). The PDF files
+are deterministic except for their timestamps.
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import math
+import multiprocessing
+import random
+from datetime import date, timedelta
+from decimal import Decimal
+from functools import lru_cache
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from lxml import etree
+from pydantic import BaseModel, Field, field_validator
+
+from .models import Invoice
+from .xml_builder import NSMAP, build_facturx_xml
+
+MODES = ("xml", "pdf", "facturx")
+FACTURX_LEVELS = ("minimum", "basicwl", "basic", "en16931", "extended")
+FACTURX_GUIDELINES = {
+    "minimum": "urn:factur-x.eu:1p0:minimum",
+    "basicwl": "urn:factur-x.eu:1p0:basicwl",
+    "basic": "urn:cen.eu:en16931:2017#compliant#urn:factur-x.eu:1p0:basic",
+    "en16931": "urn:cen.eu:en16931:2017",
+    "extended": "urn:cen.eu:en16931:2017#conformant#urn:factur-x.eu:1p0:extended",
+}
+# Elements of the EN16931 XML that the XSD of the levels without lines reject
+_BASICWL_REMOVALS = ("//ram:IncludedSupplyChainTradeLineItem",)
+_MINIMUM_REMOVALS = _BASICWL_REMOVALS + (
+    "//ram:SpecifiedTradeSettlementPaymentMeans",
+    "//ram:ApplicableTradeTax",
+    "//ram:SpecifiedTradePaymentTerms",
+    "//ram:PaymentReference",
+    "//ram:ActualDeliverySupplyChainEvent",
+    "//ram:URIUniversalCommunication",
+    "//ram:PostalTradeAddress/ram:*[not(self::ram:CountryID)]",
+    "//ram:BuyerTradeParty/ram:PostalTradeAddress",
+    "//ram:BuyerTradeParty/ram:SpecifiedTaxRegistration",
+    "//ram:SpecifiedTradeSettlementHeaderMonetarySummation/ram:LineTotalAmount",
+)
+# missing_element: invalid against the XSD
+# wrong_totals: valid against the XSD, but breaks the EN16931 rule BR-CO-15
+# malformed: not even well-formed XML (only in xml mode)
+DEFECTS = ("missing_element", "wrong_totals", "malformed")
+
+_CITIES = (
+    ("75001", "Paris"),
+    ("69002", "Lyon"),
+    ("13001", "Marseille"),
+    ("31000", "Toulouse"),
+    ("33000", "Bordeaux"),
+    ("59000", "Lille"),
+    ("44000", "Nantes"),
+    ("67000", "Strasbourg"),
+)
+_STREETS = ("Rue de la République", "Avenue Jean Jaurès", "Boulevard Victor Hugo", "Place du Marché")
+_COMPANY_SUFFIXES = ("SAS", "SARL", "SA", "EURL")
+_PRODUCTS = (
+    "Consulting services",
+    "Software license",
+    "Support contract",
+    "Training day",
+    "Hardware maintenance",
+    "Hosting (monthly)",
+    "Office supplies",
+    "Delivery fee",
+)
+
+
+class CorpusOptions(BaseModel):
+    """Description of a corpus: the same options give the same documents."""
+
+    count: int = Field(default=100, ge=1)
+    seed: int = 0
+    mode: str = "facturx"
+    levels: List[str] = Field(default_factory=lambda: ["en16931"], min_length=1)
+    min_lines: int = Field(default=1, ge=1)
+    max_lines: int = Field(default=50, ge=1)
+    vat_rates: List[Decimal] = Field(
+        default_factory=lambda: [Decimal("20"), Decimal("10"), Decimal("5.5"), Decimal("2.1")],
+        min_length=1,
+    )
+    mixed_vat_ratio: float = Field(default=0.3, ge=0, le=1)
+    parties: int = Field(default=50, ge=2)
+    max_attachments: int = Field(default=0, ge=0)
+    attachment_size: int = Field(default=20 * 1024, ge=1)
+    invalid_ratio: float = Field(default=0.0, ge=0, le=1)
+
+    @field_validator("mode")
+    @classmethod
+    def _check_mode(cls, value):
+        if value not in MODES:
+            raise ValueError(f"mode must be one of {', '.join(MODES)}")
+        return value
+
+    @field_validator("levels")
+    @classmethod
+    def _check_levels(cls, value):
+        for level in value:
+            if level not in FACTURX_LEVELS:
+                raise ValueError(f"unknown level {level!r}, possible values: {', '.join(FACTURX_LEVELS)}")
+        return value
+
+
+def _rng(options: CorpusOptions, *key: Any) -> random.Random:
+    # Seeding with a string is stable across processes and Python versions
+    return random.Random("-".join(str(part) for part in (options.seed,) + key))
+
+
+@lru_cache(maxsize=8)
+def _party_pool(seed: int, size: int) -> Tuple[Dict[str, Any], ...]:
+    rnd = random.Random(f"{seed}-parties")
+    parties = []
+    for index in range(size):
+        postal_code, city = rnd.choice(_CITIES)
+        name = f"Company {index + 1} {rnd.choice(_COMPANY_SUFFIXES)}"
+        siren = f"{rnd.randrange(10 ** 9):09d}"
+        parties.append(
+            {
+                "name": name,
+                "address": {
+                    "street": f"{rnd.randint(1, 200)} {rnd.choice(_STREETS)}",
+                    "postal_code": postal_code,
+                    "city": city,
+                    "country_code": "FR",
+                },
+                "vat_identifier": f"FR{rnd.randrange(100):02d}{siren}",
+                "tax_registration_id": siren if rnd.random() < 0.8 else None,
+                "email": f"billing@company-{index + 1}.example" if rnd.random() < 0.7 else None,
+            }
+        )
+    return tuple(parties)
+
+
+def make_invoice(options: CorpusOptions, index: int) -> Invoice:
+    """Return the invoice number ``index`` of the corpus."""
+    rnd = _rng(options, "invoice", index)
+    parties = _party_pool(options.seed, options.parties)
+    seller, buyer = rnd.sample(parties, 2)
+    # Log-uniform number of lines: many small invoices, a few big ones
+    lines = int(round(math.exp(rnd.uniform(math.log(options.min_lines), math.log(options.max_lines)))))
+    lines = min(max(lines, options.min_lines), options.max_lines)
+    if rnd.random() < options.mixed_vat_ratio:
+        rates = options.vat_rates
+    else:
+        rates = [rnd.choice(options.vat_rates)]
+    issue_date = date(2024, 1, 1) + timedelta(days=rnd.randrange(366))
+    number = f"INV-{options.seed}-{index:07d}"
+    return Invoice.model_validate(
+        {
+            "invoice_number": number,
+            "issue_date": issue_date,
+            "due_date": issue_date + timedelta(days=rnd.choice((0, 15, 30, 45, 60))),
+            "currency": "EUR",
+            "payment_reference": number,
+            "payment_means_code": "30",
+            "seller_bank_iban": "FR7630004000031234567890143",
+            "seller": seller,
+            "buyer": buyer,
+            "line_items": [
+                {
+                    "description": rnd.choice(_PRODUCTS),
+                    "quantity": Decimal(rnd.randint(1, 2000)) / (100 if rnd.random() < 0.2 else 1),
+                    "unit_price": Decimal(rnd.randint(50, 500000)) / 100,
+                    "vat_rate": rnd.choice(rates),
+                }
+                for _ in range(lines)
+            ],
+        }
+    )
+
+
+def make_attachments(options: CorpusOptions, index: int, invoice: Invoice) -> Dict[str, Dict[str, Any]]:
+    """Return the attachments of the document ``index`` for generate_from_file()."""
+    rnd = _rng(options, "attachments", index)
+    attachments = {}
+    for number in range(1, rnd.randint(0, options.max_attachments) + 1):
+        if number % 2:
+            rows = ["description;quantity;unit_price;vat_rate"] + [
+                f"{line.description};{line.quantity};{line.unit_price};{line.vat_rate}"
+                for line in invoice.line_items
+            ]
+            attachments[f"timesheet-{number}.csv"] = {
+                "filedata": "\n".join(rows).encode("utf-8"),
+                "description": "Detail of the invoice lines",
+            }
+        else:
+            attachments[f"scan-{number}.bin"] = {
+                "filedata": rnd.randbytes(rnd.randint(1, options.attachment_size)),
+                "description": "Scanned delivery note",
+            }
+    return attachments
+
+
+def convert_level(xml_bytes: bytes, level: str) -> bytes:
+    """Adapt an XML file of build_facturx_xml() to another Factur-X level."""
+    root = etree.fromstring(xml_bytes, etree.XMLParser(remove_blank_text=True))
+    removals: Tuple[str, ...] = ()
+    if level == "minimum":
+        removals = _MINIMUM_REMOVALS
+    elif level == "basicwl":
+        removals = _BASICWL_REMOVALS
+    for xpath in removals:
+        for element in root.xpath(xpath, namespaces=NSMAP):
+            element.getparent().remove(element)
+    guideline = root.xpath("//ram:GuidelineSpecifiedDocumentContextParameter/ram:ID", namespaces=NSMAP)[0]
+    guideline.text = FACTURX_GUIDELINES[level]
+    guideline.attrib.pop("schemeID", None)
+    return etree.tostring(root, xml_declaration=True, encoding="UTF-8", pretty_print=True)
+
+
+def add_defect(xml_bytes: bytes, defect: str) -> bytes:
+    """Return a copy of a valid XML file with one of the DEFECTS."""
+    if defect == "malformed":
+        return xml_bytes[: len(xml_bytes) // 2]
+    root = etree.fromstring(xml_bytes)
+    if defect == "missing_element":
+        element = root.xpath("//ram:InvoiceCurrencyCode", namespaces=NSMAP)[0]
+        element.getparent().remove(element)
+    elif defect == "wrong_totals":
+        element = root.xpath(
+            "//ram:SpecifiedTradeSettlementHeaderMonetarySummation/ram:GrandTotalAmount", namespaces=NSMAP
+        )[0]
+        element.text = str(Decimal(element.text) + Decimal("1.00"))
+    else:
+        raise ValueError(f"unknown defect {defect!r}")
+    return etree.tostring(root, xml_declaration=True, encoding="UTF-8", pretty_print=True)
+
+
+def build_document(options: CorpusOptions, index: int) -> Tuple[str, bytes, Dict[str, Any]]:
+    """Return (filename, content, manifest entry) of the document ``index``."""
+    from .utils import _render_invoice_pdf
+
+    invoice = make_invoice(options, index)
+    rnd = _rng(options, "document", index)
+    level = rnd.choice(options.levels)
+    defect: Optional[str] = None
+    if options.mode != "pdf" and rnd.random() < options.invalid_ratio:
+        # a malformed XML file can't be embedded in a PDF
+        defect = rnd.choice(DEFECTS if options.mode == "xml" else DEFECTS[:2])
+    entry: Dict[str, Any] = {
+        "index": index,
+        "invoice_number": invoice.invoice_number,
+        "lines": len(invoice.line_items),
+        "vat_rates": sorted({str(line.vat_rate) for line in invoice.line_items}),
+    }
+    if options.mode != "pdf":
+        xml_bytes = convert_level(build_facturx_xml(invoice), level)
+        if defect:
+            xml_bytes = add_defect(xml_bytes, defect)
+        entry.update(level=level, valid=defect is None, defect=defect)
+    if options.mode == "xml":
+        filename, content = f"{invoice.invoice_number}.xml", xml_bytes
+    else:
+        content = _render_invoice_pdf(invoice)
+        filename = f"{invoice.invoice_number}.pdf"
+    if options.mode == "facturx":
+        from facturx import generate_from_file
+
+        attachments = make_attachments(options, index, invoice)
+        entry["attachments"] = {name: len(att["filedata"]) for (name, att) in attachments.items()}
+        pdf_buffer = BytesIO(content)
+        generate_from_file(
+            pdf_buffer,
+            xml_bytes,
+            flavor="factur-x",
+            level=level,
+            check_xsd=defect is None,
+            attachments=attachments,
+        )
+        content = pdf_buffer.getvalue()
+    entry.update(file=filename, size=len(content), sha256=hashlib.sha256(content).hexdigest())
+    return filename, content, entry
+
+
+def iter_documents(options: CorpusOptions) -> Iterator[Tuple[str, bytes, Dict[str, Any]]]:
+    """Generate the documents of the corpus one by one, in order."""
+    for index in range(options.count):
+        yield build_document(options, index)
+
+
+def _write_document(job: Tuple[CorpusOptions, str, int]) -> Dict[str, Any]:
+    options, output_dir, index = job
+    filename, content, entry = build_document(options, index)
+    (Path(output_dir) / filename).write_bytes(content)
+    return entry
+
+
+def write_corpus(output_dir: str | Path, options: CorpusOptions, workers: int = 1) -> Dict[str, Any]:
+    """Generate the corpus in ``output_dir`` with ``workers`` processes.
+
+    Each worker writes its documents directly to disk, so the memory used
+    doesn't depend on the size of the corpus. The manifest is written in
+    the order of the documents. Return a summary of the corpus.
+    """
+    output_path = Path(output_dir)
+    output_path.mkdir(parents=True, exist_ok=True)
+    jobs = ((options, str(output_path), index) for index in range(options.count))
+    summary: Dict[str, Any] = {"count": 0, "invalid": 0, "bytes": 0}
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        if pool:
+            chunksize = max(1, min(64, options.count // (workers * 8)))
+            entries = pool.imap(_write_document, jobs, chunksize=chunksize)
+        else:
+            entries = map(_write_document, jobs)
+        with open(output_path / "manifest.jsonl", "w", encoding="utf-8") as manifest:
+            for entry in entries:
+                manifest.write(json.dumps(entry) + "\n")
+                summary["count"] += 1
+                summary["bytes"] += entry["size"]
+                if entry.get("valid") is False:
+                    summary["invalid"] += 1
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    return summary
+
+
+def _split(value: str) -> List[str]:
+    return [part.strip() for part in value.split(",") if part.strip()]
+
+
+def main(args: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Generate a reproducible corpus of synthetic invoices.")
+    parser.add_argument("output_dir", help="Directory where the documents and manifest.jsonl are written.")
+    parser.add_argument("-n", "--count", type=int, default=100, help="Number of invoices. Default: 100.")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="Seed of the corpus. Default: 0.")
+    parser.add_argument(
+        "-m", "--mode", choices=MODES, default="facturx", help="Generate XML files, PDF files or Factur-X PDF files."
+    )
+    parser.add_argument(
+        "-l", "--levels", default="en16931", help=f"Comma-separated Factur-X levels among {', '.join(FACTURX_LEVELS)}."
+    )
+    parser.add_argument("--min-lines", type=int, default=1)
+    parser.add_argument("--max-lines", type=int, default=50)
+    parser.add_argument("--vat-rates", default="20,10,5.5,2.1", help="Comma-separated VAT rates.")
+    parser.add_argument(
+        "--mixed-vat-ratio", type=float, default=0.3, help="Share of invoices with several VAT rates. Default: 0.3."
+    )
+    parser.add_argument("--parties", type=int, default=50, help="Number of distinct companies. Default: 50.")
+    parser.add_argument("--max-attachments", type=int, default=0, help="Maximum attachments per Factur-X PDF.")
+    parser.add_argument("--attachment-size", type=int, default=20 * 1024, help="Maximum size of binary attachments.")
+    parser.add_argument(
+        "--invalid-ratio", type=float, default=0.0, help="Share of deliberately invalid XML files. Default: 0."
+    )
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of worker processes. Default: 1.")
+    args = parser.parse_args(args)
+    try:
+        options = CorpusOptions(
+            count=args.count,
+            seed=args.seed,
+            mode=args.mode,
+            levels=_split(args.levels),
+            min_lines=args.min_lines,
+            max_lines=max(args.min_lines, args.max_lines),
+            vat_rates=_split(args.vat_rates),
+            mixed_vat_ratio=args.mixed_vat_ratio,
+            parties=args.parties,
+            max_attachments=args.max_attachments,
+            attachment_size=args.attachment_size,
+            invalid_ratio=args.invalid_ratio,
+        )
+    except ValueError as exc:
+        parser.error(str(exc))
+    summary = write_corpus(args.output_dir, options, workers=args.workers)
+    print(
+        f"{summary['count']} documents ({summary['invalid']} invalid, "
+        f"{summary['bytes'] / 1024 / 1024:.1f} MiB) written in {args.output_dir}"
+    )
+
+
+__all__ = [
+    "CorpusOptions",
+    "DEFECTS",
+    "FACTURX_LEVELS",
+    "MODES",
+    "add_defect",
+    "build_document",
+    "convert_level",
+    "iter_documents",
+    "make_attachments",
+    "make_invoice",
+    "write_corpus",
+]
+
+
+if __name__ == "__main__":
+    main()
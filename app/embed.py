@@ -0,0 +1,158 @@
+"""Factur-X embedding done by reportlab, in the same pass as the rendering.
+
+``facturx.generate_from_file()`` works on any PDF file: it parses it with
+pypdf, clones every object and writes the whole file again. For the PDF
+files that the API renders itself, :func:`embed_facturx_xml` adds the same
+objects to the reportlab document before it is saved:
+
+* the XML file, its file specification in ``/EmbeddedFiles`` and ``/AF``,
+* the XMP metadata with the Factur-X extension schema,
+* an sRGB ``/OutputIntents`` entry, with the ICC profile of Pillow (a
+  dependency of reportlab),
+
+so the PDF is serialised once and never parsed again.
+"""
+
+from __future__ import annotations
+
+import hashlib
+from datetime import date, datetime
+from functools import lru_cache
+from typing import Dict, Optional
+
+from facturx import base_info2pdf_metadata, get_pdf_timestamp, prepare_pdf_metadata_txt, prepare_pdf_metadata_xml
+from facturx.facturx import FACTURX_FILENAME, XML_AFRelationship
+from facturx.profiling import annotate
+from reportlab.pdfbase.pdfdoc import PDFArray, PDFCatalog, PDFDictionary, PDFName, PDFStream, PDFString, PDFZCompress
+from reportlab.pdfgen import canvas
+
+# The catalog of reportlab only writes the keys that it knows
+_CATALOG_KEYS = PDFCatalog.__NoDefault__ + ["AF", "OutputIntents"]
+_CATALOG_REFS = PDFCatalog.__Refs__ + ["AF"]
+SRGB_OUTPUT_CONDITION = "sRGB IEC61966-2.1"
+
+
+@lru_cache(maxsize=None)
+def srgb_icc_profile() -> bytes:
+    """Return an sRGB ICC profile, built once per process."""
+    from PIL import ImageCms
+
+    return ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+
+
+@lru_cache(maxsize=None)
+def _compressed_icc_profile() -> bytes:
+    return PDFZCompress.encode(srgb_icc_profile())
+
+
+def invoice_pdf_metadata(seller: str, buyer: str, number: str, issue_date: date, doc_type: str = "380") -> Dict[str, str]:
+    """Return the pdf_metadata of facturx (title, author...) of an invoice,
+    without reading them back from the XML."""
+    return base_info2pdf_metadata(
+        {
+            "seller": seller,
+            "buyer": buyer,
+            "number": number,
+            "date": datetime.combine(issue_date, datetime.min.time()),
+            "doc_type": doc_type,
+        }
+    )
+
+
+def embed_facturx_xml(
+    pdf_canvas: canvas.Canvas,
+    xml_bytes: bytes,
+    pdf_metadata: Dict[str, str],
+    level: str = "en16931",
+    lang: Optional[str] = None,
+    afrelationship: str = "data",
+) -> None:
+    """Add the Factur-X XML and metadata to a reportlab canvas, before its
+    save(). The XML is not validated: call facturx.xml_check_xsd() first."""
+    if afrelationship not in XML_AFRelationship:
+        raise ValueError(f"Wrong value for afrelationship ({afrelationship}). Possible values: {XML_AFRelationship}.")
+    annotate(xml_size=len(xml_bytes))
+    doc = pdf_canvas._doc
+    pdf_date = get_pdf_timestamp()
+
+    embedded_file = PDFStream(
+        PDFDictionary(
+            {
+                "Type": PDFName("EmbeddedFile"),
+                # "/" is a delimiter in PDF names: PDFName() would not escape it
+                "Subtype": "/text#2Fxml",
+                "Params": PDFDictionary(
+                    {
+                        "CheckSum": PDFString(hashlib.md5(xml_bytes).hexdigest()),
+                        "ModDate": PDFString(pdf_date),
+                        "Size": len(xml_bytes),
+                    }
+                ),
+            }
+        ),
+        content=xml_bytes,
+        filters=[PDFZCompress],
+    )
+    filespec = doc.Reference(
+        PDFDictionary(
+            {
+                "Type": PDFName("Filespec"),
+                "AFRelationship": PDFName(afrelationship.capitalize()),
+                "Desc": PDFString("Factur-X XML file"),
+                "F": PDFString(FACTURX_FILENAME),
+                "UF": PDFString(FACTURX_FILENAME),
+                "EF": PDFDictionary({"F": embedded_file, "UF": embedded_file}),
+            }
+        )
+    )
+
+    # The profile is compressed once per process: a stream with a /Filter is
+    # written as is
+    icc_profile = PDFStream(
+        PDFDictionary({"N": 3, "Filter": PDFArray([PDFName(PDFZCompress.pdfname)])}),
+        content=_compressed_icc_profile(),
+        filters=[],
+    )
+    output_intent = PDFDictionary(
+        {
+            "Type": PDFName("OutputIntent"),
+            "S": PDFName("GTS_PDFA1"),
+            "OutputConditionIdentifier": PDFString(SRGB_OUTPUT_CONDITION),
+            "Info": PDFString(SRGB_OUTPUT_CONDITION),
+            "RegistryName": PDFString("http://www.color.org"),
+            "DestOutputProfile": icc_profile,
+        }
+    )
+
+    info = doc.info
+    info_dict = prepare_pdf_metadata_txt(pdf_metadata)
+    info.title = info_dict["/Title"]
+    info.author = info_dict["/Author"]
+    info.subject = info_dict["/Subject"]
+    info.keywords = info_dict["/Keywords"]
+    info.creator = info_dict["/Creator"]
+    # The dates of the info dictionary must match those of the XMP metadata
+    pdf_canvas.setDateFormatter(lambda *args: pdf_date)
+    xmp = PDFStream(
+        PDFDictionary({"Type": PDFName("Metadata"), "Subtype": PDFName("XML")}),
+        # Not compressed: PDF/A validators read the XMP packet as is
+        content=prepare_pdf_metadata_xml("factur-x", level, None, pdf_metadata, producer=info.producer),
+    )
+
+    catalog = doc.Catalog
+    # Instance attributes: the other documents of the process keep the lists
+    # of reportlab
+    catalog.__NoDefault__ = _CATALOG_KEYS
+    catalog.__Refs__ = _CATALOG_REFS
+    catalog.AF = PDFArray([filespec])
+    catalog.Names = PDFDictionary(
+        {"EmbeddedFiles": PDFDictionary({"Names": PDFArray([PDFString(FACTURX_FILENAME), filespec])})}
+    )
+    catalog.OutputIntents = PDFArray([output_intent])
+    catalog.Metadata = xmp
+    catalog.PageMode = PDFName("UseAttachments")
+    if lang:
+        catalog.Lang = PDFString(lang.replace("_", "-"))
+
+
+__all__ = ["embed_facturx_xml", "invoice_pdf_metadata", "srgb_icc_profile"]
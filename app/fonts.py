@@ -0,0 +1,187 @@
+"""Embedded TrueType fonts of the invoice PDF.
+
+Factur-X is PDF/A-3, which requires every font to be embedded in the file:
+the standard Helvetica of reportlab is not. The renderer uses TrueType fonts
+instead: Bitstream Vera, shipped with reportlab, by default, or the fonts
+given by ``FACTURX_FONT`` and ``FACTURX_BOLD_FONT`` (paths to TTF files,
+e.g. with more scripts). They are parsed once per process.
+
+Each document embeds a subset of the fonts with the glyphs that it uses,
+which reportlab builds from the glyph tables of the font, then compresses,
+when it saves the document. :class:`EmbeddedFont` caches the compressed font
+files, their ToUnicode maps and widths per process, by the code points of
+the subset. To make the invoices use the same subsets, each document first
+assigns the accented letters of the western European languages
+(:data:`SUBSET_SEED`) to the free codes of the first subset: an invoice
+written with ASCII and these letters then uses exactly the same subset as
+all the others, and its font files are a cache hit.
+
+:meth:`EmbeddedFont.addObjects` replaces the method of reportlab that writes
+the font objects, and uses its internals: requirements.txt pins the tested
+versions of reportlab, and tests/test_render.py checks that the objects are
+the same as the ones of reportlab.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+from functools import lru_cache
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+import reportlab
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.pdfdoc import (
+    DummyDoc,
+    PDFArray,
+    PDFDictionary,
+    PDFDocument,
+    PDFName,
+    PDFObject,
+    PDFStream,
+    PDFTrueTypeFont,
+    PDFZCompress,
+)
+from reportlab.pdfbase.pdfdoc import format as pdf_format
+from reportlab.pdfbase.ttfonts import FF_NONSYMBOLIC, FF_SYMBOLIC, SUBSETN, TTFont, TTFontFace, makeToUnicodeCMap
+from reportlab.pdfgen import canvas
+
+from .config import env_int
+
+_REPORTLAB_FONTS = os.path.join(os.path.dirname(reportlab.__file__), "fonts")
+FONT_PATH = os.environ.get("FACTURX_FONT") or os.path.join(_REPORTLAB_FONTS, "Vera.ttf")
+BOLD_FONT_PATH = os.environ.get("FACTURX_BOLD_FONT") or os.path.join(_REPORTLAB_FONTS, "VeraBd.ttf")
+FONT = "FacturX"
+BOLD_FONT = "FacturX-Bold"
+FONT_SUBSET_CACHE_SIZE = env_int("FACTURX_FONT_SUBSET_CACHE_SIZE", 64)
+# 31 characters: the free codes 1 to 31 of the first subset, whose codes 32
+# to 127 are ASCII
+SUBSET_SEED = "àâäçéèêëîïôöùûüÀÂÇÉÈÊÔÖÜßñ€’«»°"
+
+
+class _Formatted(PDFObject):
+    """A PDF object formatted in advance."""
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def format(self, document) -> bytes:
+        return self.data
+
+
+class _SubsetObjects(NamedTuple):
+    font_file: bytes
+    font_file_length: int
+    to_unicode: bytes
+    widths: _Formatted
+
+
+def _encode(content: bytes, compression: bool) -> bytes:
+    return PDFZCompress.encode(content) if compression else content
+
+
+def _stream(content: bytes, compression: bool) -> PDFStream:
+    """Return a stream whose content is already encoded: it is written as is."""
+    if not compression:
+        return PDFStream(content=content)
+    stream = PDFStream(content=content, filters=[])
+    stream.dictionary["Filter"] = PDFArray([PDFName(PDFZCompress.pdfname)])
+    return stream
+
+
+@lru_cache(maxsize=FONT_SUBSET_CACHE_SIZE)
+def _subset_objects(face: TTFontFace, base_font_name: str, subset: Tuple[int, ...], compression: bool) -> _SubsetObjects:
+    font_file = face.makeSubset(list(subset))
+    return _SubsetObjects(
+        _encode(font_file, compression),
+        len(font_file),
+        _encode(makeToUnicodeCMap(base_font_name, list(subset)).encode("latin-1"), compression),
+        _Formatted(pdf_format(PDFArray([face.getCharWidth(code) for code in subset]), DummyDoc())),
+    )
+
+
+class EmbeddedFont(TTFont):
+    """A TrueType font whose subsets are built and compressed once per
+    process, instead of once per document."""
+
+    def __init__(self, name: str, filename: str):
+        super().__init__(name, filename, asciiReadable=1)
+
+    def addObjects(self, doc: PDFDocument) -> None:
+        # The same objects as TTFont.addObjects(), from the cache
+        face = self.face
+        state = self._assignState(doc)
+        state.frozen = 1
+        compression = bool(doc.compression)
+        for index, subset in enumerate(state.subsets):
+            internal_name = self.getSubsetInternalName(index, doc)[1:]
+            base_font_name = b"".join((SUBSETN(index), b"+", face.name, face.subfontNameX)).decode("pdfdoc")
+            objects = _subset_objects(face, base_font_name, tuple(subset), compression)
+
+            font_file = _stream(objects.font_file, compression)
+            font_file.dictionary["Length1"] = objects.font_file_length
+            descriptor = PDFDictionary(
+                {
+                    "Type": PDFName("FontDescriptor"),
+                    "Ascent": face.ascent,
+                    "CapHeight": face.capHeight,
+                    "Descent": face.descent,
+                    "Flags": (face.flags & ~FF_NONSYMBOLIC) | FF_SYMBOLIC,
+                    "FontBBox": PDFArray(face.bbox),
+                    "FontName": PDFName(base_font_name),
+                    "ItalicAngle": face.italicAngle,
+                    "StemV": face.stemV,
+                    "FontFile2": doc.Reference(font_file, f"fontFile:{face.filename}({base_font_name})"),
+                    "MissingWidth": face.defaultWidth,
+                }
+            )
+            pdf_font = PDFTrueTypeFont()
+            pdf_font.Name = internal_name
+            pdf_font.BaseFont = base_font_name
+            pdf_font.FirstChar = 0
+            pdf_font.LastChar = len(subset) - 1
+            pdf_font.Widths = objects.widths
+            pdf_font.ToUnicode = doc.Reference(_stream(objects.to_unicode, compression), f"toUnicodeCMap:{base_font_name}")
+            pdf_font.FontDescriptor = doc.Reference(descriptor, f"fontDescriptor:{base_font_name}")
+            doc.Reference(pdf_font, internal_name)
+            doc.idToObject["BasicFonts"].dict[internal_name] = pdf_font
+        del self.state[doc]
+
+
+_fonts: Optional[Tuple[EmbeddedFont, EmbeddedFont]] = None
+_fonts_lock = threading.Lock()
+
+
+def register_fonts() -> Tuple[EmbeddedFont, EmbeddedFont]:
+    """Load and register the regular and bold fonts, once per process."""
+    global _fonts
+    # A document must only use one object per font: the threads that render
+    # the first invoices wait for the same fonts
+    with _fonts_lock:
+        if _fonts is None:
+            fonts = EmbeddedFont(FONT, FONT_PATH), EmbeddedFont(BOLD_FONT, BOLD_FONT_PATH)
+            for font in fonts:
+                pdfmetrics.registerFont(font)
+            _fonts = fonts
+    return _fonts
+
+
+def prepare_fonts(pdf_canvas: canvas.Canvas, texts: Iterable[Tuple[str, str]] = ()) -> None:
+    """Add the fonts to the document of the canvas, before anything is drawn.
+
+    The fonts get the same resource names (/F1, /F2) and the same first
+    codes in every document; the codes of ``texts``, pairs of font name and
+    text, are then assigned in this order, as when they were drawn in
+    another document whose content stream is reused.
+    """
+    fonts = register_fonts()
+    doc = pdf_canvas._doc
+    for font in fonts:
+        font.getSubsetInternalName(0, doc)
+        font.splitString(SUBSET_SEED, doc)
+    fonts_by_name = {font.fontName: font for font in fonts}
+    for font_name, text in texts:
+        fonts_by_name[font_name].splitString(text, doc)
+
+
+__all__ = ["BOLD_FONT", "FONT", "EmbeddedFont", "prepare_fonts", "register_fonts"]
@@ -0,0 +1,442 @@
+"""Asynchronous jobs of the invoice API, for the heavy generations.
+
+``POST /jobs`` stores the invoice in a queue and returns a job id at once,
+instead of holding the connection while the invoice is generated; the
+client polls ``GET /jobs/{id}`` and downloads ``GET /jobs/{id}/result``.
+
+The queue is a SQLite database (:class:`JobStore`): the invoices, their
+status and the generated PDF files. With a database file, the jobs survive
+a restart of the API and several API processes can share the queue: a job
+is claimed with a single UPDATE, and it is claimed again by any process if
+the process that runs it doesn't finish it before the end of its lease
+(crash, kill). The lease of a running job is renewed while it runs, and
+the result of an attempt is only saved if the job wasn't claimed again. :class:`JobQueue` runs the jobs in the process pool of the
+API (see :mod:`app.pool`), from a set of dispatcher tasks of the event loop.
+
+The jobs have a priority lane (:data:`LANES`): a job is only started when
+no job of a higher lane is waiting, and the jobs of a lane are started in
+the order they were received. A job that fails with an error is retried,
+with an exponential backoff, up to a maximum number of attempts; an invalid
+invoice fails at once. The finished jobs, and their PDF files, are deleted
+after a time to live.
+
+The queue is configured with environment variables:
+
+* ``FACTURX_JOBS_DB``: path of the SQLite database (default: an in-memory
+  database, the jobs are lost when the API stops),
+* ``FACTURX_JOB_WORKERS``: number of jobs run at the same time by each API
+  process (default: the number of workers of the pool),
+* ``FACTURX_JOB_MAX_ATTEMPTS``: number of attempts of a job (default: 3),
+* ``FACTURX_JOB_RETRY_DELAY``: delay in seconds before the first retry,
+  doubled at each retry (default: 1),
+* ``FACTURX_JOB_RESULT_TTL``: time in seconds during which a finished job
+  and its PDF file are kept (default: 86400),
+* ``FACTURX_JOB_LEASE``: time in seconds after which a job that is still
+  running is considered lost and started again (default: 300).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from .batch import generate_from_payload
+from .config import env_float, env_int
+from .metrics import observe_profile, output_size, profiled_call
+from .pool import InvoicePool, PoolSaturated
+
+logger = logging.getLogger(__name__)
+
+# Priority of each lane: the lowest number is started first
+LANES = {"high": 0, "normal": 1, "bulk": 2}
+LANE_NAMES = {priority: lane for lane, priority in LANES.items()}
+# Delay between two looks at the queue when the dispatchers are idle, to see
+# the jobs received by the other processes and the retries
+POLL_INTERVAL = 1.0
+PURGE_INTERVAL = 60.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    priority INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    payload TEXT,
+    digest TEXT NOT NULL,
+    idempotency_key TEXT UNIQUE,
+    invoice_number TEXT,
+    error TEXT,
+    result BLOB,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    run_after REAL NOT NULL,
+    expires REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (priority, created) WHERE status IN ('queued', 'running');
+CREATE INDEX IF NOT EXISTS jobs_expires ON jobs (expires) WHERE expires IS NOT NULL;
+"""
+_STATUS_COLUMNS = "id, priority, status, attempts, invoice_number, error, created, updated, expires"
+
+
+class IdempotencyConflict(Exception):
+    """Raised when an Idempotency-Key was already used for another invoice."""
+
+
+def _timestamp(value: Optional[float]) -> Optional[str]:
+    if value is None:
+        return None
+    return datetime.fromtimestamp(value, timezone.utc).isoformat(timespec="seconds")
+
+
+def _status(row: sqlite3.Row) -> Dict[str, Any]:
+    status: Dict[str, Any] = {
+        "id": row["id"],
+        "status": row["status"],
+        "lane": LANE_NAMES.get(row["priority"], str(row["priority"])),
+        "attempts": row["attempts"],
+        "invoice_number": row["invoice_number"],
+        "created": _timestamp(row["created"]),
+        "updated": _timestamp(row["updated"]),
+    }
+    if row["expires"] is not None:
+        status["expires"] = _timestamp(row["expires"])
+    if row["error"] is not None:
+        status["error"] = json.loads(row["error"])
+    return status
+
+
+class JobStore:
+    """SQLite queue of the jobs. Its methods are blocking but short: the
+    API calls them in threads, one at a time per process."""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or ":memory:"
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def open(self) -> None:
+        if self._connection is not None:
+            return
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        if self.path != ":memory:":
+            # Readers don't block the writer, and the other API processes
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(_SCHEMA)
+        self._connection = connection
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _execute(self, sql: str, parameters: Any = ()) -> List[sqlite3.Row]:
+        if self._connection is None:
+            raise RuntimeError("The job store is not open")
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def submit(
+        self, payload: str, lane: str = "normal", idempotency_key: Optional[str] = None, now: Optional[float] = None
+    ) -> Tuple[Dict[str, Any], bool]:
+        """Queue a job for the JSON invoice ``payload``. Return (status of
+        the job, True if it was created, False if it already existed for
+        this Idempotency-Key)."""
+        now = time.time() if now is None else now
+        digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+        rows = self._execute(
+            f"""INSERT INTO jobs (id, priority, status, payload, digest, idempotency_key, created, updated, run_after)
+            VALUES (?, ?, 'queued', ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (idempotency_key) DO NOTHING
+            RETURNING {_STATUS_COLUMNS}""",
+            (uuid.uuid4().hex, LANES[lane], payload, digest, idempotency_key, now, now, now),
+        )
+        if rows:
+            return _status(rows[0]), True
+        rows = self._execute(f"SELECT {_STATUS_COLUMNS}, digest FROM jobs WHERE idempotency_key = ?", (idempotency_key,))
+        if not rows:
+            # The previous job with this key expired in the meantime
+            return self.submit(payload, lane, idempotency_key, now)
+        if rows[0]["digest"] != digest:
+            raise IdempotencyConflict("This Idempotency-Key was already used for another invoice")
+        return _status(rows[0]), False
+
+    def get(self, job_id: str, now: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Return the status of a job, or None if it is unknown or expired."""
+        now = time.time() if now is None else now
+        rows = self._execute(
+            f"SELECT {_STATUS_COLUMNS} FROM jobs WHERE id = ? AND (expires IS NULL OR expires > ?)", (job_id, now)
+        )
+        return _status(rows[0]) if rows else None
+
+    def result(self, job_id: str, now: Optional[float] = None) -> Tuple[Optional[Dict[str, Any]], Optional[bytes]]:
+        """Return (status of the job, PDF file if the job is done)."""
+        now = time.time() if now is None else now
+        rows = self._execute(
+            f"SELECT {_STATUS_COLUMNS}, result FROM jobs WHERE id = ? AND (expires IS NULL OR expires > ?)",
+            (job_id, now),
+        )
+        if not rows:
+            return None, None
+        return _status(rows[0]), rows[0]["result"]
+
+    def claim(self, lease: float, now: Optional[float] = None) -> Optional[Tuple[str, str, int]]:
+        """Start the next job: the first one of the highest lane that is
+        waiting, or whose lease ended. Return (id, payload, attempts)."""
+        now = time.time() if now is None else now
+        # run_after is the end of the lease of a running job
+        rows = self._execute(
+            """UPDATE jobs SET status = 'running', attempts = attempts + 1, updated = ?, run_after = ?
+            WHERE id = (
+                SELECT id FROM jobs WHERE status IN ('queued', 'running') AND run_after <= ?
+                ORDER BY priority, created LIMIT 1
+            )
+            RETURNING id, payload, attempts""",
+            (now, now + lease, now),
+        )
+        return (rows[0]["id"], rows[0]["payload"], rows[0]["attempts"]) if rows else None
+
+    def renew(self, job_id: str, attempts: int, lease: float, now: Optional[float] = None) -> bool:
+        """Extend the lease of a running job, if its attempt ``attempts`` is
+        still the current one. Return False if it was claimed again."""
+        now = time.time() if now is None else now
+        rows = self._execute(
+            """UPDATE jobs SET run_after = ?, updated = ?
+            WHERE id = ? AND attempts = ? AND status = 'running' RETURNING id""",
+            (now + lease, now, job_id, attempts),
+        )
+        return bool(rows)
+
+    def finish(
+        self,
+        job_id: str,
+        attempts: int,
+        status: str,
+        ttl: float,
+        result: Optional[bytes] = None,
+        invoice_number: Optional[str] = None,
+        error: Any = None,
+        now: Optional[float] = None,
+    ) -> bool:
+        """Mark a job "done" with its PDF file, or "failed" with its error.
+        Like :meth:`renew`, only for its attempt ``attempts``: the result of
+        a run whose lease ended doesn't replace the one of the next run."""
+        now = time.time() if now is None else now
+        rows = self._execute(
+            """UPDATE jobs SET status = ?, result = ?, invoice_number = ?, error = ?, payload = NULL,
+            updated = ?, expires = ? WHERE id = ? AND attempts = ? AND status = 'running' RETURNING id""",
+            (status, result, invoice_number, None if error is None else json.dumps(error), now, now + ttl, job_id, attempts),
+        )
+        return bool(rows)
+
+    def retry(
+        self,
+        job_id: str,
+        attempts: int,
+        delay: float,
+        error: Any = None,
+        count: bool = True,
+        now: Optional[float] = None,
+    ) -> bool:
+        """Put a job back in the queue, to start it again after ``delay``.
+        With ``count`` False, the attempt doesn't count (it didn't run).
+        Like :meth:`finish`, only for its attempt ``attempts``."""
+        now = time.time() if now is None else now
+        rows = self._execute(
+            """UPDATE jobs SET status = 'queued', attempts = attempts - ?, error = ?, updated = ?, run_after = ?
+            WHERE id = ? AND attempts = ? AND status = 'running' RETURNING id""",
+            (0 if count else 1, None if error is None else json.dumps(error), now, now + delay, job_id, attempts),
+        )
+        return bool(rows)
+
+    def purge(self, now: Optional[float] = None) -> int:
+        """Delete the expired jobs and return their number."""
+        now = time.time() if now is None else now
+        return len(self._execute("DELETE FROM jobs WHERE expires <= ? RETURNING id", (now,)))
+
+    def counts(self) -> Dict[str, int]:
+        """Number of jobs of each status."""
+        return {row["status"]: row["count"] for row in self._execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status")}
+
+
+class JobQueue:
+    """Dispatchers that run the jobs of a :class:`JobStore` in the pool."""
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        workers: int = 1,
+        max_attempts: int = 3,
+        retry_delay: float = 1,
+        result_ttl: float = 86400,
+        lease: float = 300,
+    ):
+        self.store = JobStore(path)
+        self.workers = max(workers, 1)
+        self.max_attempts = max(max_attempts, 1)
+        self.retry_delay = retry_delay
+        self.result_ttl = result_ttl
+        self.lease = lease
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+        self._pool: Optional[InvoicePool] = None
+        self._tasks: List[asyncio.Task] = []
+        self._wake: Optional[asyncio.Event] = None
+        self._stopping = False
+
+    @classmethod
+    def from_env(cls, workers: int = 1) -> "JobQueue":
+        return cls(
+            path=os.environ.get("FACTURX_JOBS_DB") or None,
+            workers=env_int("FACTURX_JOB_WORKERS", workers),
+            max_attempts=env_int("FACTURX_JOB_MAX_ATTEMPTS", 3),
+            retry_delay=env_float("FACTURX_JOB_RETRY_DELAY", 1),
+            result_ttl=env_float("FACTURX_JOB_RESULT_TTL", 86400),
+            lease=env_float("FACTURX_JOB_LEASE", 300),
+        )
+
+    async def start(self, pool: InvoicePool) -> None:
+        """Open the store and start the dispatchers."""
+        await asyncio.to_thread(self.store.open)
+        self._pool = pool
+        self._stopping = False
+        self._wake = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._dispatch()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._purge()))
+
+    async def stop(self) -> None:
+        """Stop starting jobs, wait for the running ones and close the store."""
+        self._stopping = True
+        if self._wake is not None:
+            self._wake.set()
+        tasks, self._tasks = self._tasks, []
+        for task in tasks[self.workers:]:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.to_thread(self.store.close)
+
+    async def submit(self, payload: str, lane: str = "normal", idempotency_key: Optional[str] = None) -> Tuple[Dict[str, Any], bool]:
+        created = await asyncio.to_thread(self.store.submit, payload, lane, idempotency_key)
+        if self._wake is not None:
+            self._wake.set()
+        return created
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self.store.get, job_id)
+
+    async def result(self, job_id: str) -> Tuple[Optional[Dict[str, Any]], Optional[bytes]]:
+        return await asyncio.to_thread(self.store.result, job_id)
+
+    async def _dispatch(self) -> None:
+        assert self._wake is not None
+        while not self._stopping:
+            # Cleared before looking at the queue: a job submitted meanwhile
+            # sets it again
+            self._wake.clear()
+            try:
+                job = await asyncio.to_thread(self.store.claim, self.lease)
+            except sqlite3.Error as exc:
+                logger.warning("Cannot read the job queue: %s", exc)
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.running += 1
+            try:
+                await self._run(*job)
+            except sqlite3.Error as exc:
+                # The job is started again at the end of its lease
+                logger.warning("Cannot save the job %s: %s", job[0], exc)
+            finally:
+                self.running -= 1
+
+    async def _run(self, job_id: str, payload: str, attempts: int) -> None:
+        assert self._pool is not None
+        store = self.store
+        if attempts > self.max_attempts:
+            # Its previous attempts were interrupted (end of the lease)
+            if await self._save(store.finish, job_id, attempts, "failed", self.result_ttl, error="The job was interrupted too many times"):
+                self.failed += 1
+            return
+        heartbeat = asyncio.create_task(self._heartbeat(job_id, attempts))
+        try:
+            (status, number, result), profile = await self._pool.run(profiled_call, generate_from_payload, json.loads(payload))
+        except PoolSaturated as exc:
+            # Not an attempt: the job waits while the pool is busy with the
+            # synchronous requests, or for the next start of the API
+            await self._save(store.retry, job_id, attempts, exc.retry_after, count=False)
+            if not exc.draining:
+                await asyncio.sleep(exc.retry_after)
+            return
+        except Exception as exc:
+            if attempts >= self.max_attempts:
+                logger.warning("Job %s failed after %d attempts: %s", job_id, attempts, exc)
+                if await self._save(store.finish, job_id, attempts, "failed", self.result_ttl, error=str(exc)):
+                    self.failed += 1
+            else:
+                logger.info("Job %s failed, attempt %d: %s", job_id, attempts, exc)
+                delay = self.retry_delay * 2 ** (attempts - 1)
+                if await self._save(store.retry, job_id, attempts, delay, str(exc)):
+                    self.retries += 1
+            return
+        finally:
+            heartbeat.cancel()
+        observe_profile(profile)
+        if status == "ok":
+            output_size.observe(len(result), kind="pdf")
+            if await self._save(store.finish, job_id, attempts, "done", self.result_ttl, result, number):
+                self.completed += 1
+        else:
+            # An invalid invoice fails the same way at every attempt
+            if await self._save(store.finish, job_id, attempts, "invalid", self.result_ttl, invoice_number=number, error=result):
+                self.failed += 1
+
+    async def _heartbeat(self, job_id: str, attempts: int) -> None:
+        # Renews the lease while the job runs, so that a long job isn't
+        # claimed again by another dispatcher or process
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                renewed = await asyncio.to_thread(self.store.renew, job_id, attempts, self.lease)
+            except sqlite3.Error as exc:
+                logger.warning("Cannot renew the lease of the job %s: %s", job_id, exc)
+                continue
+            if not renewed:
+                logger.warning("Job %s was claimed again during its attempt %d", job_id, attempts)
+                return
+
+    async def _save(self, method: Any, job_id: str, attempts: int, *args: Any, **kwargs: Any) -> bool:
+        # finish() or retry(), ignored if the job was claimed again meanwhile
+        saved = await asyncio.to_thread(method, job_id, attempts, *args, **kwargs)
+        if not saved:
+            logger.warning("Job %s: the attempt %d ended after its lease, its result is ignored", job_id, attempts)
+        return saved
+
+    async def _purge(self) -> None:
+        while True:
+            try:
+                purged = await asyncio.to_thread(self.store.purge)
+            except sqlite3.Error as exc:
+                logger.warning("Cannot purge the job queue: %s", exc)
+            else:
+                if purged:
+                    logger.info("%d expired jobs deleted", purged)
+            await asyncio.sleep(PURGE_INTERVAL)
+
+
+__all__ = ["LANES", "IdempotencyConflict", "JobQueue", "JobStore"]
@@ -1,15 +1,160 @@
 from __future__ import annotations
 
-from fastapi import Body, FastAPI, HTTPException, Response
+import asyncio
+import gzip
+import json
+from contextlib import asynccontextmanager
+from tempfile import SpooledTemporaryFile
+from time import perf_counter
+from typing import Any, Callable, Dict, Optional, Tuple
 
+from fastapi import Body, FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+from .batch import JSON_MEDIA_TYPES, NDJSON_MEDIA_TYPES, SPOOL_MAX_SIZE, iter_json_array, iter_ndjson, stream_zip
+from .cache import ResultCache, content_key, result_key
+from .columns import CSV_MEDIA_TYPES, generate_from_columns
+from .jobs import LANES, IdempotencyConflict, JobQueue
+from .metrics import (
+    MetricsMiddleware,
+    observe_profile,
+    output_size,
+    pool_rejections,
+    profiled_call,
+    register_counter,
+    register_gauge,
+    registry,
+)
 from .models import INVOICE_EXAMPLE, Invoice
-from .utils import generate_facturx_pdf
+from .pool import InvoicePool, PoolSaturated
+from .tracing import RequestTrace, TracingMiddleware, get_trace
+from .utils import generate_facturx_pdf, generate_facturx_xml
+from .warmup import Readiness
+
+pool = InvoicePool.from_env()
+cache = ResultCache.from_env()
+readiness = Readiness()
+jobs = JobQueue.from_env(workers=max(pool.workers, 1))
+
+register_gauge("facturx_pool_workers", "Worker processes of the pool.", lambda: pool.workers)
+register_gauge("facturx_pool_in_flight", "Jobs running or waiting in the process pool.", lambda: pool.pending)
+register_gauge(
+    "facturx_pool_queue_depth",
+    "Jobs waiting for a free worker process.",
+    lambda: max(0, pool.pending - max(pool.workers, 1)),
+)
+register_counter("facturx_result_cache_hits_total", "Documents served from the result cache.", lambda: cache.hits)
+register_counter("facturx_result_cache_misses_total", "Documents generated on a cache miss.", lambda: cache.misses)
+register_gauge("facturx_result_cache_bytes", "Size of the in-memory result cache.", lambda: cache.size)
+register_gauge("facturx_jobs_running", "Asynchronous jobs running in this process.", lambda: jobs.running)
+register_counter("facturx_jobs_completed_total", "Asynchronous jobs done by this process.", lambda: jobs.completed)
+register_counter("facturx_jobs_failed_total", "Asynchronous jobs failed or invalid in this process.", lambda: jobs.failed)
+register_counter("facturx_jobs_retries_total", "Attempts of asynchronous jobs that failed and were retried.", lambda: jobs.retries)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The workers are forked now, but the server accepts connections while
+    # they warm up: /ready answers 503 until the warm-up is done
+    readiness.status = "starting"
+    pool.start(wait=False)
+    warm_up = asyncio.create_task(readiness.warm_up(pool, app))
+    await jobs.start(pool)
+    try:
+        yield
+    finally:
+        readiness.status = "draining"
+        warm_up.cancel()
+        # The running jobs finish before the pool stops, the queued ones
+        # wait in the store for the next start
+        await jobs.stop()
+        await pool.shutdown()
+
 
 app = FastAPI(
     title="API Factur-X",
     description="Génération de PDF et XML conformes EN16931",
     version="1.0.0",
+    lifespan=lifespan,
 )
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
+
+
+def _saturated(exc: PoolSaturated) -> HTTPException:
+    # 503 while draining for shutdown, 429 when the queue is full
+    pool_rejections.inc(reason="draining" if exc.draining else "queue_full")
+    return HTTPException(
+        status_code=503 if exc.draining else 429,
+        detail=str(exc),
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+def _check_idempotency_key(request: Request, key: str) -> None:
+    idempotency_key = request.headers.get("idempotency-key")
+    if idempotency_key and not cache.check_idempotency_key(idempotency_key, key, request.scope.get("path", "")):
+        raise HTTPException(status_code=422, detail="This Idempotency-Key was already used for another invoice")
+
+
+def _not_modified(request: Request, etag: str) -> Optional[Response]:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if "*" in tags or etag in tags:
+            return Response(status_code=304, headers={"ETag": etag})
+    return None
+
+
+def _accepts_gzip(request: Request) -> bool:
+    """Whether the Accept-Encoding header accepts gzip: "gzip;q=0" refuses
+    it, and "*" stands for the encodings that are not listed."""
+    qualities: Dict[str, float] = {}
+    for item in request.headers.get("accept-encoding", "").split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            qualities[coding.lower()] = quality
+    quality = qualities.get("gzip", qualities.get("x-gzip", qualities.get("*", 0.0)))
+    return quality > 0
+
+
+def _trace(request: Request, invoice: Invoice) -> RequestTrace:
+    # No trace when the endpoint is called without the middleware (tests)
+    trace = get_trace(request.scope) or RequestTrace("")
+    trace.info["lines"] = len(invoice.line_items)
+    return trace
+
+
+async def _generate(
+    trace: RequestTrace, kind: str, key: str, func: Callable[..., bytes], *args: Any
+) -> Tuple[bytes, Dict[str, str]]:
+    """Return the document from the cache, or generate it in the pool."""
+
+    async def create() -> bytes:
+        start = perf_counter()
+        data, profile = await pool.run(profiled_call, func, *args)
+        trace.add_profile(profile, perf_counter() - start)
+        observe_profile(profile)
+        output_size.observe(len(data), kind=kind)
+        return data
+
+    try:
+        data, hit = await cache.get_or_create(key, create)
+    except PoolSaturated as exc:
+        raise _saturated(exc) from exc
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    trace.traced = True
+    trace.cache = "hit" if hit else "miss"
+    return data, {"ETag": f'"{key}"', "X-Cache": trace.cache}
 
 
 @app.get("/")
@@ -18,17 +163,210 @@ def ping() -> dict[str, str]:
     return {"message": "API opérationnelle"}
 
 
+@app.get("/ready")
+def ready() -> JSONResponse:
+    """Readiness probe: 200 once the caches are warm, 503 while the API
+    starts, after a failed warm-up and while it shuts down."""
+    content: Dict[str, Any] = {"status": readiness.status}
+    if readiness.ready:
+        return JSONResponse(content)
+    if readiness.error:
+        content["error"] = readiness.error
+    return JSONResponse(content, status_code=503, headers={"Retry-After": "1"})
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics() -> PlainTextResponse:
+    """Metrics of this API process in the Prometheus text format."""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.post("/invoices/pdf", response_class=Response)
-def create_invoice_pdf(
+async def create_invoice_pdf(
+    request: Request,
+    invoice: Invoice = Body(
+        ..., examples={"ValidInvoice": {"summary": "Invoice conforme", "value": INVOICE_EXAMPLE}}
+    ),
+) -> Response:
+    key = result_key(invoice, "pdf")
+    _check_idempotency_key(request, key)
+    not_modified = _not_modified(request, f'"{key}"')
+    if not_modified:
+        return not_modified
+    pdf_bytes, headers = await _generate(_trace(request, invoice), "pdf", key, generate_facturx_pdf, invoice)
+    headers["Content-Disposition"] = f"attachment; filename=invoice-{invoice.invoice_number}.pdf"
+    return Response(content=pdf_bytes, media_type="application/pdf", headers=headers)
+
+
+@app.post("/invoices/xml", response_class=Response)
+async def create_invoice_xml(
+    request: Request,
     invoice: Invoice = Body(
         ..., examples={"ValidInvoice": {"summary": "Invoice conforme", "value": INVOICE_EXAMPLE}}
+    ),
+    check_xsd: bool = Query(False, description="Validate the XML against the Factur-X EN16931 XSD"),
+) -> Response:
+    """Return the Factur-X XML of the invoice, without rendering any PDF."""
+    key = result_key(invoice, "xml+xsd" if check_xsd else "xml")
+    _check_idempotency_key(request, key)
+    use_gzip = _accepts_gzip(request)
+    # Each encoding of the document has its own ETag
+    etag = f'"{key}-gzip"' if use_gzip else f'"{key}"'
+    not_modified = _not_modified(request, etag)
+    if not_modified:
+        return not_modified
+    xml_bytes, headers = await _generate(
+        _trace(request, invoice), "xml", key, generate_facturx_xml, invoice, check_xsd
+    )
+    headers.update(
+        {
+            "Content-Disposition": f"attachment; filename=factur-x-{invoice.invoice_number}.xml",
+            "ETag": etag,
+            "Vary": "Accept-Encoding",
+        }
     )
+    if use_gzip:
+        # Not in the event loop: a large XML takes a while to compress
+        xml_bytes = await asyncio.to_thread(gzip.compress, xml_bytes, compresslevel=6)
+        headers["Content-Encoding"] = "gzip"
+    return Response(content=xml_bytes, media_type="application/xml", headers=headers)
+
+
+@app.post("/invoices/pdf:batch", response_class=StreamingResponse)
+async def create_invoice_pdf_batch(request: Request) -> StreamingResponse:
+    """Generate a batch of invoices sent as a JSON array or as NDJSON.
+
+    The response is a ZIP file streamed while the invoices are generated,
+    with a manifest.json file that gives the status of each invoice.
+    """
+    media_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if media_type in NDJSON_MEDIA_TYPES:
+        parse = iter_ndjson
+    elif media_type in JSON_MEDIA_TYPES:
+        parse = iter_json_array
+    else:
+        raise HTTPException(
+            status_code=415,
+            detail=f"Send a JSON array ({JSON_MEDIA_TYPES[0]}) or NDJSON ({NDJSON_MEDIA_TYPES[0]})",
+        )
+    if pool.draining:
+        raise HTTPException(status_code=503, detail="The server is shutting down", headers={"Retry-After": "1"})
+    # The body is read before the response starts: the ASGI server may not
+    # deliver the rest of the body once the response is being streamed
+    spool = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    async for chunk in request.stream():
+        spool.write(chunk)
+    spool.seek(0)
+
+    async def content():
+        try:
+            async for data in stream_zip(parse(spool), pool, concurrency=2 * max(pool.workers, 1)):
+                yield data
+        finally:
+            spool.close()
+
+    headers = {"Content-Disposition": "attachment; filename=invoices.zip"}
+    return StreamingResponse(content(), media_type="application/zip", headers=headers)
+
+
+@app.post("/invoices/pdf:columns", response_class=Response)
+async def create_invoice_pdf_from_columns(
+    request: Request,
+    invoice: Optional[str] = Query(
+        None, description="JSON of the invoice without its lines, when the lines are sent as CSV or NDJSON"
+    ),
 ) -> Response:
+    """Generate the PDF of an invoice whose lines are sent as columns.
+
+    The body is either the JSON invoice with ``lines`` as an object of
+    columns (description, quantity, unit_price, vat_rate), or the lines
+    alone as CSV (text/csv, with a header row) or NDJSON, one object per
+    line; the rest of the invoice is then the ``invoice`` query parameter.
+    The lines are validated with NumPy in a worker (see app.columns).
+    """
+    media_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if media_type in JSON_MEDIA_TYPES:
+        if invoice is not None:
+            raise HTTPException(status_code=400, detail="The invoice parameter is only used with CSV and NDJSON lines")
+    elif media_type in CSV_MEDIA_TYPES + NDJSON_MEDIA_TYPES:
+        if invoice is None:
+            raise HTTPException(status_code=400, detail="Send the invoice without its lines in the invoice parameter")
+    else:
+        raise HTTPException(
+            status_code=415,
+            detail=f"Send JSON columns ({JSON_MEDIA_TYPES[0]}), CSV ({CSV_MEDIA_TYPES[0]}) or NDJSON ({NDJSON_MEDIA_TYPES[0]})",
+        )
+    body = await request.body()
+    parts = [media_type.encode(), body] if invoice is None else [media_type.encode(), invoice.encode("utf-8"), body]
+    key = content_key("pdf:columns", *parts)
+    _check_idempotency_key(request, key)
+    not_modified = _not_modified(request, f'"{key}"')
+    if not_modified:
+        return not_modified
+    trace = get_trace(request.scope) or RequestTrace("")
+    pdf_bytes, headers = await _generate(trace, "pdf", key, generate_from_columns, body, media_type, invoice)
+    headers["Content-Disposition"] = "attachment; filename=invoice.pdf"
+    return Response(content=pdf_bytes, media_type="application/pdf", headers=headers)
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(
+    request: Request,
+    lane: str = Query("normal", description=f"Priority lane of the job: {', '.join(LANES)}"),
+) -> JSONResponse:
+    """Queue the generation of the PDF of an invoice and return the job at once.
+
+    The body is the JSON invoice, validated when the job runs: poll
+    ``GET /jobs/{id}`` until its status is "done", "failed" or "invalid",
+    then download the PDF from ``GET /jobs/{id}/result`` (see app.jobs).
+    """
+    if lane not in LANES:
+        raise HTTPException(status_code=400, detail=f"Unknown lane {lane!r}, use one of: {', '.join(LANES)}")
+    media_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if media_type not in JSON_MEDIA_TYPES:
+        raise HTTPException(status_code=415, detail=f"Send the invoice in JSON ({JSON_MEDIA_TYPES[0]})")
+    if pool.draining:
+        raise HTTPException(status_code=503, detail="The server is shutting down", headers={"Retry-After": "1"})
+    # Decoded once, as the job stores it: json.loads() would also accept
+    # UTF-16 and UTF-32 bodies
     try:
-        pdf_bytes = generate_facturx_pdf(invoice)
-    except ValueError as exc:  # pragma: no cover - defensive
-        raise HTTPException(status_code=400, detail=str(exc)) from exc
-    headers = {
-        "Content-Disposition": f"attachment; filename=invoice-{invoice.invoice_number}.pdf",
-    }
+        body = (await request.body()).decode("utf-8")
+    except UnicodeDecodeError as exc:
+        raise HTTPException(status_code=400, detail="The invoice must be encoded in UTF-8") from exc
+    try:
+        payload = json.loads(body)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON: {exc}") from exc
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="The invoice must be a JSON object")
+    try:
+        job, created = await jobs.submit(body, lane, request.headers.get("idempotency-key"))
+    except IdempotencyConflict as exc:
+        raise HTTPException(status_code=422, detail=str(exc)) from exc
+    # A retry with the same Idempotency-Key gets the existing job
+    return JSONResponse(job, status_code=202 if created else 200, headers={"Location": f"/jobs/{job['id']}"})
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str) -> JSONResponse:
+    """Status of a job: "queued", "running", "done", "failed" or "invalid"."""
+    job = await jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job")
+    return JSONResponse(job)
+
+
+@app.get("/jobs/{job_id}/result", response_class=Response)
+async def get_job_result(job_id: str) -> Response:
+    """PDF of a job that is done. A job still in the queue answers 202 with
+    its status, a failed or invalid job 409 with its error."""
+    job, pdf_bytes = await jobs.result(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job")
+    if job["status"] in ("queued", "running"):
+        return JSONResponse(job, status_code=202, headers={"Retry-After": "1"})
+    if pdf_bytes is None:
+        return JSONResponse(job, status_code=409)
+    filename = f"invoice-{job['invoice_number']}.pdf" if job["invoice_number"] else "invoice.pdf"
+    headers = {"Content-Disposition": f"attachment; filename={filename}", "ETag": f'"{job_id}"'}
     return Response(content=pdf_bytes, media_type="application/pdf", headers=headers)
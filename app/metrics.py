@@ -0,0 +1,277 @@
+"""Metrics of the invoice API in the Prometheus text format.
+
+The metrics are kept in the memory of each API process and served by
+``GET /metrics``: no external service or client library is needed. With
+several API processes, each of them must be scraped.
+
+The generation stages are measured in the worker processes with
+:mod:`facturx.profiling` (see :func:`profiled_call`) and sent back with the
+document, then merged here into four stages: ``render`` (reportlab),
+``xml_build`` (build_facturx_xml), ``xsd_check`` and ``embed`` (the rest:
+embedding of the XML in the reportlab document and writing of the PDF file).
+"""
+
+from __future__ import annotations
+
+import threading
+from bisect import bisect_left
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from facturx.profiling import collect_profiles
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+# stages of facturx.profiling that are not part of the PDF embedding and writing
+_STAGE_NAMES = {"render": "render", "xml_build": "xml_build", "xsd_check": "xsd_check"}
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for (name, value) in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for key, value in sorted(self.values.items()):
+            yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    """Gauge whose value is read by a callback at each scrape."""
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def samples(self) -> Iterable[str]:
+        yield f"{self.name} {_format_value(self.callback())}"
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = ()):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        # {label values: [count per bucket (not cumulative), sum]}
+        self.values: Dict[Tuple[str, ...], List[Any]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts_sum = self.values.get(key)
+            if counts_sum is None:
+                counts_sum = self.values[key] = [[0] * len(self.buckets), 0.0]
+            counts_sum[0][index] += 1
+            counts_sum[1] += value
+
+    def samples(self) -> Iterable[str]:
+        for key, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.label_names, key, 'le="%s"' % _format_value(bound))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.label_names, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+registry = Registry()
+request_duration = registry.register(
+    Histogram(
+        "facturx_http_request_duration_seconds",
+        "Duration of the HTTP requests.",
+        labels=("endpoint", "status"),
+        buckets=LATENCY_BUCKETS,
+    )
+)
+stage_duration = registry.register(
+    Histogram(
+        "facturx_stage_duration_seconds",
+        "Time spent in each stage of the generation, in the worker processes.",
+        labels=("stage",),
+        buckets=STAGE_BUCKETS,
+    )
+)
+output_size = registry.register(
+    Histogram(
+        "facturx_output_size_bytes",
+        "Size of the generated documents.",
+        labels=("kind",),
+        buckets=SIZE_BUCKETS,
+    )
+)
+xsd_cache = registry.register(
+    Counter(
+        "facturx_xsd_schema_cache_total",
+        "Lookups of compiled XSD schemas in the cache of the worker processes.",
+        labels=("result",),
+    )
+)
+pool_rejections = registry.register(
+    Counter(
+        "facturx_pool_rejections_total",
+        "Jobs refused by the admission control of the process pool.",
+        labels=("reason",),
+    )
+)
+
+
+def register_gauge(name: str, documentation: str, callback: Callable[[], float]) -> None:
+    registry.register(Gauge(name, documentation, callback))
+
+
+def register_counter(name: str, documentation: str, callback: Callable[[], float]) -> None:
+    """Counter whose value is read by a callback at each scrape."""
+    gauge = Gauge(name, documentation, callback)
+    gauge.type_name = "counter"
+    registry.register(gauge)
+
+
+in_flight = 0
+
+
+class MetricsMiddleware:
+    """ASGI middleware that measures the requests, until the last byte of
+    the response is sent (streamed responses included)."""
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        global in_flight
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        start = perf_counter()
+
+        async def send_wrapper(message: Dict[str, Any]) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        in_flight += 1
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            in_flight -= 1
+            # The path of the route, not of the request, to bound the labels
+            endpoint = getattr(scope.get("route"), "path", "other")
+            request_duration.observe(perf_counter() - start, endpoint=endpoint, status=str(status))
+
+
+register_gauge("facturx_http_requests_in_flight", "HTTP requests in progress.", lambda: in_flight)
+
+
+def merge_stages(stages: Dict[str, float]) -> Dict[str, float]:
+    """Merge the stages of facturx.profiling into render, xml_build,
+    xsd_check and embed."""
+    merged: Dict[str, float] = {}
+    for name, duration in stages.items():
+        stage = _STAGE_NAMES.get(name, "embed")
+        merged[stage] = merged.get(stage, 0.0) + duration
+    return merged
+
+
+def profiled_call(func: Callable[..., Any], *args: Any) -> Tuple[Any, Optional[Dict[str, Any]]]:
+    """Call ``func(*args)`` (in a worker process) and return its result with
+    its profile: {"stages": merged stages, "info": ..., "total": seconds}."""
+    with collect_profiles() as profiles:
+        result = func(*args)
+    if not profiles:
+        return result, None
+    profile = profiles[-1]
+    return result, {"stages": merge_stages(profile.stages), "info": profile.info, "total": profile.total}
+
+
+def observe_profile(profile: Optional[Dict[str, Any]]) -> None:
+    """Record the stages of a profile returned by profiled_call()."""
+    if not profile:
+        return
+    for stage, duration in profile["stages"].items():
+        stage_duration.observe(duration, stage=stage)
+    if "xsd_cache" in profile["info"]:
+        xsd_cache.inc(result=profile["info"]["xsd_cache"])
+
+
+__all__ = [
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "MetricsMiddleware",
+    "Registry",
+    "merge_stages",
+    "observe_profile",
+    "output_size",
+    "pool_rejections",
+    "profiled_call",
+    "register_counter",
+    "register_gauge",
+    "registry",
+    "request_duration",
+]
@@ -84,7 +84,29 @@ INVOICE_EXAMPLE: Dict[str, Any] = {
 }
 
 
-class Invoice(BaseModel):
+class InvoiceHeader(BaseModel):
+    """Everything of an invoice but its lines, for the invoices whose lines
+    are streamed (see app.xml_builder.write_facturx_xml)."""
+
+    invoice_number: str = Field(..., min_length=1)
+    issue_date: date
+    due_date: Optional[date] = None
+    seller: Party
+    buyer: Party
+    currency: str = Field(default="EUR", min_length=3, max_length=3)
+    payment_reference: Optional[str] = None
+    payment_means_code: str = Field(default="30")
+    seller_bank_iban: Optional[str] = None
+
+    @field_validator("seller_bank_iban")
+    @classmethod
+    def _strip_iban(cls, value):
+        if value:
+            return value.replace(" ", "")
+        return value
+
+
+class Invoice(InvoiceHeader):
 
     model_config = ConfigDict(json_schema_extra={"example": INVOICE_EXAMPLE})
 
@@ -140,28 +162,14 @@ class Invoice(BaseModel):
         }
     )
 
-    invoice_number: str = Field(..., min_length=1)
-    issue_date: date
-    due_date: Optional[date] = None
-    seller: Party
-    buyer: Party
-    currency: str = Field(default="EUR", min_length=3, max_length=3)
     line_items: List[LineItem] = Field(..., min_length=1)
-    payment_reference: Optional[str] = None
-    payment_means_code: str = Field(default="30")
-    seller_bank_iban: Optional[str] = None
 
-    @field_validator("seller_bank_iban")
-    @classmethod
-    def _strip_iban(cls, value):
-        if value:
-            return value.replace(" ", "")
-        return value
 
 __all__ = [
     "Address",
     "Party",
     "LineItem",
+    "InvoiceHeader",
     "Invoice",
     "INVOICE_EXAMPLE",
 ]
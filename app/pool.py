@@ -0,0 +1,151 @@
+"""Process pool that runs the CPU-bound invoice generation off the event loop.
+
+Rendering, XML building, XSD validation and the PDF writing all hold the
+GIL, so threads don't scale. :class:`InvoicePool` keeps a set of worker
+processes, forked and warmed up (imports, fonts, XSD files) when the API
+starts, and applies admission control: at most ``workers`` jobs run and at
+most ``queue_depth`` jobs wait; beyond that, :class:`PoolSaturated` is raised
+immediately instead of letting the latency grow without bound.
+
+The pool is configured with environment variables:
+
+* ``FACTURX_WORKERS``: number of worker processes (default: number of CPUs).
+  With 0, the jobs run in the default thread pool of the event loop.
+* ``FACTURX_QUEUE_DEPTH``: number of jobs that may wait for a free worker
+  (default: twice the number of workers).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import math
+import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable, List, Optional
+
+from .config import env_int
+
+logger = logging.getLogger(__name__)
+
+
+class PoolSaturated(Exception):
+    """Raised when a job is refused by the admission control.
+
+    ``draining`` is True when the pool is shutting down, False when the
+    queue is full. ``retry_after`` is a hint in seconds for the client.
+    """
+
+    def __init__(self, message: str, retry_after: int = 1, draining: bool = False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.draining = draining
+
+
+def warm_up_worker() -> None:
+    """Initializer of the worker processes: import everything and generate
+    an invoice once, so that the first real request doesn't pay for the
+    imports, the fonts and the XSD files."""
+    from .warmup import warm_up_process
+
+    warm_up_process()
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+class InvoicePool:
+    """Pool of pre-warmed worker processes with a bounded queue."""
+
+    def __init__(self, workers: Optional[int] = None, queue_depth: Optional[int] = None, warm_up: bool = True):
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.queue_depth = 2 * self.workers if queue_depth is None else queue_depth
+        self.warm_up = warm_up
+        self.pending = 0  # jobs running or waiting for a worker
+        self.draining = False
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._idle: Optional[asyncio.Event] = None
+        self._mean_duration = 0.0
+        self._starting: List[Future] = []
+
+    @classmethod
+    def from_env(cls) -> "InvoicePool":
+        workers = env_int("FACTURX_WORKERS", os.cpu_count() or 1)
+        return cls(workers=workers, queue_depth=env_int("FACTURX_QUEUE_DEPTH", 2 * max(workers, 1)))
+
+    @property
+    def capacity(self) -> int:
+        return max(self.workers, 1) + self.queue_depth
+
+    def start(self, wait: bool = True) -> None:
+        """Fork the worker processes and, if ``wait``, wait until they are
+        all warmed up. Otherwise, await :meth:`wait_started` for that.
+
+        Until start() is called, the jobs run in the default thread pool,
+        which is what the unit tests and ``FACTURX_WORKERS=0`` rely on.
+        """
+        self.draining = False
+        if not self.workers or self._executor is not None:
+            return
+        initializer = warm_up_worker if self.warm_up else None
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=initializer)
+        # The processes are spawned on demand: submit one job per worker so
+        # that they are all forked and initialized before the first request
+        self._starting = [self._executor.submit(_ping) for _ in range(self.workers)]
+        if wait:
+            pids = {future.result() for future in self._starting}
+            self._starting = []
+            logger.info("Invoice pool started with %d worker processes %s", self.workers, sorted(pids))
+
+    async def wait_started(self) -> None:
+        """Wait until the workers forked by ``start(wait=False)`` are warmed up."""
+        starting, self._starting = self._starting, []
+        if starting:
+            pids = await asyncio.gather(*(asyncio.wrap_future(future) for future in starting))
+            logger.info("Invoice pool started with %d worker processes %s", self.workers, sorted(set(pids)))
+
+    def _retry_after(self) -> int:
+        # Time for the jobs already admitted to go through the workers
+        return max(1, math.ceil(self._mean_duration * self.pending / max(self.workers, 1)))
+
+    async def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        """Run ``func(*args)`` in a worker, or raise PoolSaturated at once."""
+        if self.draining:
+            raise PoolSaturated("The server is shutting down", retry_after=self._retry_after(), draining=True)
+        if self.pending >= self.capacity:
+            raise PoolSaturated(
+                f"Too many invoices in progress ({self.pending})", retry_after=self._retry_after()
+            )
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            duration = time.perf_counter() - start
+            self._mean_duration = 0.9 * self._mean_duration + 0.1 * duration if self._mean_duration else duration
+            self.pending -= 1
+            if not self.pending and self._idle is not None:
+                self._idle.set()
+
+    async def shutdown(self, timeout: Optional[float] = None) -> None:
+        """Refuse new jobs, wait for the admitted ones and stop the workers."""
+        self.draining = True
+        if self.pending:
+            logger.info("Waiting for %d invoices in progress", self.pending)
+            self._idle = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("%d invoices still in progress after %ss", self.pending, timeout)
+            finally:
+                self._idle = None
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
+            logger.info("Invoice pool stopped")
+
+
+__all__ = ["InvoicePool", "PoolSaturated", "warm_up_worker"]
@@ -0,0 +1,295 @@
+"""Paginated PDF rendering of an invoice.
+
+The lines are laid out in a table that continues on as many pages as
+needed. Each continuation page repeats the table header and starts with the
+subtotal carried forward from the previous page, which ends with it. The
+totals and the VAT breakdown are on the last page. The layout of the pages
+is computed from the number of lines before anything is drawn, so the pages
+are numbered "Page 2/5" while the lines are still read from an iterator.
+
+The letterhead (the seller) and the legal footer are the same on every page
+of every invoice of a seller: they are drawn once as a Form XObject, which
+each page shows with a single operator. The content stream of the form is
+built and compressed once per process and per seller
+(:func:`_page_template`) and only added to each new document: a PDF object
+cannot be shared by two documents. Most invoices come from a handful of
+sellers, so only the templates of the last :data:`TEMPLATE_CACHE_SIZE`
+sellers are kept.
+
+The public API of reportlab draws a form in the document that shows it
+(``beginForm()``/``doForm()``), so the cached template relies on internals
+of reportlab, pinned in requirements.txt: ``endForm()`` leaves the content
+of the form, not yet encoded, in the ``stream`` attribute of the
+``PDFFormXObject`` registered under its name, ``PDFDocument.addForm()``
+registers a form built outside the canvas, and a ``PDFStream`` whose
+dictionary has a /Filter entry is written without being encoded again.
+tests/test_render.py checks the template in the generated PDF files.
+"""
+
+from __future__ import annotations
+
+from functools import lru_cache
+from io import BytesIO
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from reportlab import rl_config
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfbase.pdfdoc import (
+    PDFArray,
+    PDFBase85Encode,
+    PDFFormXObject,
+    PDFName,
+    PDFStream,
+    PDFZCompress,
+    xObjectName,
+)
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfgen import canvas
+
+from .fonts import BOLD_FONT, FONT, prepare_fonts, register_fonts
+from .models import InvoiceHeader, Party
+from .totals import VatGroup, format_amount
+
+# The text of a line in the PDF: description, quantity, unit price, and the
+# net amount in cents
+DisplayLine = Tuple[str, str, str, int]
+
+PAGE_WIDTH, PAGE_HEIGHT = A4
+MARGIN = 40
+TEMPLATE_FORM = "PageTemplate"
+TEMPLATE_CACHE_SIZE = 32
+
+ROW_HEIGHT = 14
+TOTAL_ROW_HEIGHT = 16
+FIRST_TABLE_TOP = PAGE_HEIGHT - 250
+NEXT_TABLE_TOP = PAGE_HEIGHT - 150
+TABLE_BOTTOM = 70
+# Table columns: right edge of the numbers
+QUANTITY_RIGHT = 370
+PRICE_RIGHT = 460
+AMOUNT_RIGHT = PAGE_WIDTH - MARGIN
+DESCRIPTION_WIDTH = 280
+
+
+def new_canvas(output, **kwargs) -> canvas.Canvas:
+    """Return a canvas for an A4 invoice. Its initial font is the embedded
+    one: with the default Helvetica, reportlab would add this font, which
+    is not embedded, to every page."""
+    register_fonts()
+    return canvas.Canvas(output, pagesize=A4, initialFontName=FONT, **kwargs)
+
+
+def _rows(top: float) -> int:
+    # Table header, then one row per line and the carried forward subtotal
+    return int((top - ROW_HEIGHT - TABLE_BOTTOM) // ROW_HEIGHT) - 1
+
+
+FIRST_PAGE_ROWS = _rows(FIRST_TABLE_TOP)
+NEXT_PAGE_ROWS = _rows(NEXT_TABLE_TOP) - 1  # "Carried forward" row at the top
+
+
+def paginate(line_count: int, vat_group_count: int) -> List[int]:
+    """Return the number of lines of each page. The totals (subtotal, one
+    row per VAT rate and total due) follow the lines of the last page; when
+    they don't fit, the last page only has the totals."""
+    totals_rows = -(-(vat_group_count + 3) * TOTAL_ROW_HEIGHT // ROW_HEIGHT) + 1
+    pages = []
+    remaining, capacity = line_count, FIRST_PAGE_ROWS
+    while remaining + totals_rows > capacity:
+        count = min(remaining, capacity)
+        pages.append(count)
+        remaining -= count
+        capacity = NEXT_PAGE_ROWS
+    pages.append(remaining)
+    return pages
+
+
+def _party_lines(party: Party) -> List[str]:
+    address = party.address
+    return [party.name, address.street, f"{address.postal_code} {address.city}", address.country_code]
+
+
+def _legal_notice(seller: Party, iban: Optional[str]) -> str:
+    parts = [seller.name]
+    if seller.tax_registration_id:
+        parts.append(f"Registration: {seller.tax_registration_id}")
+    if seller.vat_identifier:
+        parts.append(f"VAT: {seller.vat_identifier}")
+    if iban:
+        parts.append(f"IBAN: {iban}")
+    return " - ".join(parts)
+
+
+def _draw_page_template(pdf_canvas: canvas.Canvas, seller: Party, iban: Optional[str]) -> List[Tuple[str, str]]:
+    """Draw the letterhead and the footer, and return the texts drawn with
+    their font."""
+    texts = []
+
+    def draw(draw_string, x_position: float, y_position: float, font: str, size: float, text: str) -> None:
+        pdf_canvas.setFont(font, size)
+        draw_string(x_position, y_position, text)
+        texts.append((font, text))
+
+    name, *address = _party_lines(seller)
+    draw(pdf_canvas.drawString, MARGIN, PAGE_HEIGHT - 50, BOLD_FONT, 14, name)
+    y_position = PAGE_HEIGHT - 64
+    for text in address + ([seller.email] if seller.email else []):
+        draw(pdf_canvas.drawString, MARGIN, y_position, FONT, 9, text)
+        y_position -= 11
+    pdf_canvas.setLineWidth(0.5)
+    pdf_canvas.line(MARGIN, PAGE_HEIGHT - 120, PAGE_WIDTH - MARGIN, PAGE_HEIGHT - 120)
+    pdf_canvas.line(MARGIN, 48, PAGE_WIDTH - MARGIN, 48)
+    draw(pdf_canvas.drawCentredString, PAGE_WIDTH / 2, 36, FONT, 7, _legal_notice(seller, iban))
+    return texts
+
+
+def _stream_filters(compression: bool) -> list:
+    if not compression:
+        return []
+    return [PDFBase85Encode, PDFZCompress] if rl_config.useA85 else [PDFZCompress]
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _page_template(
+    seller_json: str, iban: Optional[str], compression: bool
+) -> Tuple[bytes, Tuple[str, ...], Tuple[Tuple[str, str], ...]]:
+    """Return the content stream of the page template of a seller, already
+    compressed, the names of its filters and the texts that it shows."""
+    seller = Party.model_validate_json(seller_json)
+    pdf_canvas = new_canvas(BytesIO())
+    prepare_fonts(pdf_canvas)
+    pdf_canvas.beginForm(TEMPLATE_FORM)
+    texts = _draw_page_template(pdf_canvas, seller, iban)
+    pdf_canvas.endForm()
+    content = pdf_canvas._doc.idToObject[xObjectName(TEMPLATE_FORM)].stream
+    filters = _stream_filters(compression)
+    for stream_filter in reversed(filters):
+        content = stream_filter.encode(content)
+    return content, tuple(stream_filter.pdfname for stream_filter in filters), tuple(texts)
+
+
+def _add_page_template(pdf_canvas: canvas.Canvas, invoice: InvoiceHeader) -> None:
+    content, filter_names, texts = _page_template(
+        invoice.seller.model_dump_json(), invoice.seller_bank_iban, bool(pdf_canvas._pageCompression)
+    )
+    # The text of the stream is encoded with the codes of the font subsets:
+    # the document must give the same codes to the same characters
+    prepare_fonts(pdf_canvas, texts)
+    form = PDFFormXObject(lowerx=0, lowery=0, upperx=PAGE_WIDTH, uppery=PAGE_HEIGHT)
+    # A stream with a /Filter entry is written as is: the cached content is
+    # not compressed again in each document
+    form.Contents = PDFStream(content=content, filters=[])
+    if filter_names:
+        form.Contents.dictionary["Filter"] = PDFArray([PDFName(name) for name in filter_names])
+    pdf_canvas._doc.addForm(TEMPLATE_FORM, form)
+
+
+def _fit(text: str, font: str, size: float, width: float) -> str:
+    """Shorten a text that is wider than ``width``."""
+    if stringWidth(text, font, size) <= width:
+        return text
+    while text and stringWidth(text + "...", font, size) > width:
+        text = text[:-1]
+    return text + "..."
+
+
+def _draw_table_header(pdf_canvas: canvas.Canvas, y_position: float) -> None:
+    pdf_canvas.setFont(BOLD_FONT, 9)
+    pdf_canvas.drawString(MARGIN, y_position, "#")
+    pdf_canvas.drawString(MARGIN + 30, y_position, "Description")
+    pdf_canvas.drawRightString(QUANTITY_RIGHT, y_position, "Quantity")
+    pdf_canvas.drawRightString(PRICE_RIGHT, y_position, "Unit price")
+    pdf_canvas.drawRightString(AMOUNT_RIGHT, y_position, "Amount")
+
+
+def _draw_subtotal(pdf_canvas: canvas.Canvas, y_position: float, label: str, amount: int, currency: str) -> None:
+    pdf_canvas.setFont(BOLD_FONT, 9)
+    pdf_canvas.drawString(MARGIN + 30, y_position, label)
+    pdf_canvas.drawRightString(AMOUNT_RIGHT, y_position, f"{format_amount(amount)} {currency}")
+
+
+def _draw_first_page_header(pdf_canvas: canvas.Canvas, invoice: InvoiceHeader) -> None:
+    pdf_canvas.setFont(BOLD_FONT, 16)
+    pdf_canvas.drawString(MARGIN, PAGE_HEIGHT - 150, f"Invoice {invoice.invoice_number}")
+    pdf_canvas.setFont(FONT, 10)
+    dates = f"Issue date: {invoice.issue_date.isoformat()}"
+    if invoice.due_date:
+        dates += f"    Due date: {invoice.due_date.isoformat()}"
+    pdf_canvas.drawString(MARGIN, PAGE_HEIGHT - 166, dates)
+    x_position = PAGE_WIDTH / 2 + 40
+    pdf_canvas.setFont(BOLD_FONT, 10)
+    pdf_canvas.drawString(x_position, PAGE_HEIGHT - 150, "Buyer:")
+    pdf_canvas.setFont(FONT, 10)
+    y_position = PAGE_HEIGHT - 164
+    for text in _party_lines(invoice.buyer):
+        pdf_canvas.drawString(x_position, y_position, text)
+        y_position -= 12
+
+
+def _draw_totals(
+    pdf_canvas: canvas.Canvas, y_position: float, vat_groups: List[VatGroup], line_total: int, tax_total: int, currency: str
+) -> None:
+    pdf_canvas.setFont(BOLD_FONT, 11)
+    pdf_canvas.drawString(MARGIN, y_position, f"Subtotal: {format_amount(line_total)} {currency}")
+    pdf_canvas.setFont(FONT, 10)
+    for group in vat_groups:
+        y_position -= TOTAL_ROW_HEIGHT
+        pdf_canvas.drawString(
+            MARGIN, y_position, f"VAT {group.rate}% on {format_amount(group.basis)}: {format_amount(group.tax)} {currency}"
+        )
+    y_position -= TOTAL_ROW_HEIGHT
+    pdf_canvas.setFont(BOLD_FONT, 11)
+    pdf_canvas.drawString(MARGIN, y_position, f"VAT: {format_amount(tax_total)} {currency}")
+    y_position -= TOTAL_ROW_HEIGHT
+    pdf_canvas.drawString(MARGIN, y_position, f"Total due: {format_amount(line_total + tax_total)} {currency}")
+
+
+def draw_invoice(pdf_canvas: canvas.Canvas, invoice: InvoiceHeader, lines: Iterable[DisplayLine], totals) -> int:
+    """Draw the pages of the invoice on the canvas and return their number.
+
+    ``lines`` may be an iterator of totals.line_count lines; ``totals`` is
+    an app.totals.InvoiceTotals or an app.columns.ColumnTotals.
+    """
+    currency = invoice.currency
+    vat_groups = totals.vat_groups
+    pages = paginate(totals.line_count, len(vat_groups))
+    _add_page_template(pdf_canvas, invoice)
+    lines_iter: Iterator[DisplayLine] = iter(lines)
+    index = 0
+    subtotal = 0
+    for page_number, line_count in enumerate(pages, start=1):
+        pdf_canvas.doForm(TEMPLATE_FORM)
+        pdf_canvas.setFont(FONT, 8)
+        pdf_canvas.drawRightString(AMOUNT_RIGHT, 20, f"Page {page_number}/{len(pages)}")
+        if page_number == 1:
+            _draw_first_page_header(pdf_canvas, invoice)
+            y_position = FIRST_TABLE_TOP
+        else:
+            pdf_canvas.setFont(BOLD_FONT, 12)
+            pdf_canvas.drawString(MARGIN, PAGE_HEIGHT - 140, f"Invoice {invoice.invoice_number} (continued)")
+            y_position = NEXT_TABLE_TOP
+        _draw_table_header(pdf_canvas, y_position)
+        y_position -= ROW_HEIGHT
+        if page_number > 1:
+            _draw_subtotal(pdf_canvas, y_position, "Carried forward", subtotal, currency)
+            y_position -= ROW_HEIGHT
+        pdf_canvas.setFont(FONT, 9)
+        for description, quantity, unit_price, net_amount in islice(lines_iter, line_count):
+            index += 1
+            subtotal += net_amount
+            pdf_canvas.drawString(MARGIN, y_position, str(index))
+            pdf_canvas.drawString(MARGIN + 30, y_position, _fit(description, FONT, 9, DESCRIPTION_WIDTH))
+            pdf_canvas.drawRightString(QUANTITY_RIGHT, y_position, quantity)
+            pdf_canvas.drawRightString(PRICE_RIGHT, y_position, unit_price)
+            pdf_canvas.drawRightString(AMOUNT_RIGHT, y_position, format_amount(net_amount))
+            y_position -= ROW_HEIGHT
+        if page_number < len(pages):
+            _draw_subtotal(pdf_canvas, y_position, "Carried forward to next page", subtotal, currency)
+        else:
+            _draw_totals(pdf_canvas, y_position - 10, vat_groups, totals.line_total, totals.tax_total, currency)
+        pdf_canvas.showPage()
+    return len(pages)
+
+
+__all__ = ["DisplayLine", "draw_invoice", "new_canvas", "paginate"]
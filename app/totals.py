@@ -0,0 +1,143 @@
+"""Totals of an invoice, computed once in integer minor units (cents).
+
+The XML builder and the PDF renderer both use :class:`InvoiceTotals`, so the
+two documents always show the same amounts. The amounts are kept as
+integers: the inputs (quantity, unit price, VAT rate) are converted to exact
+fractions and each amount is rounded once, half up, to the cent:
+
+* line net amount (BT-131) = quantity x unit price,
+* VAT category taxable amount (BT-116) = sum of the line net amounts of the
+  rate,
+* VAT category tax amount (BT-117) = taxable amount x rate / 100, rounded on
+  the taxable amount of the category (EN16931 BR-S-09) and not summed from
+  the rounded VAT of each line,
+* sum of line net amounts (BT-106), total VAT (BT-110) and grand total
+  (BT-112) are sums of rounded amounts.
+
+The VAT of each line, which is not part of EN16931 but is written in the
+line of the XML, is rounded the same way.
+"""
+
+from __future__ import annotations
+
+from decimal import Decimal
+from typing import Dict, Iterable, List, Tuple
+
+from .models import LineItem
+
+CENTS = 100
+
+
+def _fraction(value: Decimal) -> Tuple[int, int]:
+    """Return (numerator, denominator) of a Decimal, the denominator being a
+    power of 10."""
+    exponent = value.as_tuple().exponent
+    if exponent >= 0:
+        return int(value), 1
+    return int(value.scaleb(-exponent)), 10 ** -exponent
+
+
+def round_half_up(numerator: int, denominator: int) -> int:
+    """Round numerator / denominator to an integer, halves away from zero."""
+    if numerator < 0:
+        return -round_half_up(-numerator, denominator)
+    quotient, remainder = divmod(numerator, denominator)
+    return quotient + (2 * remainder >= denominator)
+
+
+def format_amount(cents: int) -> str:
+    """Format an amount in cents as in the XML: 1234 -> "12.34"."""
+    sign = "-" if cents < 0 else ""
+    units, cents = divmod(abs(cents), CENTS)
+    return f"{sign}{units}.{cents:02d}"
+
+
+def normalize_rate(rate: Decimal) -> Decimal:
+    """Return the rate without trailing zeros, so that it is shown the same
+    way whatever the input: 20, 20.0 and 20.00 -> 20, 5.50 -> 5.5."""
+    normalized = rate.normalize()
+    return normalized.quantize(1) if normalized.as_tuple().exponent > 0 else normalized
+
+
+class VatGroup:
+    """VAT breakdown of one rate (BG-23)."""
+
+    __slots__ = ("rate", "basis", "tax")
+
+    def __init__(self, rate: Decimal, basis: int, tax: int):
+        # The same text in the PDF for the invoices built from objects
+        # (InvoiceTotals) and from columns (app.columns)
+        self.rate = normalize_rate(rate)
+        self.basis = basis  # cents
+        self.tax = tax  # cents
+
+    def __repr__(self) -> str:
+        return f"VatGroup({self.rate}, basis={self.basis}, tax={self.tax})"
+
+
+class InvoiceTotals:
+    """Accumulator of the amounts of an invoice, line by line.
+
+    With ``keep_lines=False`` (streamed invoices), the amounts of the lines
+    are returned by add_line() but not kept.
+    """
+
+    def __init__(self, keep_lines: bool = True):
+        self.keep_lines = keep_lines
+        self.lines: List[Tuple[int, int]] = []  # (net amount, VAT) in cents
+        self.line_count = 0
+        self._bases: Dict[Decimal, int] = {}  # rate -> taxable amount in cents
+        self._rates: Dict[Decimal, Tuple[int, int]] = {}  # rate -> fraction of rate / 100
+
+    def _rate_fraction(self, rate: Decimal) -> Tuple[int, int]:
+        fraction = self._rates.get(rate)
+        if fraction is None:
+            numerator, denominator = _fraction(rate)
+            fraction = self._rates[rate] = (numerator, denominator * 100)
+        return fraction
+
+    def add_line(self, quantity: Decimal, unit_price: Decimal, vat_rate: Decimal) -> Tuple[int, int]:
+        """Add a line and return its (net amount, VAT) in cents."""
+        quantity_num, quantity_den = _fraction(quantity)
+        price_num, price_den = _fraction(unit_price)
+        net = round_half_up(quantity_num * price_num * CENTS, quantity_den * price_den)
+        rate_num, rate_den = self._rate_fraction(vat_rate)
+        tax = round_half_up(net * rate_num, rate_den)
+        self._bases[vat_rate] = self._bases.get(vat_rate, 0) + net
+        self.line_count += 1
+        if self.keep_lines:
+            self.lines.append((net, tax))
+        return net, tax
+
+    @property
+    def vat_groups(self) -> List[VatGroup]:
+        """The VAT breakdown, in the order of the first line of each rate."""
+        groups = []
+        for rate, basis in self._bases.items():
+            rate_num, rate_den = self._rate_fraction(rate)
+            groups.append(VatGroup(rate, basis, round_half_up(basis * rate_num, rate_den)))
+        return groups
+
+    @property
+    def line_total(self) -> int:
+        """Sum of the line net amounts (BT-106), which is also the total
+        taxable amount (BT-109) as there are no allowances or charges."""
+        return sum(self._bases.values())
+
+    @property
+    def tax_total(self) -> int:
+        return sum(group.tax for group in self.vat_groups)
+
+    @property
+    def grand_total(self) -> int:
+        return self.line_total + self.tax_total
+
+
+def compute_totals(line_items: Iterable[LineItem]) -> InvoiceTotals:
+    totals = InvoiceTotals()
+    for line in line_items:
+        totals.add_line(line.quantity, line.unit_price, line.vat_rate)
+    return totals
+
+
+__all__ = ["InvoiceTotals", "VatGroup", "compute_totals", "format_amount", "normalize_rate", "round_half_up"]
@@ -0,0 +1,145 @@
+"""Per-request trace of the invoice API.
+
+:class:`TracingMiddleware` gives each request an ``X-Request-Id`` (the one
+sent by the client, or a new one) and a :class:`RequestTrace` that the
+invoice endpoints fill with the stages of the generation. The breakdown is
+returned in a ``Server-Timing`` header::
+
+    Server-Timing: render;dur=3.2, xml;dur=0.9, validation;dur=0.4,
+        embed;dur=5.1, wait;dur=0.3, total;dur=11.0
+
+Requests slower than a threshold are logged with their breakdown and the
+size of the invoice (line count, XML and attachment bytes), for a sample of
+them. Environment variables:
+
+* ``FACTURX_SERVER_TIMING``: 0 to disable the Server-Timing header (default: 1),
+* ``FACTURX_SLOW_REQUEST_SECONDS``: threshold of the slow-request log
+  (default: 1),
+* ``FACTURX_SLOW_REQUEST_SAMPLE``: share of the slow requests that are logged
+  (default: 1, all of them).
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import random
+import re
+import uuid
+from time import perf_counter
+from typing import Any, Dict, List, Optional
+
+from .config import env_float
+
+logger = logging.getLogger(__name__)
+
+SCOPE_KEY = "facturx.trace"
+# Stage of the trace -> name in the Server-Timing header
+SERVER_TIMING_NAMES = {
+    "render": "render",
+    "xml_build": "xml",
+    "xsd_check": "validation",
+    "embed": "embed",
+    "wait": "wait",
+}
+_REQUEST_ID = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+
+
+class RequestTrace:
+    """Breakdown of one request, filled by the endpoints."""
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.start = perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.info: Dict[str, Any] = {}
+        self.cache: Optional[str] = None
+        self.traced = False  # True when an endpoint filled the trace
+
+    def add_profile(self, profile: Optional[Dict[str, Any]], duration: float) -> None:
+        """Add a profile of metrics.profiled_call(); ``duration`` is the time
+        the API process waited for it, so the rest is the pool overhead."""
+        self.traced = True
+        if not profile:
+            return
+        for stage, stage_duration in profile["stages"].items():
+            self.stages[stage] = self.stages.get(stage, 0.0) + stage_duration
+        self.stages["wait"] = self.stages.get("wait", 0.0) + max(0.0, duration - profile["total"])
+        self.info.update(profile["info"])
+
+    def server_timing(self, total: float) -> str:
+        metrics: List[str] = []
+        if self.cache:
+            metrics.append(f'cache;desc="{self.cache}"')
+        for stage, name in SERVER_TIMING_NAMES.items():
+            if stage in self.stages:
+                metrics.append(f"{name};dur={self.stages[stage] * 1000:.1f}")
+        metrics.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(metrics)
+
+
+def get_trace(scope: Dict[str, Any]) -> Optional[RequestTrace]:
+    return scope.get(SCOPE_KEY)
+
+
+class TracingMiddleware:
+    """ASGI middleware that adds X-Request-Id and Server-Timing headers and
+    logs a sample of the slow requests."""
+
+    def __init__(self, app: Any):
+        self.app = app
+        self.server_timing = os.environ.get("FACTURX_SERVER_TIMING", "1") not in ("0", "false", "no")
+        self.slow_seconds = env_float("FACTURX_SLOW_REQUEST_SECONDS", 1.0)
+        self.slow_sample = env_float("FACTURX_SLOW_REQUEST_SAMPLE", 1.0)
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")
+        if not request_id or not _REQUEST_ID.match(request_id):
+            request_id = uuid.uuid4().hex
+        trace = scope[SCOPE_KEY] = RequestTrace(request_id)
+        status = 500
+
+        async def send_wrapper(message: Dict[str, Any]) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"x-request-id", request_id.encode("latin-1")))
+                if self.server_timing and trace.traced:
+                    total = perf_counter() - trace.start
+                    headers.append((b"server-timing", trace.server_timing(total).encode("latin-1")))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = perf_counter() - trace.start
+            if duration >= self.slow_seconds and random.random() < self.slow_sample:
+                logger.warning(
+                    "Slow request %s: %s",
+                    request_id,
+                    json.dumps(
+                        {
+                            "request_id": request_id,
+                            "path": scope.get("path"),
+                            "status": status,
+                            "duration": round(duration, 4),
+                            "cache": trace.cache,
+                            "stages": {stage: round(value, 4) for (stage, value) in trace.stages.items()},
+                            "lines": trace.info.get("lines"),
+                            "xml_bytes": trace.info.get("xml_size"),
+                            "attachment_bytes": trace.info.get("attachments_size"),
+                        }
+                    ),
+                )
+
+
+__all__ = ["RequestTrace", "TracingMiddleware", "get_trace"]
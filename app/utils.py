@@ -1,115 +1,157 @@
 from __future__ import annotations
 
-from decimal import Decimal
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from typing import Iterable
+from typing import Callable, Iterable, Iterator, Optional
 
-from facturx import generate_from_file
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
+from facturx import xml_check_xsd
+from facturx.profiling import annotate, record, span
 
-from .models import Invoice
-from .xml_builder import build_facturx_xml
+from .columns import ColumnTotals, LineColumns
+from .config import env_int
+from .embed import embed_facturx_xml, invoice_pdf_metadata
+from .models import Invoice, InvoiceHeader
+from .render import DisplayLine, draw_invoice, new_canvas
+from .totals import InvoiceTotals, compute_totals
+from .xml_builder import build_facturx_xml, build_facturx_xml_from_columns
 
+# Below this number of lines, or with a single CPU, handing the XML over
+# to a thread costs more than the time saved
+XML_THREAD_MIN_LINES = env_int("FACTURX_XML_THREAD_MIN_LINES", 50)
+_CPU_COUNT = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+_executor: Optional[ThreadPoolExecutor] = None
 
-def _format_amount(value: Decimal) -> str:
-    return f"{value:.2f}"
 
-
-def _draw_multiline(c: canvas.Canvas, lines: Iterable[str], start_y: float, line_height: float = 18) -> float:
-    y = start_y
-    for line in lines:
-        c.drawString(40, y, line)
-        y -= line_height
-    return y
+def _invoice_lines(invoice: Invoice, totals: InvoiceTotals) -> Iterator[DisplayLine]:
+    for line, (net_amount, _) in zip(invoice.line_items, totals.lines):
+        yield line.description, str(line.quantity), str(line.unit_price), net_amount
 
 
 def _render_invoice_pdf(invoice: Invoice) -> bytes:
+    """Render the invoice as a plain PDF, without any Factur-X XML."""
     buffer = BytesIO()
-    pdf_canvas = canvas.Canvas(buffer, pagesize=A4)
-    _, height = A4
-
-    pdf_canvas.setFont("Helvetica-Bold", 16)
-    pdf_canvas.drawString(40, height - 60, f"Invoice {invoice.invoice_number}")
-
-    pdf_canvas.setFont("Helvetica", 11)
-    y_position = height - 100
-    y_position = _draw_multiline(
-        pdf_canvas,
-        [
-            "Seller:",
-            invoice.seller.name,
-            invoice.seller.address.street,
-            f"{invoice.seller.address.postal_code} {invoice.seller.address.city}",
-            invoice.seller.address.country_code,
-        ],
-        y_position,
-    )
-
-    y_position = _draw_multiline(
-        pdf_canvas,
-        [
-            "Buyer:",
-            invoice.buyer.name,
-            invoice.buyer.address.street,
-            f"{invoice.buyer.address.postal_code} {invoice.buyer.address.city}",
-            invoice.buyer.address.country_code,
-        ],
-        y_position - 20,
-    )
-
-    y_position -= 20
-    pdf_canvas.setFont("Helvetica-Bold", 12)
-    pdf_canvas.drawString(40, y_position, "Lines")
-    y_position -= 20
-    pdf_canvas.setFont("Helvetica", 11)
-
-    total_excl_tax = Decimal("0")
-    for index, line in enumerate(invoice.line_items, start=1):
-        line_total = line.unit_price * line.quantity
-        total_excl_tax += line_total
-        pdf_canvas.drawString(
-            40,
-            y_position,
-            f"{index}. {line.description} — Qty: {line.quantity} × {line.unit_price} = {_format_amount(line_total)} {invoice.currency}",
-        )
-        y_position -= 16
-
-    tax_total = sum(
-        (line.unit_price * line.quantity * line.vat_rate / Decimal("100"))
-        for line in invoice.line_items
-    )
-    grand_total = total_excl_tax + tax_total
-
-    y_position -= 10
-    pdf_canvas.setFont("Helvetica-Bold", 12)
-    pdf_canvas.drawString(40, y_position, f"Subtotal: {_format_amount(total_excl_tax)} {invoice.currency}")
-    y_position -= 16
-    pdf_canvas.drawString(40, y_position, f"VAT: {_format_amount(tax_total)} {invoice.currency}")
-    y_position -= 16
-    pdf_canvas.drawString(40, y_position, f"Total due: {_format_amount(grand_total)} {invoice.currency}")
-
-    pdf_canvas.showPage()
+    pdf_canvas = new_canvas(buffer)
+    totals = compute_totals(invoice.line_items)
+    draw_invoice(pdf_canvas, invoice, _invoice_lines(invoice, totals), totals)
     pdf_canvas.save()
-    buffer.seek(0)
-    return buffer.read()
+    return buffer.getvalue()
+
+
+def _xml_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(thread_name_prefix="facturx-xml")
+    return _executor
+
+
+def _reset_xml_executor() -> None:
+    # The threads of the parent don't exist in a forked child
+    global _executor
+    _executor = None
+
+
+# No fork() on Windows
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_xml_executor)
+
+
+def _checked_xml(build_xml: Callable[[], bytes]) -> bytes:
+    with span("xml_build"):
+        xml_bytes = build_xml()
+    with span("xsd_check"):
+        xml_check_xsd(xml_bytes, flavor="factur-x", level="en16931")
+    return xml_bytes
+
+
+def _concurrent_xml(line_count: int) -> bool:
+    return _CPU_COUNT > 1 and line_count >= XML_THREAD_MIN_LINES
+
+
+def _facturx_pdf(
+    invoice: InvoiceHeader,
+    lines: Iterable[DisplayLine],
+    totals: InvoiceTotals | ColumnTotals,
+    build_xml: Callable[[], bytes],
+) -> bytes:
+    buffer = BytesIO()
+    pdf_canvas = new_canvas(buffer, pdfVersion=(1, 7))
+    if _concurrent_xml(totals.line_count):
+        # The XML is built and validated in another thread while reportlab
+        # draws the pages: the XSD validation of lxml releases the GIL. The
+        # profiling context is copied so that its spans go to this call.
+        xml_future = _xml_executor().submit(contextvars.copy_context().run, _checked_xml, build_xml)
+        try:
+            with span("render"):
+                draw_invoice(pdf_canvas, invoice, lines, totals)
+            xml_bytes = xml_future.result()
+        finally:
+            xml_future.cancel()
+    else:
+        xml_bytes = _checked_xml(build_xml)
+        with span("render"):
+            draw_invoice(pdf_canvas, invoice, lines, totals)
+    with span("embed"):
+        pdf_metadata = invoice_pdf_metadata(
+            invoice.seller.name, invoice.buyer.name, invoice.invoice_number, invoice.issue_date
+        )
+        embed_facturx_xml(pdf_canvas, xml_bytes, pdf_metadata, level="en16931")
+    with span("write"):
+        pdf_canvas.save()
+    return buffer.getvalue()
 
 
 def generate_facturx_pdf(invoice: Invoice) -> bytes:
-    pdf_bytes = _render_invoice_pdf(invoice)
-    xml_bytes = build_facturx_xml(invoice.model_dump(mode="python"))
-
-    pdf_buffer = BytesIO(pdf_bytes)
-    pdf_buffer.seek(0)
-    generate_from_file(
-        pdf_buffer,
-        xml_bytes,
-        flavor="factur-x",
-        level="en16931",
-        check_xsd=True,
-    )
-    pdf_buffer.seek(0)
-    return pdf_buffer.read()
-
-
-__all__ = ["generate_facturx_pdf"]
+    """Render the Factur-X EN16931 PDF of the invoice.
+
+    The XML, its file specification, the XMP metadata and the OutputIntent
+    are added by reportlab while it writes the PDF (see app.embed), instead
+    of rewriting the rendered PDF with facturx.generate_from_file(). For
+    the invoices of FACTURX_XML_THREAD_MIN_LINES lines or more, the
+    rendering and the XML (build and XSD validation) run at the same time.
+    """
+    # The stages are only measured when a facturx.profiling hook is
+    # registered
+    with record("generate_facturx_pdf"):
+        # The PDF and the XML show the same amounts
+        totals = compute_totals(invoice.line_items)
+        return _facturx_pdf(
+            invoice, _invoice_lines(invoice, totals), totals, lambda: build_facturx_xml(invoice, totals)
+        )
+
+
+def generate_facturx_pdf_from_columns(invoice: InvoiceHeader, columns: LineColumns) -> bytes:
+    """Render the Factur-X EN16931 PDF of an invoice whose lines are columns
+    (see app.columns): the same document as generate_facturx_pdf(), without
+    a pydantic object per line."""
+    with record("generate_facturx_pdf"):
+        annotate(lines=len(columns))
+        totals = columns.totals()
+        return _facturx_pdf(
+            invoice,
+            columns.display_rows(totals),
+            totals,
+            lambda: build_facturx_xml_from_columns(invoice, columns, totals),
+        )
+
+
+def generate_facturx_xml(invoice: Invoice, check_xsd: bool = False) -> bytes:
+    """Build the Factur-X EN16931 XML of the invoice, without any PDF.
+
+    With check_xsd, the XML is validated against the XSD (compiled once per
+    process) and a ValueError is raised if it is invalid.
+    """
+    with record("generate_facturx_xml"):
+        with span("xml_build"):
+            xml_bytes = build_facturx_xml(invoice)
+        if check_xsd:
+            try:
+                with span("xsd_check"):
+                    xml_check_xsd(xml_bytes, flavor="factur-x", level="en16931")
+            except Exception as exc:
+                raise ValueError(str(exc)) from exc
+        return xml_bytes
+
+
+__all__ = ["generate_facturx_pdf", "generate_facturx_pdf_from_columns", "generate_facturx_xml"]
@@ -0,0 +1,81 @@
+"""Warm-up of the invoice API at start-up, and its readiness state.
+
+The first generation of an invoice in a process is much slower than the
+next ones: it compiles the XSD schemas, loads the fonts of reportlab and
+builds the pydantic validators. :func:`warm_up_process` pays for all of it
+once, in each worker process of the pool (see :mod:`app.pool`) and, when the
+invoices are generated in threads (``FACTURX_WORKERS=0``), in the API process.
+
+The API only reports itself ready (``GET /ready``) when the warm-up is done,
+so that a rolling deploy doesn't send live traffic to a cold process.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from copy import deepcopy
+from time import perf_counter
+from typing import Any, Dict, Optional
+
+from facturx import preload_xsd_schemas
+
+logger = logging.getLogger(__name__)
+
+# Factur-X levels of the documents generated by the API
+SERVED_LEVELS = ("en16931",)
+
+
+def warm_up_process() -> Dict[str, float]:
+    """Compile the XSD schemas of the served levels and generate a throwaway
+    invoice (render, XML, embed). Return the duration of each step."""
+    from .models import INVOICE_EXAMPLE, Invoice
+    from .utils import generate_facturx_pdf, generate_facturx_xml
+
+    durations: Dict[str, float] = {}
+    start = perf_counter()
+    preload_xsd_schemas("factur-x", SERVED_LEVELS)
+    durations["xsd"] = perf_counter() - start
+    start = perf_counter()
+    invoice = Invoice.model_validate(deepcopy(INVOICE_EXAMPLE))
+    generate_facturx_xml(invoice, check_xsd=True)
+    generate_facturx_pdf(invoice)
+    durations["generation"] = perf_counter() - start
+    return durations
+
+
+class Readiness:
+    """Readiness state of the API process: "starting", "ready", "failed"
+    (the warm-up raised an error) or "draining" (shutting down)."""
+
+    def __init__(self) -> None:
+        self.status = "starting"
+        self.error: Optional[str] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.status == "ready"
+
+    async def warm_up(self, pool: Any, app: Any = None) -> None:
+        """Warm up the API process and wait for the warm-up of the pool."""
+        start = perf_counter()
+        loop = asyncio.get_running_loop()
+        try:
+            if app is not None:
+                # The OpenAPI schema is built on the first request of /docs
+                await loop.run_in_executor(None, app.openapi)
+            if not pool.workers:
+                durations = await loop.run_in_executor(None, warm_up_process)
+                logger.info("API process warmed up: %s", {key: round(value, 3) for (key, value) in durations.items()})
+            await pool.wait_started()
+        except Exception as exc:
+            logger.exception("Warm-up failed")
+            self.status = "failed"
+            self.error = str(exc)
+            return
+        if self.status == "starting":
+            self.status = "ready"
+            logger.info("Ready after a warm-up of %.2fs", perf_counter() - start)
+
+
+__all__ = ["Readiness", "SERVED_LEVELS", "warm_up_process"]
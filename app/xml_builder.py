@@ -1,13 +1,16 @@
 from __future__ import annotations
 
-from collections import defaultdict
+from copy import deepcopy
 from datetime import date
 from decimal import Decimal, ROUND_HALF_UP
-from typing import Dict
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from lxml import etree
 
-from .models import Invoice, LineItem
+from .columns import ColumnTotals, LineColumns
+from .models import Invoice, InvoiceHeader, LineItem, Party
+from .totals import InvoiceTotals, compute_totals, format_amount
 
 
 NSMAP = {
@@ -19,8 +22,23 @@ NSMAP = {
 }
 
 
-def _qn(prefix: str, name: str) -> etree.QName:
-    return etree.QName(NSMAP[prefix], name)
+GUIDELINE_ID = "urn:factur-x.eu:1p0:en16931:ver1.0"
+# Distinct parties whose element is kept by _create_trade_party()
+PARTY_CACHE_SIZE = 256
+
+# The text of a line in the XML: description, unit price, quantity, VAT
+# rate, net amount and VAT amount
+LineRow = Tuple[str, str, str, str, str, str]
+
+# Each line item written by write_facturx_xml() declares its namespace
+_LINE_NSMAP = {"ram": NSMAP["ram"]}
+
+
+@lru_cache(maxsize=None)
+def _qn(prefix: str, name: str) -> str:
+    # The tags in Clark notation ("{namespace}name"): lxml parses a string
+    # tag faster than it reads a new QName object for each element
+    return f"{{{NSMAP[prefix]}}}{name}"
 
 
 def _format_decimal(value: Decimal, digits: str = "0.01") -> str:
@@ -40,95 +58,127 @@ def _date_element(tag: str, value: date, *, child_tag: str | None = None) -> etr
     return element
 
 
-def _create_trade_party(tag: str, party_data) -> etree.Element:
+def _party_key(party_data: Party) -> Tuple[Optional[str], ...]:
+    address = party_data.address
+    return (
+        party_data.name,
+        party_data.tax_registration_id,
+        address.postal_code,
+        address.street,
+        address.city,
+        address.country_code,
+        party_data.email,
+        party_data.vat_identifier,
+    )
+
+
+@lru_cache(maxsize=PARTY_CACHE_SIZE)
+def _cached_trade_party(tag: str, key: Tuple[Optional[str], ...]) -> etree.Element:
+    # Never modified: _create_trade_party() returns copies
+    name, tax_registration_id, postal_code, street, city, country_code, email, vat_identifier = key
     party_elem = etree.Element(_qn("ram", tag))
-    etree.SubElement(party_elem, _qn("ram", "Name")).text = party_data.name
-    if party_data.tax_registration_id:
+    etree.SubElement(party_elem, _qn("ram", "Name")).text = name
+    if tax_registration_id:
         legal_org = etree.SubElement(party_elem, _qn("ram", "SpecifiedLegalOrganization"))
-        etree.SubElement(legal_org, _qn("ram", "ID")).text = party_data.tax_registration_id
+        etree.SubElement(legal_org, _qn("ram", "ID")).text = tax_registration_id
     address = etree.SubElement(party_elem, _qn("ram", "PostalTradeAddress"))
-    etree.SubElement(address, _qn("ram", "PostcodeCode")).text = party_data.address.postal_code
-    etree.SubElement(address, _qn("ram", "LineOne")).text = party_data.address.street
-    etree.SubElement(address, _qn("ram", "CityName")).text = party_data.address.city
-    etree.SubElement(address, _qn("ram", "CountryID")).text = party_data.address.country_code
-    if party_data.email:
+    etree.SubElement(address, _qn("ram", "PostcodeCode")).text = postal_code
+    etree.SubElement(address, _qn("ram", "LineOne")).text = street
+    etree.SubElement(address, _qn("ram", "CityName")).text = city
+    etree.SubElement(address, _qn("ram", "CountryID")).text = country_code
+    if email:
         comms = etree.SubElement(party_elem, _qn("ram", "URIUniversalCommunication"))
-        etree.SubElement(comms, _qn("ram", "URIID")).text = party_data.email
-    if party_data.vat_identifier:
+        etree.SubElement(comms, _qn("ram", "URIID")).text = email
+    if vat_identifier:
         tax_reg = etree.SubElement(party_elem, _qn("ram", "SpecifiedTaxRegistration"))
-        etree.SubElement(tax_reg, _qn("ram", "ID"), attrib={"schemeID": "VAT"}).text = party_data.vat_identifier
+        etree.SubElement(tax_reg, _qn("ram", "ID"), attrib={"schemeID": "VAT"}).text = vat_identifier
     return party_elem
 
 
-def _line_trade_tax(line: LineItem, currency: str, line_total: Decimal) -> etree.Element:
-    tax = etree.Element(_qn("ram", "ApplicableTradeTax"))
-    tax_amount = (line_total * line.vat_rate / Decimal("100")).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-    etree.SubElement(tax, _qn("ram", "CalculatedAmount"), attrib={"currencyID": currency}).text = _format_decimal(tax_amount, "0.01")
+def _create_trade_party(tag: str, party_data: Party) -> etree.Element:
+    """Return the element of a party: a copy of the element built for the
+    first invoice of the same party, most invoices having the same seller."""
+    return deepcopy(_cached_trade_party(tag, _party_key(party_data)))
+
+
+def _line_trade_tax(parent: etree.Element, vat_rate: str, currency: str, net_amount: str, tax_amount: str) -> etree.Element:
+    tax = etree.SubElement(parent, _qn("ram", "ApplicableTradeTax"))
+    etree.SubElement(tax, _qn("ram", "CalculatedAmount"), attrib={"currencyID": currency}).text = tax_amount
     etree.SubElement(tax, _qn("ram", "TypeCode")).text = "VAT"
-    etree.SubElement(tax, _qn("ram", "BasisAmount"), attrib={"currencyID": currency}).text = _format_decimal(line_total, "0.01")
+    etree.SubElement(tax, _qn("ram", "BasisAmount"), attrib={"currencyID": currency}).text = net_amount
     etree.SubElement(tax, _qn("ram", "CategoryCode")).text = "S"
-    etree.SubElement(tax, _qn("ram", "RateApplicablePercent")).text = _format_decimal(line.vat_rate, "0.01")
+    etree.SubElement(tax, _qn("ram", "RateApplicablePercent")).text = vat_rate
     return tax
 
 
-def build_facturx_xml(invoice: Dict) -> bytes:
-    """Build a Factur-X EN16931 compliant XML document."""
+@lru_cache(maxsize=None)
+def _document_context(guideline_id: str) -> etree.Element:
+    # Never modified: _document_elements() returns copies
+    context = etree.Element(_qn("rsm", "ExchangedDocumentContext"))
+    guideline = etree.SubElement(context, _qn("ram", "GuidelineSpecifiedDocumentContextParameter"))
+    etree.SubElement(guideline, _qn("ram", "ID"), attrib={"schemeID": guideline_id}).text = guideline_id
+    return context
 
-    invoice_model = Invoice.model_validate(invoice)
-    currency = invoice_model.currency
 
-    root = etree.Element(_qn("rsm", "CrossIndustryInvoice"), nsmap=NSMAP)
+def _document_elements(invoice_model: InvoiceHeader) -> List[etree.Element]:
+    """ExchangedDocumentContext and ExchangedDocument."""
+    context = deepcopy(_document_context(GUIDELINE_ID))
 
-    context = etree.SubElement(root, _qn("rsm", "ExchangedDocumentContext"))
-    guideline = etree.SubElement(context, _qn("ram", "GuidelineSpecifiedDocumentContextParameter"))
-    etree.SubElement(
-        guideline,
-        _qn("ram", "ID"),
-        attrib={"schemeID": "urn:factur-x.eu:1p0:en16931:ver1.0"},
-    ).text = "urn:factur-x.eu:1p0:en16931:ver1.0"
-
-    document = etree.SubElement(root, _qn("rsm", "ExchangedDocument"))
+    document = etree.Element(_qn("rsm", "ExchangedDocument"))
     etree.SubElement(document, _qn("ram", "ID")).text = invoice_model.invoice_number
     etree.SubElement(document, _qn("ram", "TypeCode")).text = "380"
     issue_dt = etree.SubElement(document, _qn("ram", "IssueDateTime"))
     etree.SubElement(issue_dt, _qn("udt", "DateTimeString"), attrib={"format": "102"}).text = invoice_model.issue_date.strftime("%Y%m%d")
+    return [context, document]
+
+
+def _line_row(line: LineItem, amounts: Tuple[int, int]) -> LineRow:
+    net_amount, tax_amount = amounts
+    return (
+        line.description,
+        _format_decimal(line.unit_price, "0.01"),
+        _format_decimal(line.quantity, "0.001"),
+        _format_decimal(line.vat_rate, "0.01"),
+        format_amount(net_amount),
+        format_amount(tax_amount),
+    )
 
-    transaction = etree.SubElement(root, _qn("rsm", "SupplyChainTradeTransaction"))
 
-    vat_groups: Dict[Decimal, Dict[str, Decimal]] = defaultdict(lambda: {"basis": Decimal("0"), "tax": Decimal("0")})
+def _line_item_element(index: int, row: LineRow, currency: str, nsmap: Dict[str, str] | None = None) -> etree.Element:
+    description, unit_price, quantity, vat_rate, net_amount, tax_amount = row
+    line_item = etree.Element(_qn("ram", "IncludedSupplyChainTradeLineItem"), nsmap=nsmap)
+    doc = etree.SubElement(line_item, _qn("ram", "AssociatedDocumentLineDocument"))
+    etree.SubElement(doc, _qn("ram", "LineID")).text = str(index)
 
-    for index, line in enumerate(invoice_model.line_items, start=1):
-        line_total = (line.unit_price * line.quantity).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-        tax_amount = (line_total * line.vat_rate / Decimal("100")).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-        vat_groups[line.vat_rate]["basis"] += line_total
-        vat_groups[line.vat_rate]["tax"] += tax_amount
+    product = etree.SubElement(line_item, _qn("ram", "SpecifiedTradeProduct"))
+    etree.SubElement(product, _qn("ram", "Name")).text = description
 
-        line_item = etree.SubElement(transaction, _qn("ram", "IncludedSupplyChainTradeLineItem"))
-        doc = etree.SubElement(line_item, _qn("ram", "AssociatedDocumentLineDocument"))
-        etree.SubElement(doc, _qn("ram", "LineID")).text = str(index)
+    line_agreement = etree.SubElement(line_item, _qn("ram", "SpecifiedLineTradeAgreement"))
+    gross = etree.SubElement(line_agreement, _qn("ram", "GrossPriceProductTradePrice"))
+    etree.SubElement(gross, _qn("ram", "ChargeAmount"), attrib={"currencyID": currency}).text = unit_price
+    net = etree.SubElement(line_agreement, _qn("ram", "NetPriceProductTradePrice"))
+    etree.SubElement(net, _qn("ram", "ChargeAmount"), attrib={"currencyID": currency}).text = unit_price
 
-        product = etree.SubElement(line_item, _qn("ram", "SpecifiedTradeProduct"))
-        etree.SubElement(product, _qn("ram", "Name")).text = line.description
+    line_delivery = etree.SubElement(line_item, _qn("ram", "SpecifiedLineTradeDelivery"))
+    etree.SubElement(line_delivery, _qn("ram", "BilledQuantity"), attrib={"unitCode": "C62"}).text = quantity
 
-        line_agreement = etree.SubElement(line_item, _qn("ram", "SpecifiedLineTradeAgreement"))
-        gross = etree.SubElement(line_agreement, _qn("ram", "GrossPriceProductTradePrice"))
-        etree.SubElement(gross, _qn("ram", "ChargeAmount"), attrib={"currencyID": currency}).text = _format_decimal(line.unit_price, "0.01")
-        net = etree.SubElement(line_agreement, _qn("ram", "NetPriceProductTradePrice"))
-        etree.SubElement(net, _qn("ram", "ChargeAmount"), attrib={"currencyID": currency}).text = _format_decimal(line.unit_price, "0.01")
+    line_settlement = etree.SubElement(line_item, _qn("ram", "SpecifiedLineTradeSettlement"))
+    _line_trade_tax(line_settlement, vat_rate, currency, net_amount, tax_amount)
+    line_sum = etree.SubElement(line_settlement, _qn("ram", "SpecifiedTradeSettlementLineMonetarySummation"))
+    etree.SubElement(line_sum, _qn("ram", "LineTotalAmount"), attrib={"currencyID": currency}).text = net_amount
+    return line_item
 
-        line_delivery = etree.SubElement(line_item, _qn("ram", "SpecifiedLineTradeDelivery"))
-        etree.SubElement(line_delivery, _qn("ram", "BilledQuantity"), attrib={"unitCode": "C62"}).text = _format_decimal(line.quantity, "0.001")
 
-        line_settlement = etree.SubElement(line_item, _qn("ram", "SpecifiedLineTradeSettlement"))
-        line_settlement.append(_line_trade_tax(line, currency, line_total))
-        line_sum = etree.SubElement(line_settlement, _qn("ram", "SpecifiedTradeSettlementLineMonetarySummation"))
-        etree.SubElement(line_sum, _qn("ram", "LineTotalAmount"), attrib={"currencyID": currency}).text = _format_decimal(line_total, "0.01")
+def _header_trade_elements(invoice_model: InvoiceHeader, totals: InvoiceTotals | ColumnTotals) -> List[etree.Element]:
+    """The header sections that follow the lines: agreement, delivery and
+    settlement, with the VAT breakdown and the totals."""
+    currency = invoice_model.currency
 
-    agreement = etree.SubElement(transaction, _qn("ram", "ApplicableHeaderTradeAgreement"))
+    agreement = etree.Element(_qn("ram", "ApplicableHeaderTradeAgreement"))
     agreement.append(_create_trade_party("SellerTradeParty", invoice_model.seller))
     agreement.append(_create_trade_party("BuyerTradeParty", invoice_model.buyer))
 
-    delivery = etree.SubElement(transaction, _qn("ram", "ApplicableHeaderTradeDelivery"))
+    delivery = etree.Element(_qn("ram", "ApplicableHeaderTradeDelivery"))
     delivery.append(
         _date_element(
             "ActualDeliverySupplyChainEvent",
@@ -137,7 +187,7 @@ def build_facturx_xml(invoice: Dict) -> bytes:
         )
     )
 
-    settlement = etree.SubElement(transaction, _qn("ram", "ApplicableHeaderTradeSettlement"))
+    settlement = etree.Element(_qn("ram", "ApplicableHeaderTradeSettlement"))
     if invoice_model.payment_reference:
         etree.SubElement(settlement, _qn("ram", "PaymentReference")).text = invoice_model.payment_reference
     etree.SubElement(settlement, _qn("ram", "InvoiceCurrencyCode")).text = currency
@@ -148,17 +198,18 @@ def build_facturx_xml(invoice: Dict) -> bytes:
         account = etree.SubElement(payment_means, _qn("ram", "PayeePartyCreditorFinancialAccount"))
         etree.SubElement(account, _qn("ram", "IBANID")).text = invoice_model.seller_bank_iban
 
-    for rate, amounts in vat_groups.items():
+    vat_groups = totals.vat_groups
+    for group in vat_groups:
         tax = etree.SubElement(settlement, _qn("ram", "ApplicableTradeTax"))
-        etree.SubElement(tax, _qn("ram", "CalculatedAmount"), attrib={"currencyID": currency}).text = _format_decimal(amounts["tax"], "0.01")
+        etree.SubElement(tax, _qn("ram", "CalculatedAmount"), attrib={"currencyID": currency}).text = format_amount(group.tax)
         etree.SubElement(tax, _qn("ram", "TypeCode")).text = "VAT"
-        etree.SubElement(tax, _qn("ram", "BasisAmount"), attrib={"currencyID": currency}).text = _format_decimal(amounts["basis"], "0.01")
+        etree.SubElement(tax, _qn("ram", "BasisAmount"), attrib={"currencyID": currency}).text = format_amount(group.basis)
         etree.SubElement(tax, _qn("ram", "CategoryCode")).text = "S"
-        etree.SubElement(tax, _qn("ram", "RateApplicablePercent")).text = _format_decimal(rate, "0.01")
+        etree.SubElement(tax, _qn("ram", "RateApplicablePercent")).text = _format_decimal(group.rate, "0.01")
 
-    taxable_total = sum(group["basis"] for group in vat_groups.values())
-    tax_total = sum(group["tax"] for group in vat_groups.values())
-    grand_total = taxable_total + tax_total
+    taxable_total = format_amount(totals.line_total)
+    tax_total = format_amount(totals.tax_total)
+    grand_total = format_amount(totals.grand_total)
 
     if invoice_model.due_date:
         payment_terms = etree.SubElement(settlement, _qn("ram", "SpecifiedTradePaymentTerms"))
@@ -166,13 +217,112 @@ def build_facturx_xml(invoice: Dict) -> bytes:
         etree.SubElement(due_date, _qn("udt", "DateTimeString"), attrib={"format": "102"}).text = invoice_model.due_date.strftime("%Y%m%d")
 
     monetary = etree.SubElement(settlement, _qn("ram", "SpecifiedTradeSettlementHeaderMonetarySummation"))
-    etree.SubElement(monetary, _qn("ram", "LineTotalAmount"), attrib={"currencyID": currency}).text = _format_decimal(taxable_total, "0.01")
-    etree.SubElement(monetary, _qn("ram", "TaxBasisTotalAmount"), attrib={"currencyID": currency}).text = _format_decimal(taxable_total, "0.01")
-    etree.SubElement(monetary, _qn("ram", "TaxTotalAmount"), attrib={"currencyID": currency}).text = _format_decimal(tax_total, "0.01")
-    etree.SubElement(monetary, _qn("ram", "GrandTotalAmount"), attrib={"currencyID": currency}).text = _format_decimal(grand_total, "0.01")
-    etree.SubElement(monetary, _qn("ram", "DuePayableAmount"), attrib={"currencyID": currency}).text = _format_decimal(grand_total, "0.01")
+    etree.SubElement(monetary, _qn("ram", "LineTotalAmount"), attrib={"currencyID": currency}).text = taxable_total
+    etree.SubElement(monetary, _qn("ram", "TaxBasisTotalAmount"), attrib={"currencyID": currency}).text = taxable_total
+    etree.SubElement(monetary, _qn("ram", "TaxTotalAmount"), attrib={"currencyID": currency}).text = tax_total
+    etree.SubElement(monetary, _qn("ram", "GrandTotalAmount"), attrib={"currencyID": currency}).text = grand_total
+    etree.SubElement(monetary, _qn("ram", "DuePayableAmount"), attrib={"currencyID": currency}).text = grand_total
+
+    return [agreement, delivery, settlement]
 
+
+def _build_xml(invoice_model: InvoiceHeader, rows: Iterable[LineRow], totals: InvoiceTotals | ColumnTotals) -> bytes:
+    currency = invoice_model.currency
+    root = etree.Element(_qn("rsm", "CrossIndustryInvoice"), nsmap=NSMAP)
+    root.extend(_document_elements(invoice_model))
+    transaction = etree.SubElement(root, _qn("rsm", "SupplyChainTradeTransaction"))
+    for index, row in enumerate(rows, start=1):
+        transaction.append(_line_item_element(index, row, currency))
+    transaction.extend(_header_trade_elements(invoice_model, totals))
     return etree.tostring(root, xml_declaration=True, encoding="UTF-8", pretty_print=True)
 
 
-__all__ = ["build_facturx_xml"]
+def build_facturx_xml(invoice: Invoice | Dict, totals: InvoiceTotals | None = None) -> bytes:
+    """Build a Factur-X EN16931 compliant XML document.
+
+    ``invoice`` is a dict, validated here, or an Invoice that is used as
+    is. ``totals`` are those of app.totals.compute_totals() for the lines of
+    the invoice, when the caller already has them (to render the PDF).
+    """
+
+    invoice_model = invoice if isinstance(invoice, Invoice) else Invoice.model_validate(invoice)
+    if totals is None:
+        totals = compute_totals(invoice_model.line_items)
+    rows = map(_line_row, invoice_model.line_items, totals.lines)
+    return _build_xml(invoice_model, rows, totals)
+
+
+def build_facturx_xml_from_columns(
+    invoice: InvoiceHeader, columns: LineColumns, totals: ColumnTotals | None = None
+) -> bytes:
+    """Build the same document as build_facturx_xml() for an invoice whose
+    lines are columns (see app.columns)."""
+    if totals is None:
+        totals = columns.totals()
+    return _build_xml(invoice, columns.xml_rows(totals), totals)
+
+
+def _stream_element(xf: Any, element: etree.Element) -> None:
+    # xf.write(element) would declare the namespaces again: nested
+    # xf.element() calls reuse the prefixes of the root element, but they are
+    # 10 times slower, so they are only used for the few header elements
+    with xf.element(element.tag, element.attrib):
+        if element.text:
+            xf.write(element.text)
+        for child in element:
+            _stream_element(xf, child)
+
+
+def _streamed_rows(line_items: Iterable[LineItem | Dict], totals: InvoiceTotals) -> Iterator[LineRow]:
+    for line in line_items:
+        if not isinstance(line, LineItem):
+            line = LineItem.model_validate(line)
+        yield _line_row(line, totals.add_line(line.quantity, line.unit_price, line.vat_rate))
+
+
+def write_facturx_xml(
+    output: Any,
+    invoice: InvoiceHeader | Dict,
+    line_items: Iterable[LineItem | Dict] | LineColumns,
+    flush_every: int = 1000,
+) -> int:
+    """Write the Factur-X EN16931 XML of an invoice whose lines come from an
+    iterator, without keeping them in memory.
+
+    ``output`` is a file name or a binary file object (a socket file...).
+    The lines are written as they come and the VAT breakdown is accumulated
+    on the way (see app.totals); the header sections with the totals are
+    written after the last line. ``line_items`` may also be the columns of
+    app.columns, whose totals are computed first. The output is the same
+    document as build_facturx_xml(), not indented and with a namespace
+    declaration on each line item. Return the number of lines; raise
+    ValueError if there is none.
+    """
+    invoice_model = InvoiceHeader.model_validate(invoice)
+    currency = invoice_model.currency
+    totals: InvoiceTotals | ColumnTotals
+    if isinstance(line_items, LineColumns):
+        totals = line_items.totals()
+        rows = line_items.xml_rows(totals)
+    else:
+        totals = InvoiceTotals(keep_lines=False)
+        rows = _streamed_rows(line_items, totals)
+    count = 0
+    with etree.xmlfile(output, encoding="UTF-8") as xf:
+        xf.write_declaration()
+        with xf.element(_qn("rsm", "CrossIndustryInvoice"), nsmap=NSMAP):
+            for element in _document_elements(invoice_model):
+                _stream_element(xf, element)
+            with xf.element(_qn("rsm", "SupplyChainTradeTransaction")):
+                for count, row in enumerate(rows, start=1):
+                    xf.write(_line_item_element(count, row, currency, _LINE_NSMAP))
+                    if count % flush_every == 0:
+                        xf.flush()
+                if not count:
+                    raise ValueError("An invoice must have at least one line")
+                for element in _header_trade_elements(invoice_model, totals):
+                    _stream_element(xf, element)
+    return count
+
+
+__all__ = ["build_facturx_xml", "build_facturx_xml_from_columns", "write_facturx_xml"]
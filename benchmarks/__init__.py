@@ -0,0 +1,5 @@
+"""Benchmarks of the factur-x lib and of the invoice API.
+
+They are not part of the test suite. Run them from the root of the
+repository, for example: python -m benchmarks.import_time
+"""
@@ -0,0 +1,163 @@
+"""Synthetic documents for the benchmarks.
+
+The Factur-X XML files are built with app.xml_builder.build_facturx_xml()
+(EN 16931 profile) and then adapted to the requested level with
+app.corpus.convert_level(). For load tests on large and varied datasets,
+use the corpus generator of app.corpus instead. The Order-X
+XML files are minimal documents that are valid against the XSD of each
+Order-X level. The PDF files are generated with reportlab.
+All the documents are deterministic: the same arguments give the same
+content (except the timestamps written by reportlab).
+"""
+
+from decimal import Decimal
+from io import BytesIO
+import random
+
+from lxml import etree
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+
+from app.corpus import FACTURX_LEVELS, convert_level  # noqa: F401
+from app.xml_builder import build_facturx_xml
+from facturx import get_xml_namespaces
+
+ORDERX_LEVELS = ('basic', 'comfort', 'extended')
+VAT_RATES = ('20', '10', '5.5', '2.1')
+
+
+def _party(rnd, name):
+    return {
+        'name': name,
+        'address': {
+            'street': '%d Rue de la République' % rnd.randint(1, 200),
+            'postal_code': '%05d' % rnd.randint(1000, 95999),
+            'city': 'Lyon',
+            'country_code': 'FR',
+        },
+        'vat_identifier': 'FR%011d' % rnd.randint(0, 10 ** 11 - 1),
+        'tax_registration_id': '%09d' % rnd.randint(0, 10 ** 9 - 1),
+        'email': 'billing@%s.example' % name.lower().replace(' ', '-'),
+    }
+
+
+def make_invoice(lines=10, seed=0):
+    """Return an invoice as a dict for app.models.Invoice"""
+    rnd = random.Random(seed)
+    return {
+        'invoice_number': 'INV-%06d' % seed,
+        'issue_date': '2024-01-15',
+        'due_date': '2024-02-14',
+        'currency': 'EUR',
+        'payment_reference': 'INV-%06d' % seed,
+        'payment_means_code': '30',
+        'seller_bank_iban': 'FR7630004000031234567890143',
+        'seller': _party(rnd, 'Seller %d' % rnd.randint(1, 5)),
+        'buyer': _party(rnd, 'Buyer %d' % rnd.randint(1, 1000)),
+        'line_items': [
+            {
+                'description': 'Item %d' % index,
+                'quantity': str(rnd.randint(1, 50)),
+                'unit_price': str(Decimal(rnd.randint(100, 100000)) / 100),
+                'vat_rate': rnd.choice(VAT_RATES),
+            }
+            for index in range(1, lines + 1)
+        ],
+    }
+
+
+def facturx_xml(level='en16931', lines=10, seed=0):
+    """Return a Factur-X XML file of the given level as bytes.
+    The levels minimum and basicwl don't have lines."""
+    return convert_level(
+        build_facturx_xml(make_invoice(lines=lines, seed=seed)), level)
+
+
+def orderx_xml(level='basic', lines=10, seed=0):
+    """Return an Order-X XML file (order, TypeCode 220) as bytes"""
+    rnd = random.Random(seed)
+    namespaces = get_xml_namespaces('order-x')
+
+    def sub(parent, prefix, tag, text=None, **attrib):
+        element = etree.SubElement(
+            parent, etree.QName(namespaces[prefix], tag), attrib=attrib)
+        element.text = text
+        return element
+
+    root = etree.Element(
+        etree.QName(namespaces['rsm'], 'SCRDMCCBDACIOMessageStructure'),
+        nsmap=namespaces)
+    context = sub(root, 'rsm', 'ExchangedDocumentContext')
+    guideline = sub(context, 'ram', 'GuidelineSpecifiedDocumentContextParameter')
+    sub(guideline, 'ram', 'ID', 'urn:order-x.eu:1p0:%s' % level)
+    document = sub(root, 'rsm', 'ExchangedDocument')
+    sub(document, 'ram', 'ID', 'PO-%06d' % seed)
+    sub(document, 'ram', 'TypeCode', '220')
+    issue_date = sub(document, 'ram', 'IssueDateTime')
+    sub(issue_date, 'udt', 'DateTimeString', '20240115', format='102')
+    transaction = sub(root, 'rsm', 'SupplyChainTradeTransaction')
+    total = Decimal(0)
+    for index in range(1, lines + 1):
+        price = Decimal(rnd.randint(100, 100000)) / 100
+        quantity = rnd.randint(1, 50)
+        line_total = price * quantity
+        total += line_total
+        line = sub(transaction, 'ram', 'IncludedSupplyChainTradeLineItem')
+        line_doc = sub(line, 'ram', 'AssociatedDocumentLineDocument')
+        sub(line_doc, 'ram', 'LineID', str(index))
+        product = sub(line, 'ram', 'SpecifiedTradeProduct')
+        sub(product, 'ram', 'Name', 'Item %d' % index)
+        agreement = sub(line, 'ram', 'SpecifiedLineTradeAgreement')
+        net_price = sub(agreement, 'ram', 'NetPriceProductTradePrice')
+        sub(net_price, 'ram', 'ChargeAmount', '%.2f' % price)
+        delivery = sub(line, 'ram', 'SpecifiedLineTradeDelivery')
+        sub(delivery, 'ram', 'RequestedQuantity', str(quantity), unitCode='C62')
+        settlement = sub(line, 'ram', 'SpecifiedLineTradeSettlement')
+        summation = sub(
+            settlement, 'ram', 'SpecifiedTradeSettlementLineMonetarySummation')
+        sub(summation, 'ram', 'LineTotalAmount', '%.2f' % line_total)
+    agreement = sub(transaction, 'ram', 'ApplicableHeaderTradeAgreement')
+    seller = sub(agreement, 'ram', 'SellerTradeParty')
+    sub(seller, 'ram', 'Name', 'Seller %d' % rnd.randint(1, 5))
+    buyer = sub(agreement, 'ram', 'BuyerTradeParty')
+    sub(buyer, 'ram', 'Name', 'Buyer %d' % rnd.randint(1, 1000))
+    sub(transaction, 'ram', 'ApplicableHeaderTradeDelivery')
+    settlement = sub(transaction, 'ram', 'ApplicableHeaderTradeSettlement')
+    sub(settlement, 'ram', 'OrderCurrencyCode', 'EUR')
+    summation = sub(
+        settlement, 'ram', 'SpecifiedTradeSettlementHeaderMonetarySummation')
+    for tag in ('LineTotalAmount', 'TaxBasisTotalAmount', 'GrandTotalAmount'):
+        sub(summation, 'ram', tag, '%.2f' % total)
+    return etree.tostring(
+        root, xml_declaration=True, encoding='UTF-8', pretty_print=True)
+
+
+def make_pdf(pages=1):
+    """Return a regular PDF document with the given number of pages"""
+    buffer = BytesIO()
+    pdf_canvas = canvas.Canvas(buffer, pagesize=A4)
+    _, height = A4
+    for page in range(1, pages + 1):
+        pdf_canvas.setFont('Helvetica', 11)
+        y_position = height - 60
+        for row in range(45):
+            pdf_canvas.drawString(
+                40, y_position, 'Page %d - line %d - synthetic benchmark content'
+                % (page, row + 1))
+            y_position -= 16
+        pdf_canvas.showPage()
+    pdf_canvas.save()
+    return buffer.getvalue()
+
+
+def make_attachments(count=0, size=50 * 1024, seed=0):
+    """Return a dict of attachments for generate_from_file()"""
+    rnd = random.Random(seed)
+    return {
+        'attachment-%d.bin' % index: {
+            # as Random.randbytes(), which needs Python 3.9
+            'filedata': rnd.getrandbits(size * 8).to_bytes(size, 'little'),
+            'description': 'Synthetic attachment %d' % index,
+        }
+        for index in range(1, count + 1)
+    }
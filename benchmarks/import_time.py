@@ -0,0 +1,103 @@
+"""Measure the import time of the factur-x lib and of its command line tools.
+
+The import time is given by "python -X importtime" in a fresh interpreter.
+The benchmark also reports the heavy modules (pypdf, lxml...) loaded by
+each import: "import facturx" must not load any of them.
+
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --runs 20 --json import_time.json
+    python -m benchmarks.import_time --max-ms 50  # exit code 1 if slower
+"""
+
+from pathlib import Path
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+
+TARGETS = (
+    'facturx',
+    'facturx.scripts.xmlcheck',
+    'facturx.scripts.pdfextractxml',
+    'facturx.scripts.pdfgen',
+    )
+HEAVY_MODULES = (
+    'pypdf', 'lxml', 'mimetypes', 'hashlib', 'importlib.metadata')
+
+
+def _parse_importtime(stderr, target):
+    """Return the cumulative import time of target (in microseconds) and
+    the list of the heavy modules imported."""
+    cumulative = None
+    imported = set()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        parts = line[len('import time:'):].split('|')
+        # nested imports are indented after the separator space
+        name = parts[2].rstrip()[1:]
+        module = name.strip()
+        for heavy_module in HEAVY_MODULES:
+            if module == heavy_module or module.startswith(heavy_module + '.'):
+                imported.add(heavy_module)
+        if module == target and not name.startswith(' '):
+            cumulative = int(parts[1])
+    return cumulative, sorted(imported)
+
+
+def measure(target, runs=5):
+    timings = []
+    heavy_modules = []
+    for _ in range(runs):
+        proc = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import %s' % target],
+            capture_output=True, text=True, check=True, cwd=ROOT_DIR)
+        cumulative, heavy_modules = _parse_importtime(proc.stderr, target)
+        if cumulative is None:
+            raise RuntimeError('No import time found for %s' % target)
+        timings.append(cumulative / 1000)
+    return {
+        'runs': runs,
+        'min_ms': min(timings),
+        'median_ms': statistics.median(timings),
+        'heavy_modules': heavy_modules,
+        }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '-r', '--runs', type=int, default=5,
+        help="Number of runs per target. Default: 5.")
+    parser.add_argument(
+        '-j', '--json', dest='json_file',
+        help="Write the results to this JSON file.")
+    parser.add_argument(
+        '-m', '--max-ms', type=float,
+        help="Exit with code 1 if the median import time of a target "
+        "is over this value (in milliseconds).")
+    parser.add_argument(
+        'targets', nargs='*', default=list(TARGETS),
+        help="Modules to import. Default: the lib and its scripts.")
+    args = parser.parse_args(args)
+    results = {}
+    failed = False
+    for target in args.targets:
+        res = results[target] = measure(target, runs=args.runs)
+        print('%-32s median %7.1f ms  min %7.1f ms  heavy modules: %s' % (
+            target, res['median_ms'], res['min_ms'],
+            ', '.join(res['heavy_modules']) or '-'))
+        if args.max_ms is not None and res['median_ms'] > args.max_ms:
+            failed = True
+    if args.json_file:
+        with open(args.json_file, 'w') as f:
+            json.dump(results, f, indent=2)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+"""Benchmark suite of the generation, extraction and validation functions.
+
+Each case is measured on synthetic documents (see benchmarks.corpus), one
+dimension at a time: the level of the XML, the number of lines of the XML,
+the number of pages of the PDF and the number of attachments. For each
+case, the suite gives the throughput, the latency percentiles and the peak
+memory allocated by Python (facturx.profiling.memory_accounting(), based
+on tracemalloc, in a separate run because it slows down the code; the
+memory allocated by libxml2 is not included).
+
+    python -m benchmarks.suite --json results.json
+    python -m benchmarks.suite --quick --filter generate_from_file
+    python -m benchmarks.suite --baseline results.json --tolerance 0.15
+
+With --baseline, the exit code is 1 if the median latency of a case is
+more than tolerance slower than in the baseline.
+"""
+
+from datetime import datetime
+from io import BytesIO
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+
+from facturx import __version__ as fxversion
+from facturx import generate_from_binary, generate_from_file, \
+    get_xml_from_pdf, xml_check_xsd
+from facturx.profiling import memory_accounting, percentile, record
+
+from . import corpus
+
+XML_LINES = (1, 100, 1000, 10000)
+PDF_PAGES = (1, 10, 100, 500)
+ATTACHMENTS = (0, 1, 5, 10)
+QUICK_XML_LINES = (1, 100)
+QUICK_PDF_PAGES = (1, 10)
+QUICK_ATTACHMENTS = (0, 2)
+DEFAULT_LINES = 10
+DEFAULT_PAGES = 1
+
+
+class _Corpus(object):
+    """Cache of the synthetic documents used by the cases"""
+
+    def __init__(self):
+        self.cache = {}
+
+    def _get(self, key, func, *args):
+        if key not in self.cache:
+            self.cache[key] = func(*args)
+        return self.cache[key]
+
+    def xml(self, flavor, level, lines):
+        if flavor == 'order-x':
+            return self._get(
+                ('orderx', level, lines), corpus.orderx_xml, level, lines)
+        return self._get(
+            ('facturx', level, lines), corpus.facturx_xml, level, lines)
+
+    def pdf(self, pages):
+        return self._get(('pdf', pages), corpus.make_pdf, pages)
+
+    def facturx_pdf(self, flavor, level, pages):
+        return self._get(
+            ('facturx_pdf', flavor, level, pages), generate_from_binary,
+            self.pdf(pages), self.xml(flavor, level, DEFAULT_LINES))
+
+    def attachments(self, count):
+        return self._get(('attachments', count), corpus.make_attachments, count)
+
+
+def _levels():
+    return [('factur-x', level) for level in corpus.FACTURX_LEVELS] + [
+        ('order-x', level) for level in corpus.ORDERX_LEVELS]
+
+
+def build_cases(quick=False):
+    """Return a list of (name, setup) where setup() returns the function
+    to measure. The documents are generated by setup(), not measured."""
+    docs = _Corpus()
+    xml_lines = quick and QUICK_XML_LINES or XML_LINES
+    pdf_pages = quick and QUICK_PDF_PAGES or PDF_PAGES
+    attachments_counts = quick and QUICK_ATTACHMENTS or ATTACHMENTS
+    cases = []
+
+    def generate_case(flavor, level, lines, pages, attachments_count):
+        def setup():
+            pdf_bytes = docs.pdf(pages)
+            xml_bytes = docs.xml(flavor, level, lines)
+            attachments = docs.attachments(attachments_count)
+
+            def run():
+                # generate_from_file() re-writes the file and pops the
+                # attachments dict, so give it fresh objects
+                generate_from_file(
+                    BytesIO(pdf_bytes), xml_bytes,
+                    attachments=dict(attachments))
+            return run
+        return setup
+
+    def generate_binary_case(flavor, level, lines, pages):
+        def setup():
+            pdf_bytes = docs.pdf(pages)
+            xml_bytes = docs.xml(flavor, level, lines)
+            return lambda: generate_from_binary(pdf_bytes, xml_bytes)
+        return setup
+
+    def extract_case(flavor, level, pages):
+        def setup():
+            pdf_bytes = docs.facturx_pdf(flavor, level, pages)
+            return lambda: get_xml_from_pdf(pdf_bytes)
+        return setup
+
+    def check_case(flavor, level, lines):
+        def setup():
+            xml_bytes = docs.xml(flavor, level, lines)
+            return lambda: xml_check_xsd(xml_bytes)
+        return setup
+
+    for flavor, level in _levels():
+        suffix = '%s-%s' % (flavor, level)
+        cases += [
+            ('generate_from_file[level=%s]' % suffix, generate_case(
+                flavor, level, DEFAULT_LINES, DEFAULT_PAGES, 0)),
+            ('generate_from_binary[level=%s]' % suffix, generate_binary_case(
+                flavor, level, DEFAULT_LINES, DEFAULT_PAGES)),
+            ('get_xml_from_pdf[level=%s]' % suffix, extract_case(
+                flavor, level, DEFAULT_PAGES)),
+            ('xml_check_xsd[level=%s]' % suffix, check_case(
+                flavor, level, DEFAULT_LINES)),
+            ]
+    for lines in xml_lines:
+        cases += [
+            ('generate_from_file[lines=%d]' % lines, generate_case(
+                'factur-x', 'en16931', lines, DEFAULT_PAGES, 0)),
+            ('generate_from_binary[lines=%d]' % lines, generate_binary_case(
+                'factur-x', 'en16931', lines, DEFAULT_PAGES)),
+            ('xml_check_xsd[lines=%d]' % lines, check_case(
+                'factur-x', 'en16931', lines)),
+            ]
+    for pages in pdf_pages:
+        cases += [
+            ('generate_from_file[pages=%d]' % pages, generate_case(
+                'factur-x', 'en16931', DEFAULT_LINES, pages, 0)),
+            ('generate_from_binary[pages=%d]' % pages, generate_binary_case(
+                'factur-x', 'en16931', DEFAULT_LINES, pages)),
+            ('get_xml_from_pdf[pages=%d]' % pages, extract_case(
+                'factur-x', 'en16931', pages)),
+            ]
+    for count in attachments_counts:
+        cases.append((
+            'generate_from_file[attachments=%d]' % count, generate_case(
+                'factur-x', 'en16931', DEFAULT_LINES, DEFAULT_PAGES, count)))
+    return cases
+
+
+def measure(run, runs=20, max_seconds=5.0, memory=True):
+    """Call run() up to runs times (at least 3 times, and less if the total
+    time is over max_seconds) and return the statistics in seconds"""
+    run()  # warm-up: imports, XSD loading...
+    latencies = []
+    start = time.perf_counter()
+    while len(latencies) < runs:
+        call_start = time.perf_counter()
+        run()
+        latencies.append(time.perf_counter() - call_start)
+        if len(latencies) >= 3 and time.perf_counter() - start > max_seconds:
+            break
+    latencies.sort()
+    res = {
+        'runs': len(latencies),
+        'throughput': len(latencies) / sum(latencies),
+        'mean': statistics.mean(latencies),
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1],
+        'peak_memory': None,
+        }
+    if memory:
+        # A single profile for the whole run: the profiles of the calls of
+        # the lib are nested in it
+        with memory_accounting() as profiles:
+            with record('benchmark'):
+                run()
+        res['peak_memory'] = profiles[0].peak_memory
+    return res
+
+
+def run_suite(quick=False, filters=None, runs=20, max_seconds=5.0, memory=True):
+    results = {}
+    for name, setup in build_cases(quick=quick):
+        if filters and not any(pattern in name for pattern in filters):
+            continue
+        results[name] = res = measure(
+            setup(), runs=runs, max_seconds=max_seconds, memory=memory)
+        print('%-48s p50 %9.2f ms  p99 %9.2f ms  %8.1f ops/s  peak %s' % (
+            name, res['p50'] * 1000, res['p99'] * 1000, res['throughput'],
+            '-' if res['peak_memory'] is None else
+            '%.1f MiB' % (res['peak_memory'] / 1024 / 1024)))
+    return {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'facturx': fxversion,
+            'quick': quick,
+            },
+        'results': results,
+        }
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Return the list of the regressions as tuples
+    (case name, baseline p50, new p50, ratio)"""
+    regressions = []
+    for name, res in results['results'].items():
+        base = baseline['results'].get(name)
+        if not base:
+            continue
+        ratio = res['p50'] / base['p50']
+        if ratio > 1 + tolerance:
+            regressions.append((name, base['p50'], res['p50'], ratio))
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark suite of the factur-x lib.")
+    parser.add_argument(
+        '-q', '--quick', action='store_true',
+        help="Only use small documents, to check the suite quickly.")
+    parser.add_argument(
+        '-f', '--filter', dest='filters', action='append',
+        help="Only run the cases whose name contains this string. "
+        "Can be used several times.")
+    parser.add_argument(
+        '-r', '--runs', type=int, default=20,
+        help="Maximum number of runs per case. Default: 20.")
+    parser.add_argument(
+        '-s', '--max-seconds', type=float, default=5.0,
+        help="Stop measuring a case after this time (it is run at least "
+        "3 times). Default: 5.")
+    parser.add_argument(
+        '-n', '--no-memory', dest='memory', action='store_false',
+        help="Don't measure the peak memory.")
+    parser.add_argument(
+        '-j', '--json', dest='json_file',
+        help="Write the results to this JSON file.")
+    parser.add_argument(
+        '-b', '--baseline',
+        help="JSON file of a previous run to compare with.")
+    parser.add_argument(
+        '-t', '--tolerance', type=float, default=0.2,
+        help="Accepted slowdown of the median latency compared to the "
+        "baseline. Default: 0.2 (20%%).")
+    args = parser.parse_args(args)
+    results = run_suite(
+        quick=args.quick, filters=args.filters, runs=args.runs,
+        max_seconds=args.max_seconds, memory=args.memory)
+    if args.json_file:
+        with open(args.json_file, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, tolerance=args.tolerance)
+        for name, base_p50, new_p50, ratio in regressions:
+            print('REGRESSION %s: p50 %.2f ms -> %.2f ms (x%.2f)' % (
+                name, base_p50 * 1000, new_p50 * 1000, ratio))
+        if regressions:
+            sys.exit(1)
+        print('No regression compared to %s' % args.baseline)
+
+
+if __name__ == '__main__':
+    main()
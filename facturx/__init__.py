@@ -10,7 +10,12 @@ from .facturx import generate_from_file, \
     get_level, \
     check_facturx_xsd, \
     xml_check_xsd, \
+    preload_xsd_schemas, \
     get_facturx_xml_from_pdf, \
     get_orderx_xml_from_pdf, \
     get_xml_from_pdf, \
-    get_orderx_type
+    get_orderx_type, \
+    get_pdf_timestamp, \
+    prepare_pdf_metadata_txt, \
+    prepare_pdf_metadata_xml, \
+    base_info2pdf_metadata
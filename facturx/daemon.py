@@ -0,0 +1,339 @@
+"""Daemon of warm worker processes for the command line tools.
+
+Each run of facturx-pdfgen, facturx-pdfextractxml or facturx-xmlcheck
+starts Python, imports pypdf and lxml and compiles an XSD schema to
+process a single file. The daemon (facturx-daemon) does it once: it
+compiles the XSD schemas of all the flavors and levels, then forks worker
+processes that accept the jobs of the command line tools on a Unix domain
+socket. The command line tools use the daemon when its socket exists, or
+when they get the --daemon option; they only import the standard library
+modules needed to talk to it, not pypdf or lxml.
+
+A job is sent as a message: a 4-byte length, a JSON header with the name of
+the command, its options and the sizes of the binary parts (the input
+files), then the binary parts. The answer has the same format: the header
+tells if the job succeeded, with the error otherwise, and carries the log
+messages of the factur-x lib, which the client logs as if it had run the
+job itself. The files are sent over the socket rather than their paths,
+so the daemon doesn't need access to the directories of the client. The
+socket is only accessible to the user who started the daemon.
+
+    from facturx import daemon
+
+    connection = daemon.connect()
+    if connection:
+        header, parts = daemon.call(
+            connection, 'xml_check_xsd', {'flavor': 'autodetect'}, [xml_bytes])
+"""
+
+import json
+import logging
+import os
+import signal
+import socket
+import struct
+import threading
+
+from .facturx import logger
+
+SOCKET_ENV = 'FACTURX_DAEMON_SOCKET'
+_LENGTH = struct.Struct('!I')
+
+
+class DaemonError(Exception):
+    """Raised when the daemon can't be reached or answers with an error."""
+
+
+def default_socket_path():
+    """Path of the socket of the daemon: FACTURX_DAEMON_SOCKET, or
+    facturx.sock in XDG_RUNTIME_DIR, or facturx-<uid>.sock in /tmp."""
+    path = os.environ.get(SOCKET_ENV)
+    if path:
+        return path
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'facturx.sock')
+    return '/tmp/facturx-%d.sock' % os.getuid()
+
+
+def send_message(sock, header, parts=()):
+    """Send a JSON header and its binary parts."""
+    header = dict(header, parts=[len(part) for part in parts])
+    data = json.dumps(header).encode('utf-8')
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+    for part in parts:
+        sock.sendall(part)
+
+
+def _read(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise DaemonError('Connection closed in the middle of a message')
+    return data
+
+
+def read_message(stream):
+    """Read a message from a binary file object (socket.makefile('rb')).
+    Return (header, parts), or (None, []) if the connection was closed."""
+    length = stream.read(_LENGTH.size)
+    if not length:
+        return None, []
+    if len(length) != _LENGTH.size:
+        raise DaemonError('Connection closed in the middle of a message')
+    header = json.loads(_read(stream, _LENGTH.unpack(length)[0]))
+    parts = [_read(stream, size) for size in header.pop('parts', [])]
+    return header, parts
+
+
+def connect(socket_path=None, required=False):
+    """Return a socket connected to the daemon, or None if no daemon
+    listens. With ``required``, raise DaemonError instead of returning None."""
+    socket_path = socket_path or default_socket_path()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        # The invoices are only sent to a daemon of the same user: another
+        # user could create the socket first in a shared directory
+        if os.stat(socket_path).st_uid != os.getuid():
+            raise OSError('the socket belongs to another user')
+        sock.connect(socket_path)
+    except OSError as e:
+        sock.close()
+        if required:
+            raise DaemonError(
+                'Cannot connect to the factur-x daemon on %s: %s' % (socket_path, e))
+        return None
+    return sock
+
+
+def add_arguments(parser):
+    """Add the options of the daemon to the parser of a command line tool."""
+    parser.add_argument(
+        '--daemon', dest='daemon', action='store_true',
+        help="Send the job to the factur-x daemon (facturx-daemon) and fail "
+        "if it doesn't run. By default, the daemon is used if it runs.")
+    parser.add_argument(
+        '--no-daemon', dest='no_daemon', action='store_true',
+        help="Run the job in this process, even if the factur-x daemon runs.")
+    parser.add_argument(
+        '--daemon-socket', dest='daemon_socket',
+        help="Path of the socket of the factur-x daemon. Default: "
+        "$%s, $XDG_RUNTIME_DIR/facturx.sock or /tmp/facturx-<uid>.sock." % SOCKET_ENV)
+
+
+def connect_from_args(args):
+    """Return a connection to the daemon, as requested by the options
+    added by add_arguments(), or None to run the job in this process."""
+    if args.no_daemon:
+        return None
+    return connect(args.daemon_socket, required=args.daemon)
+
+
+def call(sock, command, options=None, parts=()):
+    """Run a command in the daemon and return (header, parts) of the answer.
+    The log messages of the job are logged by the factur-x logger of this
+    process; a failed job raises DaemonError with its error message."""
+    send_message(sock, {
+        'command': command,
+        'options': options or {},
+        'log_level': logger.getEffectiveLevel(),
+        }, parts)
+    with sock.makefile('rb') as stream:
+        header, parts = read_message(stream)
+    if header is None:
+        raise DaemonError('The factur-x daemon closed the connection')
+    for level, message in header.pop('logs', []):
+        logger.log(level, '%s', message)
+    if not header.pop('ok', False):
+        raise DaemonError(header.get('error') or 'Unknown error')
+    return header, parts
+
+
+# Commands of the daemon, which run in its worker processes
+
+def _generate_from_file(options, parts):
+    from datetime import datetime
+    from io import BytesIO
+    from .facturx import generate_from_file
+    pdf, xml = parts[:2]
+    attachments = {}
+    for attachment, filedata in zip(options.pop('attachments', []), parts[2:]):
+        attachments[attachment['filename']] = {
+            'filedata': filedata,
+            'modification_datetime': datetime.fromtimestamp(attachment['mtime']),
+            }
+    output = BytesIO()
+    generate_from_file(
+        BytesIO(pdf), xml, output_pdf_file=output, attachments=attachments,
+        **options)
+    return {}, [output.getvalue()]
+
+
+def _get_xml_from_pdf(options, parts):
+    from .facturx import get_xml_from_pdf
+    xml_filename, xml_bytes = get_xml_from_pdf(parts[0], **options)
+    return {'xml_filename': xml_filename}, [xml_bytes or b'']
+
+
+def _xml_check_xsd(options, parts):
+    from .facturx import xml_check_xsd
+    return {'valid': xml_check_xsd(parts[0], **options)}, []
+
+
+COMMANDS = {
+    'generate_from_file': _generate_from_file,
+    'get_xml_from_pdf': _get_xml_from_pdf,
+    'xml_check_xsd': _xml_check_xsd,
+}
+
+
+class _LogRecords(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append([record.levelno, record.getMessage()])
+
+
+def run_command(header, parts):
+    """Run the command of a message and return the answer (header, parts)."""
+    handler = _LogRecords()
+    level, propagate = logger.level, logger.propagate
+    # The log messages of the job are only logged by the client
+    logger.setLevel(header.get('log_level') or logging.INFO)
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        command = COMMANDS.get(header.get('command'))
+        if command is None:
+            raise ValueError('Unknown command %s' % header.get('command'))
+        answer, parts = command(dict(header.get('options') or {}), parts)
+        answer['ok'] = True
+    except Exception as e:
+        answer, parts = {'ok': False, 'error': str(e)}, []
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+        logger.propagate = propagate
+    answer['logs'] = handler.records
+    return answer, parts
+
+
+def warm_up():
+    """Compile the XSD schemas of all the flavors and levels, so that the
+    first jobs don't pay for it."""
+    import pypdf  # noqa: F401
+    from .facturx import preload_xsd_schemas
+    xsd_files = []
+    for flavor in ('factur-x', 'order-x', 'zugferd'):
+        xsd_files += preload_xsd_schemas(flavor)
+    return xsd_files
+
+
+def serve_prefork(server, workers, log=logger):
+    """Serve a socketserver in several worker processes, forked now and
+    which share its listening socket. A worker that dies is replaced. On
+    SIGTERM or SIGINT, the workers finish their current request and stop.
+    Return when all the workers have stopped."""
+    parent_pid = os.getpid()
+    children = set()
+    stopping = []
+
+    def stop_worker(signum, frame):
+        # shutdown() waits for serve_forever(): call it from another thread
+        threading.Thread(target=server.shutdown).start()
+
+    def check_parent():
+        # Called between two requests: the workers stop with the parent
+        if os.getppid() != parent_pid:
+            stop_worker(None, None)
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                signal.signal(signal.SIGTERM, stop_worker)
+                signal.signal(signal.SIGINT, stop_worker)
+                server.service_actions = check_parent
+                server.serve_forever()
+            except BaseException:
+                log.exception('Worker %d failed', os.getpid())
+                status = 1
+            finally:
+                os._exit(status)
+        children.add(pid)
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for i in range(workers):
+        spawn()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    log.info('%d workers started %s', workers, sorted(children))
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            log.warning(
+                'Worker %d exited with status %d: starting a new one',
+                pid, status)
+            spawn()
+
+
+def make_server(socket_path=None):
+    """Return the server of the daemon, listening on its Unix socket."""
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            # Several jobs may be sent on the same connection
+            while True:
+                header, parts = read_message(self.rfile)
+                if header is None:
+                    return
+                send_message(self.connection, *run_command(header, parts))
+
+    socket_path = socket_path or default_socket_path()
+    if os.path.exists(socket_path):
+        sock = connect(socket_path)
+        if sock is not None:
+            sock.close()
+            raise DaemonError(
+                'A factur-x daemon already listens on %s' % socket_path)
+        # Left by a daemon that was killed
+        os.unlink(socket_path)
+    # Only the user who runs the daemon may connect to it
+    umask = os.umask(0o077)
+    try:
+        return socketserver.UnixStreamServer(socket_path, Handler)
+    finally:
+        os.umask(umask)
+
+
+def serve(socket_path=None, workers=None):
+    """Warm up, then run the daemon in ``workers`` processes (default:
+    number of CPUs) until SIGTERM or SIGINT."""
+    xsd_files = warm_up()
+    logger.info('%d XSD schemas compiled', len(xsd_files))
+    server = make_server(socket_path)
+    try:
+        logger.info('factur-x daemon listening on %s', server.server_address)
+        serve_prefork(server, workers or os.cpu_count() or 1)
+    finally:
+        server.server_close()
+        try:
+            os.unlink(server.server_address)
+        except OSError:
+            pass
@@ -27,31 +27,21 @@
 # - add automated tests (currently, we only have tests at odoo module level)
 # - keep original metadata by copy of pdf_tailer[/Info] ?
 
+from contextlib import contextmanager
 from io import BytesIO, IOBase
-from lxml import etree
-from tempfile import NamedTemporaryFile
 from datetime import datetime
-from pypdf import PdfWriter, PdfReader
-from pypdf.generic import DictionaryObject, DecodedStreamObject, \
-    NameObject, NumberObject, ArrayObject, create_string_object
-import importlib.resources as importlib_resources
-try:
-    importlib_resources.files  # added in py3.9
-except AttributeError:
-    import importlib_resources  # py3.8 compat: pip install importlib-resources
-import importlib.metadata
 import os.path
-import mimetypes
-import hashlib
 import logging
+import threading
 
+from . import __version__ as VERSION
+from .profiling import annotate, record, span
+
+# lxml, pypdf and the other heavy modules are imported by the functions
+# that need them, so that "import facturx" stays fast and the command line
+# tools that don't read PDF files (facturx-xmlcheck) don't load pypdf.
 
-try:
-    VERSION = importlib.metadata.version("factur-x")
-except importlib.metadata.PackageNotFoundError:
-    VERSION = "0.0.dev0"
 FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
-logging.basicConfig(format=FORMAT)
 logger = logging.getLogger('factur-x')
 logger.setLevel(logging.INFO)
 
@@ -110,6 +100,76 @@ XML_NAMESPACES = {
 }
 
 
+def _open_package_file(path):
+    import importlib.resources as importlib_resources
+    try:
+        importlib_resources.files  # added in py3.9
+    except AttributeError:
+        import importlib_resources  # py3.8 compat: pip install importlib-resources
+    return importlib_resources.files(__package__).joinpath(path).open()
+
+
+# Compiling an XSD takes much longer than validating a usual XML file with it,
+# so the compiled schemas are kept: {xsd file: [idle XMLSchema objects]}.
+# A schema object is not used by 2 threads at the same time, because its
+# error log is not thread-safe.
+_xsd_schemas = {}
+_xsd_schemas_lock = threading.Lock()
+
+
+@contextmanager
+def _xsd_schema(xsd_file):
+    from lxml import etree
+    with _xsd_schemas_lock:
+        idle_schemas = _xsd_schemas.setdefault(xsd_file, [])
+        schema = idle_schemas and idle_schemas.pop() or None
+    annotate(xsd_cache=schema is None and 'miss' or 'hit')
+    if schema is None:
+        logger.debug('Compiling XSD file %s', xsd_file)
+        with _open_package_file(xsd_file) as xsd_file_obj:
+            schema = etree.XMLSchema(etree.parse(xsd_file_obj))
+    try:
+        yield schema
+    finally:
+        with _xsd_schemas_lock:
+            idle_schemas.append(schema)
+
+
+def preload_xsd_schemas(flavor='factur-x', levels=None):
+    """
+    Compile the XSD files of the given levels and keep them in the cache of
+    xml_check_xsd(), so that the first validation doesn't pay for it.
+    Useful when a long-running process starts.
+    :param flavor: possible values: 'factur-x', 'zugferd' or 'order-x'
+    :type flavor: string
+    :param levels: the levels to load, all the levels of the flavor if None
+    :type levels: list of strings
+    :return: the list of the XSD files that were loaded
+    """
+    if flavor in ('factur-x', 'facturx'):
+        level2xsd = FACTURX_LEVEL2xsd
+    elif flavor in ('order-x', 'orderx'):
+        level2xsd = ORDERX_LEVEL2xsd
+    elif flavor == 'zugferd':
+        level2xsd = {'zugferd': 'zugferd/ZUGFeRD1p0.xsd'}
+        levels = None
+    else:
+        raise ValueError("Wrong flavor '%s'" % flavor)
+    if levels is None:
+        levels = list(level2xsd)
+    xsd_files = []
+    for level in levels:
+        if level not in level2xsd:
+            raise ValueError(
+                "Wrong level '%s' for flavor '%s'" % (level, flavor))
+        xsd_file = 'xsd/%s' % level2xsd[level]
+        if xsd_file not in xsd_files:
+            with _xsd_schema(xsd_file):
+                pass
+            xsd_files.append(xsd_file)
+    return xsd_files
+
+
 def check_facturx_xsd(
         facturx_xml, flavor='autodetect', facturx_level='autodetect'):
     logger.warning(
@@ -133,6 +193,7 @@ def xml_check_xsd(xml, flavor='autodetect', level='autodetect'):
     :return: True if the XML is valid against the XSD
     raise an error if it is not valid against the XSD
     """
+    from lxml import etree
     logger.debug(
         'xml_check_xsd with factur-x lib %s', VERSION)
     if not isinstance(flavor, str):
@@ -144,7 +205,7 @@ def xml_check_xsd(xml, flavor='autodetect', level='autodetect'):
         xml_bytes = xml
     elif isinstance(xml, str):
         xml_bytes = xml.encode('utf8')
-    elif isinstance(xml, type(etree.Element('pouet'))):
+    elif isinstance(xml, etree._Element):
         xml_etree = xml
         xml_bytes = etree.tostring(
             xml, pretty_print=True, encoding='UTF-8',
@@ -198,12 +259,11 @@ def xml_check_xsd(xml, flavor='autodetect', level='autodetect'):
         xsd_file = 'xsd/%s' % ORDERX_LEVEL2xsd[level]
 
     logger.debug('Using XSD file %s', xsd_file)
-    xsd_etree_obj = etree.parse(
-        importlib_resources.files(__package__).joinpath(xsd_file).open())
-    official_schema = etree.XMLSchema(xsd_etree_obj)
     try:
-        t = etree.parse(BytesIO(xml_bytes))
-        official_schema.assertValid(t)
+        with _xsd_schema(xsd_file) as official_schema:
+            if xml_etree is None:
+                xml_etree = etree.parse(BytesIO(xml_bytes))
+            official_schema.assertValid(xml_etree)
         logger.info('%s XML file successfully validated against XSD', flavor)
     except Exception as e:
         # if the validation of the XSD fails, we arrive here
@@ -229,33 +289,55 @@ def get_orderx_xml_from_pdf(pdf_file, check_xsd=True):
 
 
 def get_xml_from_pdf(pdf_file, check_xsd=True, filenames=[]):
-    logger.debug(
-        'get_xml_from_pdf with factur-x lib %s', VERSION)
-    if not pdf_file:
-        raise ValueError('Missing pdf_invoice argument')
-    if not isinstance(check_xsd, bool):
-        raise ValueError('Bad type for check_xsd argument')
-    if not isinstance(filenames, list):
-        raise ValueError('Bad type for filenames argument')
-    if isinstance(pdf_file, (str, bytes)):
-        pdf_file_in = BytesIO(pdf_file)
-    elif isinstance(pdf_file, IOBase):
-        pdf_file_in = pdf_file
-    else:
-        raise TypeError(
-            "The first argument of the method get_xml_from_pdf must "
-            "be either a byte or a file (it is a %s)." % type(pdf_file))
-    if not filenames:
-        filenames = ALL_FILENAMES
-    logger.debug('Searching for filenames %s', filenames)
+    with record('get_xml_from_pdf'):
+        return _get_xml_from_pdf(pdf_file, check_xsd, filenames)
+
+
+def _get_xml_from_pdf(pdf_file, check_xsd, filenames):
+    from lxml import etree
+    from pypdf import PdfReader
+    with span('input'):
+        logger.debug(
+            'get_xml_from_pdf with factur-x lib %s', VERSION)
+        if not pdf_file:
+            raise ValueError('Missing pdf_invoice argument')
+        if not isinstance(check_xsd, bool):
+            raise ValueError('Bad type for check_xsd argument')
+        if not isinstance(filenames, list):
+            raise ValueError('Bad type for filenames argument')
+        if isinstance(pdf_file, (str, bytes)):
+            pdf_file_in = BytesIO(pdf_file)
+            annotate(pdf_size=len(pdf_file))
+        elif isinstance(pdf_file, IOBase) or (
+                hasattr(pdf_file, 'read') and hasattr(pdf_file, 'seek')):
+            # Other file-like objects, such as SpooledTemporaryFile before
+            # Python 3.11 (it doesn't inherit from IOBase)
+            pdf_file_in = pdf_file
+        else:
+            raise TypeError(
+                "The first argument of the method get_xml_from_pdf must "
+                "be either a byte or a file (it is a %s)." % type(pdf_file))
+        if not filenames:
+            filenames = ALL_FILENAMES
+        logger.debug('Searching for filenames %s', filenames)
     xml_bytes = xml_filename = False
-    pdf_reader = PdfReader(pdf_file_in)
-    for attach_obj in pdf_reader.attachment_list:
+    with span('pdf_read'):
+        pdf_reader = PdfReader(pdf_file_in)
+    with span('attachments'):
+        attach_objs = pdf_reader.attachment_list
+    for attach_obj in attach_objs:
         filename = attach_obj.name
         logger.debug('Found filename=%s', filename)
-        if filename in filenames and attach_obj.content:
+        if filename not in filenames:
+            continue
+        with span('attachments'):
+            # the content is decompressed each time it is read
+            content = attach_obj.content
+        if content:
+            annotate(xml_size=len(content))
             try:
-                xml_root = etree.fromstring(attach_obj.content)
+                with span('xml_parse'):
+                    xml_root = etree.fromstring(content)
                 logger.info(
                     'A valid XML file %s has been found in the PDF file',
                     filename)
@@ -272,8 +354,9 @@ def get_xml_from_pdf(pdf_file, check_xsd=True, filenames=[]):
                 # Don't set flavor when filename is zugferd-invoice.xml
                 # because it can be either zugferd (ie zugferd 1.0)
                 # or 'factur-x' i.e. zugferd 2.0, see bug #41
-                xml_check_xsd(xml_root, flavor=flavor)
-            xml_bytes = attach_obj.content
+                with span('xsd_check'):
+                    xml_check_xsd(xml_root, flavor=flavor)
+            xml_bytes = content
             xml_filename = filename
             break
     logger.info('Returning an XML file %s', xml_filename)
@@ -281,7 +364,13 @@ def get_xml_from_pdf(pdf_file, check_xsd=True, filenames=[]):
     return (xml_filename, xml_bytes)
 
 
-def _get_pdf_timestamp(date=None):
+def get_pdf_timestamp(date=None):
+    """
+    Format a date as a PDF date string, e.g. "D:20141006161354+00'00'".
+    :param date: the date, now if None
+    :type date: datetime
+    :return: the PDF date string
+    """
     if date is None:
         date = datetime.now()
     # example date format: "D:20141006161354+02'00'"
@@ -296,8 +385,14 @@ def _get_metadata_timestamp():
     return meta_date
 
 
-def _prepare_pdf_metadata_txt(pdf_metadata):
-    pdf_date = _get_pdf_timestamp()
+def prepare_pdf_metadata_txt(pdf_metadata):
+    """
+    Build the entries of the info dictionary of a Factur-X PDF file.
+    :param pdf_metadata: dict with the keys author, keywords, title, subject
+    :type pdf_metadata: dict
+    :return: dict of the entries, with their PDF names (/Title...)
+    """
+    pdf_date = get_pdf_timestamp()
     info_dict = {
         '/Author': pdf_metadata.get('author', ''),
         '/CreationDate': pdf_date,
@@ -311,7 +406,19 @@ def _prepare_pdf_metadata_txt(pdf_metadata):
     return info_dict
 
 
-def _prepare_pdf_metadata_xml(flavor, level, orderx_type, pdf_metadata):
+def prepare_pdf_metadata_xml(
+        flavor, level, orderx_type, pdf_metadata, producer='pypdf'):
+    """
+    Build the XMP metadata of a Factur-X or Order-X PDF file, with the
+    extension schema of the flavor.
+    :param flavor: possible values: 'factur-x' or 'order-x'
+    :param level: the level of the XML file
+    :param orderx_type: the type of the Order-X document, None for Factur-X
+    :param pdf_metadata: dict with the keys author, keywords, title, subject
+    :param producer: the PDF producer
+    :return: the XMP packet
+    :rtype: bytes
+    """
     xml_str = """
 <?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>
 <x:xmpmeta xmlns:x="adobe:ns:meta/">
@@ -408,7 +515,7 @@ def _prepare_pdf_metadata_xml(flavor, level, orderx_type, pdf_metadata):
         title=pdf_metadata.get('title', ''),
         author=pdf_metadata.get('author', ''),
         subject=pdf_metadata.get('subject', ''),
-        producer='pypdf',
+        producer=producer,
         creator_tool='factur-x python lib v%s by Alexis de Lattre' % VERSION,
         timestamp=_get_metadata_timestamp(),
         urn=urn,
@@ -430,6 +537,10 @@ def _prepare_pdf_metadata_xml(flavor, level, orderx_type, pdf_metadata):
 
 def _filespec_additional_attachments(
         pdf_writer, name_arrayobj_cdict, file_dict, filename):
+    from pypdf.generic import DictionaryObject, DecodedStreamObject, \
+        NameObject, NumberObject, create_string_object
+    import hashlib
+    import mimetypes
     logger.debug('_filespec_additional_attachments filename=%s', filename)
     md5sum = hashlib.md5(file_dict['filedata']).hexdigest()
     md5sum_obj = create_string_object(md5sum)
@@ -439,10 +550,10 @@ def _filespec_additional_attachments(
         })
     # creation date and modification date are optional
     if isinstance(file_dict.get('modification_datetime'), datetime):
-        mod_date_pdf = _get_pdf_timestamp(file_dict['modification_datetime'])
+        mod_date_pdf = get_pdf_timestamp(file_dict['modification_datetime'])
         params_dict[NameObject('/ModDate')] = create_string_object(mod_date_pdf)
     if isinstance(file_dict.get('creation_datetime'), datetime):
-        creation_date_pdf = _get_pdf_timestamp(file_dict['creation_datetime'])
+        creation_date_pdf = get_pdf_timestamp(file_dict['creation_datetime'])
         params_dict[NameObject('/CreationDate')] = create_string_object(
             creation_date_pdf)
     file_entry = DecodedStreamObject()
@@ -481,6 +592,9 @@ def _facturx_update_metadata_add_attachment(
         lang=None, additional_attachments={}, afrelationship='data'):
     '''This method is inspired from the code of the add_attachment()
     method of the pypdf lib'''
+    from pypdf.generic import DictionaryObject, DecodedStreamObject, \
+        NameObject, NumberObject, ArrayObject, create_string_object
+    import hashlib
     # The entry for the file
     # facturx_xml_str = facturx_xml_str.encode('utf-8')
     if flavor == 'order-x' and orderx_type not in ORDERX_TYPES:
@@ -491,99 +605,101 @@ def _facturx_update_metadata_add_attachment(
         raise ValueError(
             "Wrong value for afrelationship (%s). Possible values: %s."
             % (afrelationship, XML_AFRelationship))
-    md5sum = hashlib.md5(xml_bytes).hexdigest()
-    md5sum_obj = create_string_object(md5sum)
-    params_dict = DictionaryObject({
-        NameObject('/CheckSum'): md5sum_obj,
-        NameObject('/ModDate'): create_string_object(_get_pdf_timestamp()),
-        NameObject('/Size'): NumberObject(len(xml_bytes)),
-        })
-    file_entry = DecodedStreamObject()
-    file_entry.set_data(xml_bytes)  # here we integrate the file itself
-    file_entry = file_entry.flate_encode()
-    file_entry.update({
-        NameObject("/Type"): NameObject("/EmbeddedFile"),
-        NameObject("/Params"): params_dict,
-        NameObject("/Subtype"): NameObject("/text/xml"),
-        })
-    file_entry_obj = pdf_writer._add_object(file_entry)
-    # The Filespec entry
-    ef_dict = DictionaryObject({
-        NameObject("/F"): file_entry_obj,
-        NameObject('/UF'): file_entry_obj,
-        })
-
-    if flavor == 'order-x':
-        xml_filename = ORDERX_FILENAME
-        desc = 'Order-X XML file'
-    else:
-        xml_filename = FACTURX_FILENAME
-        desc = 'Factur-X XML file'
-
-    fname_obj = create_string_object(xml_filename)
-    filespec_dict = DictionaryObject({
-        NameObject("/AFRelationship"): NameObject("/%s" % afrelationship.capitalize()),
-        NameObject("/Desc"): create_string_object(desc),
-        NameObject("/Type"): NameObject("/Filespec"),
-        NameObject("/F"): fname_obj,
-        NameObject("/EF"): ef_dict,
-        NameObject("/UF"): fname_obj,
-        })
-    filespec_obj = pdf_writer._add_object(filespec_dict)
-    name_arrayobj_cdict = {fname_obj: filespec_obj}
-    for attach_filename, attach_dict in additional_attachments.items():
-        _filespec_additional_attachments(
-            pdf_writer, name_arrayobj_cdict, attach_dict, attach_filename)
-    logger.debug('name_arrayobj_cdict=%s', name_arrayobj_cdict)
-    name_arrayobj_content_sort = list(
-        sorted(name_arrayobj_cdict.items(), key=lambda x: x[0]))
-    logger.debug('name_arrayobj_content_sort=%s', name_arrayobj_content_sort)
-    name_arrayobj_content_final = []
-    af_list = []
-    for (fname_obj, filespec_obj) in name_arrayobj_content_sort:
-        name_arrayobj_content_final += [fname_obj, filespec_obj]
-        af_list.append(filespec_obj)
-    embedded_files_names_dict = DictionaryObject({
-        NameObject("/Names"): ArrayObject(name_arrayobj_content_final),
-        })
-    # Then create the entry for the root, as it needs a
-    # reference to the Filespec
-    embedded_files_dict = DictionaryObject({
-        NameObject("/EmbeddedFiles"): embedded_files_names_dict,
-        })
-    # Update the root
-    af_value_obj = pdf_writer._add_object(ArrayObject(af_list))
-    update_root_dict = {
-        NameObject("/AF"): af_value_obj,
-        NameObject("/Names"): embedded_files_dict,
-        # show attachments when opening PDF
-        NameObject("/PageMode"): NameObject("/UseAttachments"),
-        }
-    metadata_xml_bytes = _prepare_pdf_metadata_xml(
-        flavor, level, orderx_type, pdf_metadata)
-    metadata_file_entry = DecodedStreamObject()
-    metadata_file_entry.update({
-        NameObject('/Subtype'): NameObject('/XML'),
-        NameObject('/Type'): NameObject('/Metadata'),
-        })
-    metadata_file_entry.set_data(metadata_xml_bytes)
-    metadata_file_entry = metadata_file_entry.flate_encode()
+    with span('attachments'):
+        md5sum = hashlib.md5(xml_bytes).hexdigest()
+        md5sum_obj = create_string_object(md5sum)
+        params_dict = DictionaryObject({
+            NameObject('/CheckSum'): md5sum_obj,
+            NameObject('/ModDate'): create_string_object(get_pdf_timestamp()),
+            NameObject('/Size'): NumberObject(len(xml_bytes)),
+            })
+        file_entry = DecodedStreamObject()
+        file_entry.set_data(xml_bytes)  # here we integrate the file itself
+        file_entry = file_entry.flate_encode()
+        file_entry.update({
+            NameObject("/Type"): NameObject("/EmbeddedFile"),
+            NameObject("/Params"): params_dict,
+            NameObject("/Subtype"): NameObject("/text/xml"),
+            })
+        file_entry_obj = pdf_writer._add_object(file_entry)
+        # The Filespec entry
+        ef_dict = DictionaryObject({
+            NameObject("/F"): file_entry_obj,
+            NameObject('/UF'): file_entry_obj,
+            })
 
-    existing_metadata_obj = pdf_writer._root_object.get('/Metadata')
-    if existing_metadata_obj:
-        logger.debug('Found existing /Metadata entry in catalog: replacing it.')
-        pdf_writer._replace_object(existing_metadata_obj, metadata_file_entry)
-    else:
-        logger.debug('No existing /Metadata entry in catalog: creating one.')
-        metadata_obj = pdf_writer._add_object(metadata_file_entry)
-        update_root_dict[NameObject("/Metadata")] = metadata_obj
-    pdf_writer._root_object.update(update_root_dict)
-    if lang:
-        pdf_writer._root_object.update({
-            NameObject("/Lang"): create_string_object(lang.replace('_', '-')),
+        if flavor == 'order-x':
+            xml_filename = ORDERX_FILENAME
+            desc = 'Order-X XML file'
+        else:
+            xml_filename = FACTURX_FILENAME
+            desc = 'Factur-X XML file'
+
+        fname_obj = create_string_object(xml_filename)
+        filespec_dict = DictionaryObject({
+            NameObject("/AFRelationship"): NameObject("/%s" % afrelationship.capitalize()),
+            NameObject("/Desc"): create_string_object(desc),
+            NameObject("/Type"): NameObject("/Filespec"),
+            NameObject("/F"): fname_obj,
+            NameObject("/EF"): ef_dict,
+            NameObject("/UF"): fname_obj,
+            })
+        filespec_obj = pdf_writer._add_object(filespec_dict)
+        name_arrayobj_cdict = {fname_obj: filespec_obj}
+        for attach_filename, attach_dict in additional_attachments.items():
+            _filespec_additional_attachments(
+                pdf_writer, name_arrayobj_cdict, attach_dict, attach_filename)
+        logger.debug('name_arrayobj_cdict=%s', name_arrayobj_cdict)
+        name_arrayobj_content_sort = list(
+            sorted(name_arrayobj_cdict.items(), key=lambda x: x[0]))
+        logger.debug('name_arrayobj_content_sort=%s', name_arrayobj_content_sort)
+        name_arrayobj_content_final = []
+        af_list = []
+        for (fname_obj, filespec_obj) in name_arrayobj_content_sort:
+            name_arrayobj_content_final += [fname_obj, filespec_obj]
+            af_list.append(filespec_obj)
+        embedded_files_names_dict = DictionaryObject({
+            NameObject("/Names"): ArrayObject(name_arrayobj_content_final),
             })
-    metadata_txt_dict = _prepare_pdf_metadata_txt(pdf_metadata)
-    pdf_writer.add_metadata(metadata_txt_dict)
+        # Then create the entry for the root, as it needs a
+        # reference to the Filespec
+        embedded_files_dict = DictionaryObject({
+            NameObject("/EmbeddedFiles"): embedded_files_names_dict,
+            })
+        # Update the root
+        af_value_obj = pdf_writer._add_object(ArrayObject(af_list))
+        update_root_dict = {
+            NameObject("/AF"): af_value_obj,
+            NameObject("/Names"): embedded_files_dict,
+            # show attachments when opening PDF
+            NameObject("/PageMode"): NameObject("/UseAttachments"),
+            }
+    with span('xmp'):
+        metadata_xml_bytes = prepare_pdf_metadata_xml(
+            flavor, level, orderx_type, pdf_metadata)
+        metadata_file_entry = DecodedStreamObject()
+        metadata_file_entry.update({
+            NameObject('/Subtype'): NameObject('/XML'),
+            NameObject('/Type'): NameObject('/Metadata'),
+            })
+        metadata_file_entry.set_data(metadata_xml_bytes)
+        metadata_file_entry = metadata_file_entry.flate_encode()
+
+        existing_metadata_obj = pdf_writer._root_object.get('/Metadata')
+        if existing_metadata_obj:
+            logger.debug('Found existing /Metadata entry in catalog: replacing it.')
+            pdf_writer._replace_object(existing_metadata_obj, metadata_file_entry)
+        else:
+            logger.debug('No existing /Metadata entry in catalog: creating one.')
+            metadata_obj = pdf_writer._add_object(metadata_file_entry)
+            update_root_dict[NameObject("/Metadata")] = metadata_obj
+        pdf_writer._root_object.update(update_root_dict)
+        if lang:
+            pdf_writer._root_object.update({
+                NameObject("/Lang"): create_string_object(lang.replace('_', '-')),
+                })
+        metadata_txt_dict = prepare_pdf_metadata_txt(pdf_metadata)
+        pdf_writer.add_metadata(metadata_txt_dict)
     logger.info('%s file added to PDF document', xml_filename)
 
 
@@ -627,7 +743,15 @@ def _extract_base_info(facturx_xml_etree, flavor):
     return base_info
 
 
-def _base_info2pdf_metadata(base_info):
+def base_info2pdf_metadata(base_info):
+    """
+    Build the pdf_metadata (author, keywords, title, subject) of a document
+    from its base info.
+    :param base_info: dict with the keys seller, buyer, number, date
+    (datetime) and doc_type (e.g. '380')
+    :type base_info: dict
+    :return: the pdf_metadata dict
+    """
     doc_type_map = {
         '220': 'Order',
         '230': 'Order Change',
@@ -683,7 +807,8 @@ def get_facturx_level(facturx_xml_etree):
 
 
 def get_level(xml_etree, flavor='autodetect'):
-    if not isinstance(xml_etree, type(etree.Element('pouet'))):
+    from lxml import etree
+    if not isinstance(xml_etree, etree._Element):
         raise ValueError('xml_etree must be an etree.Element() object')
     if flavor not in ('autodetect', 'factur-x', 'facturx', 'order-x', 'orderx', 'zugferd'):
         raise ValueError('Wrong value for flavor argument.')
@@ -730,7 +855,8 @@ def get_facturx_flavor(facturx_xml_etree):
 
 
 def get_flavor(xml_etree):
-    if not isinstance(xml_etree, type(etree.Element('pouet'))):
+    from lxml import etree
+    if not isinstance(xml_etree, etree._Element):
         raise ValueError('xml_etree must be an etree.Element() object')
     logger.debug('First XML tag: %s', xml_etree.tag)
     if xml_etree.tag.endswith('CrossIndustryInvoice'):
@@ -748,7 +874,8 @@ def get_flavor(xml_etree):
 
 
 def get_orderx_type(xml_etree):
-    if not isinstance(xml_etree, type(etree.Element('pouet'))):
+    from lxml import etree
+    if not isinstance(xml_etree, etree._Element):
         raise ValueError('xml_etree must be an etree.Element() object')
     type_code_xpath = \
         "/rsm:SCRDMCCBDACIOMessageStructure/rsm:ExchangedDocument/ram:TypeCode"
@@ -843,20 +970,16 @@ def generate_from_binary(
     :return: The Factur-X or Order-X PDF file as bytes
     :rtype: bytes
     """
-
     if not isinstance(pdf_file, bytes):
         raise ValueError('pdf_invoice argument must be a string')
-    result_pdf = False
-    with NamedTemporaryFile(prefix='facturx-', suffix='.pdf') as f:
-        f.write(pdf_file)
-        generate_from_file(
-            f, xml, flavor=flavor, level=level, orderx_type=orderx_type,
-            check_xsd=check_xsd, pdf_metadata=pdf_metadata, lang=lang,
-            attachments=attachments, afrelationship=afrelationship)
-        f.seek(0)
-        result_pdf = f.read()
-        f.close()
-    return result_pdf
+    # The input and output PDF files stay in memory
+    output_pdf_file = BytesIO()
+    generate_from_file(
+        BytesIO(pdf_file), xml, flavor=flavor, level=level,
+        orderx_type=orderx_type, check_xsd=check_xsd,
+        pdf_metadata=pdf_metadata, lang=lang, output_pdf_file=output_pdf_file,
+        attachments=attachments, afrelationship=afrelationship)
+    return output_pdf_file.getvalue()
 
 
 def generate_facturx_from_file(
@@ -927,8 +1050,9 @@ def generate_from_file(
     natural language of the PDF document. Used by PDF readers for blind people.
     Example: en-US or fr-FR
     :type lang: string
-    :param output_pdf_file: File Path to the output Factur-X/Order-X PDF file
-    :type output_pdf_file: string
+    :param output_pdf_file: File Path to the output Factur-X/Order-X PDF file,
+    or file object (such as io.BytesIO) in which it is written
+    :type output_pdf_file: string or file
     :param attachments: Specify the other files that you want to
     embed in the PDF file. It is a dict where key is the filename and value
     is a dict. In this dict, keys are 'filepath' (value is the full file path)
@@ -947,135 +1071,160 @@ def generate_from_file(
     :return: Returns True. This method re-writes the input PDF file,
     unless if the argument output_pdf_file is set.
     :rtype: bool
+    The duration of each stage of the generation can be collected with
+    the hooks of the facturx.profiling module.
     """
-    start_chrono = datetime.now()
-    logger.debug(
-        'generate_from_file with factur-x lib %s', VERSION)
-    logger.debug('1st arg pdf_file type=%s', type(pdf_file))
-    logger.debug('2nd arg xml type=%s', type(xml))
-    logger.debug('optional arg flavor=%s', flavor)
-    logger.debug('optional arg level=%s', level)
-    logger.debug('optional arg orderx_type=%s', orderx_type)
-    logger.debug('optional arg check_xsd=%s', check_xsd)
-    logger.debug('optional arg pdf_metadata=%s', pdf_metadata)
-    logger.debug('optional arg lang=%s', lang)
-    logger.debug('optional arg output_pdf_file=%s', output_pdf_file)
-    logger.debug('optional arg attachments=%s', attachments)
-    logger.debug('optional arg afrelationship=%s', afrelationship)
-    if not pdf_file:
-        raise ValueError('Missing pdf_file argument')
-    if not xml:
-        raise ValueError('Missing xml argument')
-    if not isinstance(flavor, str):
-        raise ValueError('flavor argument is a %s, must be a string' % type(flavor))
-    if not isinstance(level, str):
-        raise ValueError('level argument is a %s, must be a string' % type(level))
-    if not isinstance(orderx_type, (str, type(None))):
-        raise ValueError(
-            'orderx_type argument is a %s, must be a string or None'
-            % type(orderx_type))
-    if not isinstance(check_xsd, bool):
-        raise ValueError(
-            'check_xsd argument is a %s, must be a boolean' % type(check_xsd))
-    if not isinstance(pdf_metadata, (dict, type(None))):
-        raise ValueError(
-            'pdf_metadata argument is a %s, must be a dict or None'
-            % type(pdf_metadata))
-    if not isinstance(lang, (type(None), str)):
-        raise ValueError(
-            'lang argument is a %s, must be a string or None' % type(lang))
-    if not isinstance(output_pdf_file, (type(None), str)):
-        raise ValueError(
-            'output_pdf_file argument is a %s, must be a string or None'
-            % type(output_pdf_file))
-    if not isinstance(attachments, (dict, type(None))):
-        raise ValueError(
-            'attachments argument is a %s, must be a dict or None' % type(attachments))
-    if not isinstance(afrelationship, (str, type(None))):
-        raise ValueError(
-            'afrelationship argument is a %s, must be a string or None'
-            % type(afrelationship))
-    # Tolerance on arguments - reformatting
-    flavor = flavor.lower()
-    flavor_fix_mapping = {
-        'orderx': 'order-x',
-        'facturx': 'factur-x',
-        }
-    flavor = flavor_fix_mapping.get(flavor, flavor)
-    level = level.lower().replace(' ', '')
-    if orderx_type:
-        orderx_type = orderx_type.lower().replace('-', '_').replace(' ', '_')
-    if afrelationship:
-        afrelationship = afrelationship.lower()
-    else:
-        afrelationship = 'data'
-    if afrelationship not in XML_AFRelationship:
-        logger.warning(
-            "Wrong value for afrelationship (%s). Forcing it to 'data'.",
-            afrelationship)
-        afrelationship = 'data'
+    with record('generate_from_file'):
+        return _generate_from_file(
+            pdf_file, xml, flavor=flavor, level=level, orderx_type=orderx_type,
+            check_xsd=check_xsd, pdf_metadata=pdf_metadata, lang=lang,
+            output_pdf_file=output_pdf_file, attachments=attachments,
+            afrelationship=afrelationship)
 
-    if isinstance(pdf_file, str):
-        file_type = 'path'
-    else:
-        file_type = 'file'
-    xml_root = None
-    if isinstance(xml, bytes):
-        xml_bytes = xml
-    elif isinstance(xml, str):
-        xml_bytes = xml.encode('utf8')
-    elif isinstance(xml, type(etree.Element('pouet'))):
-        xml_root = xml
-        xml_bytes = etree.tostring(
-            xml_root, pretty_print=True, encoding='UTF-8',
-            xml_declaration=True)
-    elif isinstance(xml, IOBase):
-        xml.seek(0)
-        xml_bytes = xml.read()
-        # xml.close()
-        # If xml is passed as file descriptor
-        # I don't think we expect the lib to close it
-    else:
-        raise TypeError(
-            "The second argument of the method generate_from_file must be "
-            "either a string, an etree.Element() object or a file "
-            "(it is a %s)." % type(xml))
-    if attachments is None:
-        attachments = {}
-    if attachments:
-        # I used list() to avoid the following error in Python3:
-        # Error: dictionary changed size during iteration
-        for filename in list(attachments.keys()):
-            if filename in ALL_FILENAMES:
-                logger.warning(
-                    'You cannot provide as attachment a file named %s. '
-                    'This file will NOT be attached.', filename)
-                attachments.pop(filename)
-        for fadict in attachments.values():
-            if fadict.get('filepath') and not fadict.get('filedata'):
-                with open(fadict['filepath'], 'rb') as fa:
-                    fa.seek(0)
-                    fadict['filedata'] = fa.read()
-                    fa.close()
-
-                # As explained here
-                # https://stackoverflow.com/questions/237079/how-to-get-file-creation-modification-date-times-in-python
-                # creation date is not easy to get.
-                # So we only implement getting the modification date
-                if not fadict.get('modification_datetime'):
-                    mod_timestamp = os.path.getmtime(fadict['filepath'])
-                    fadict['modification_datetime'] = datetime.fromtimestamp(
-                        mod_timestamp)
-                if fadict.get('afrelationship'):
-                    fadict['afrelationship'] = fadict['afrelationship'].lower()
-                if fadict.get('afrelationship') not in ATTACHMENTS_AFRelationship:
-                    # set default value
-                    fadict['afrelationship'] = 'unspecified'
+
+def _generate_from_file(
+        pdf_file, xml, flavor, level, orderx_type, check_xsd, pdf_metadata,
+        lang, output_pdf_file, attachments, afrelationship):
+    from lxml import etree
+    from pypdf import PdfReader, PdfWriter
+
+    start_chrono = datetime.now()
+    with span('input'):
+        logger.debug(
+            'generate_from_file with factur-x lib %s', VERSION)
+        logger.debug('1st arg pdf_file type=%s', type(pdf_file))
+        logger.debug('2nd arg xml type=%s', type(xml))
+        logger.debug('optional arg flavor=%s', flavor)
+        logger.debug('optional arg level=%s', level)
+        logger.debug('optional arg orderx_type=%s', orderx_type)
+        logger.debug('optional arg check_xsd=%s', check_xsd)
+        logger.debug('optional arg pdf_metadata=%s', pdf_metadata)
+        logger.debug('optional arg lang=%s', lang)
+        logger.debug('optional arg output_pdf_file=%s', output_pdf_file)
+        logger.debug('optional arg attachments=%s', attachments)
+        logger.debug('optional arg afrelationship=%s', afrelationship)
+        if not pdf_file:
+            raise ValueError('Missing pdf_file argument')
+        if not xml:
+            raise ValueError('Missing xml argument')
+        if not isinstance(flavor, str):
+            raise ValueError('flavor argument is a %s, must be a string' % type(flavor))
+        if not isinstance(level, str):
+            raise ValueError('level argument is a %s, must be a string' % type(level))
+        if not isinstance(orderx_type, (str, type(None))):
+            raise ValueError(
+                'orderx_type argument is a %s, must be a string or None'
+                % type(orderx_type))
+        if not isinstance(check_xsd, bool):
+            raise ValueError(
+                'check_xsd argument is a %s, must be a boolean' % type(check_xsd))
+        if not isinstance(pdf_metadata, (dict, type(None))):
+            raise ValueError(
+                'pdf_metadata argument is a %s, must be a dict or None'
+                % type(pdf_metadata))
+        if not isinstance(lang, (type(None), str)):
+            raise ValueError(
+                'lang argument is a %s, must be a string or None' % type(lang))
+        if not isinstance(output_pdf_file, (type(None), str, IOBase)):
+            raise ValueError(
+                'output_pdf_file argument is a %s, must be a string, a file '
+                'or None' % type(output_pdf_file))
+        if not isinstance(attachments, (dict, type(None))):
+            raise ValueError(
+                'attachments argument is a %s, must be a dict or None' % type(attachments))
+        if not isinstance(afrelationship, (str, type(None))):
+            raise ValueError(
+                'afrelationship argument is a %s, must be a string or None'
+                % type(afrelationship))
+        # Tolerance on arguments - reformatting
+        flavor = flavor.lower()
+        flavor_fix_mapping = {
+            'orderx': 'order-x',
+            'facturx': 'factur-x',
+            }
+        flavor = flavor_fix_mapping.get(flavor, flavor)
+        level = level.lower().replace(' ', '')
+        if orderx_type:
+            orderx_type = orderx_type.lower().replace('-', '_').replace(' ', '_')
+        if afrelationship:
+            afrelationship = afrelationship.lower()
+        else:
+            afrelationship = 'data'
+        if afrelationship not in XML_AFRelationship:
+            logger.warning(
+                "Wrong value for afrelationship (%s). Forcing it to 'data'.",
+                afrelationship)
+            afrelationship = 'data'
+
+        if isinstance(pdf_file, str):
+            file_type = 'path'
+        else:
+            file_type = 'file'
+        xml_root = None
+        if isinstance(xml, bytes):
+            xml_bytes = xml
+        elif isinstance(xml, str):
+            xml_bytes = xml.encode('utf8')
+        elif isinstance(xml, etree._Element):
+            xml_root = xml
+            xml_bytes = etree.tostring(
+                xml_root, pretty_print=True, encoding='UTF-8',
+                xml_declaration=True)
+        elif isinstance(xml, IOBase):
+            xml.seek(0)
+            xml_bytes = xml.read()
+            # xml.close()
+            # If xml is passed as file descriptor
+            # I don't think we expect the lib to close it
+        else:
+            raise TypeError(
+                "The second argument of the method generate_from_file must be "
+                "either a string, an etree.Element() object or a file "
+                "(it is a %s)." % type(xml))
+        annotate(xml_size=len(xml_bytes))
+        if attachments is None:
+            attachments = {}
+        if attachments:
+            # I used list() to avoid the following error in Python3:
+            # Error: dictionary changed size during iteration
+            for filename in list(attachments.keys()):
+                if filename in ALL_FILENAMES:
+                    logger.warning(
+                        'You cannot provide as attachment a file named %s. '
+                        'This file will NOT be attached.', filename)
+                    attachments.pop(filename)
+            for fadict in attachments.values():
+                if fadict.get('filepath') and not fadict.get('filedata'):
+                    with open(fadict['filepath'], 'rb') as fa:
+                        fa.seek(0)
+                        fadict['filedata'] = fa.read()
+                        fa.close()
+
+                    # As explained here
+                    # https://stackoverflow.com/questions/237079/how-to-get-file-creation-modification-date-times-in-python
+                    # creation date is not easy to get.
+                    # So we only implement getting the modification date
+                    if not fadict.get('modification_datetime'):
+                        mod_timestamp = os.path.getmtime(fadict['filepath'])
+                        fadict['modification_datetime'] = datetime.fromtimestamp(
+                            mod_timestamp)
+                    if fadict.get('afrelationship'):
+                        fadict['afrelationship'] = fadict['afrelationship'].lower()
+                    if fadict.get('afrelationship') not in ATTACHMENTS_AFRelationship:
+                        # set default value
+                        fadict['afrelationship'] = 'unspecified'
+            annotate(
+                attachments_count=len(attachments),
+                attachments_size=sum(
+                    len(fadict.get('filedata') or b'')
+                    for fadict in attachments.values()))
     if flavor not in ('factur-x', 'order-x'):
         if xml_root is None:
-            xml_root = etree.fromstring(xml_bytes)
+            with span('xml_parse'):
+                xml_root = etree.fromstring(xml_bytes)
         logger.debug('Flavor will be autodetected')
-        flavor = get_flavor(xml_root)
+        with span('detection'):
+            flavor = get_flavor(xml_root)
         if flavor == 'zugferd':
             raise ValueError(
                 "XML is ZUGFeRD 1.x. Generating ZUGFeRD 1.x PDF is not supported. "
@@ -1084,9 +1233,11 @@ def generate_from_file(
             (flavor == 'factur-x' and level not in FACTURX_LEVEL2xsd) or
             (flavor == 'order-x' and level not in ORDERX_LEVEL2xsd)):
         if xml_root is None:
-            xml_root = etree.fromstring(xml_bytes)
+            with span('xml_parse'):
+                xml_root = etree.fromstring(xml_bytes)
         logger.debug('level will be autodetected')
-        level = get_level(xml_root, flavor)
+        with span('detection'):
+            level = get_level(xml_root, flavor)
     if (
             flavor == 'factur-x' and
             level in ('minimum', 'basicwl') and
@@ -1097,42 +1248,53 @@ def generate_from_file(
         afrelationship = 'data'
     if flavor == 'order-x' and orderx_type not in ORDERX_TYPES:
         if xml_root is None:
-            xml_root = etree.fromstring(xml_bytes)
-        orderx_type = get_orderx_type(xml_root)
+            with span('xml_parse'):
+                xml_root = etree.fromstring(xml_bytes)
+        with span('detection'):
+            orderx_type = get_orderx_type(xml_root)
     if check_xsd:
-        xml_check_xsd(
-            xml_bytes, flavor=flavor, level=level)
+        with span('xsd_check'):
+            xml_check_xsd(
+                xml_bytes, flavor=flavor, level=level)
     if pdf_metadata is None:
         if xml_root is None:
-            xml_root = etree.fromstring(xml_bytes)
-        base_info = _extract_base_info(xml_root, flavor)
-        pdf_metadata = _base_info2pdf_metadata(base_info)
+            with span('xml_parse'):
+                xml_root = etree.fromstring(xml_bytes)
+        with span('metadata'):
+            base_info = _extract_base_info(xml_root, flavor)
+            pdf_metadata = base_info2pdf_metadata(base_info)
     else:
         # clean-up pdf_metadata dict
         for key, value in pdf_metadata.items():
             if not isinstance(value, str):
                 pdf_metadata[key] = ''
-    pdf_reader = PdfReader(pdf_file)
-    pdf_writer = PdfWriter()
-    pdf_writer._header = b"%PDF-1.6"
-    pdf_writer.clone_document_from_reader(pdf_reader)
+    with span('pdf_read'):
+        pdf_reader = PdfReader(pdf_file)
+        annotate(pdf_pages=len(pdf_reader.pages))
+    with span('clone'):
+        pdf_writer = PdfWriter()
+        pdf_writer._header = b"%PDF-1.6"
+        pdf_writer.clone_document_from_reader(pdf_reader)
 
     _facturx_update_metadata_add_attachment(
         pdf_writer, xml_bytes, pdf_metadata, flavor, level,
         orderx_type=orderx_type, lang=lang,
         additional_attachments=attachments,
         afrelationship=afrelationship)
-    if output_pdf_file:
-        with open(output_pdf_file, 'wb') as output_f:
-            pdf_writer.write(output_f)
-            output_f.close()
-    else:
-        if file_type == 'path':
-            with open(pdf_file, 'wb') as f:
-                pdf_writer.write(f)
-                f.close()
-        elif file_type == 'file':
-            pdf_writer.write(pdf_file)
+    with span('write'):
+        if isinstance(output_pdf_file, IOBase):
+            pdf_writer.write(output_pdf_file)
+        elif output_pdf_file:
+            with open(output_pdf_file, 'wb') as output_f:
+                pdf_writer.write(output_f)
+                output_f.close()
+        else:
+            if file_type == 'path':
+                with open(pdf_file, 'wb') as f:
+                    pdf_writer.write(f)
+                    f.close()
+            elif file_type == 'file':
+                pdf_writer.write(pdf_file)
     end_chrono = datetime.now()
     logger.info(
         '%s PDF generated in %s seconds',
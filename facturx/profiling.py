@@ -0,0 +1,349 @@
+"""Per-stage instrumentation of the Factur-X/Order-X pipeline.
+
+Instrumentation is disabled by default: as long as no hook is registered,
+each stage only costs a context variable lookup. To get the breakdown of
+the calls made in a block of code:
+
+    from facturx import generate_from_file
+    from facturx.profiling import collect_profiles
+
+    with collect_profiles() as profiles:
+        generate_from_file(pdf_file, xml_file)
+    profiles[0].stages
+    # {'input': 0.0001, 'xml_parse': 0.0003, 'detection': 0.0001, ...}
+
+To aggregate the profiles of a batch of calls (or of a whole process),
+register a ProfileAggregator with hook() or add_hook() and read its
+summary() at the end.
+
+The memory accounting mode, based on tracemalloc, also gives the peak and
+net allocation of each stage and flags the calls that cross a budget:
+
+    from facturx.profiling import memory_accounting
+
+    with memory_accounting(budget=200 * 1024 * 1024) as profiles:
+        get_xml_from_pdf(pdf_file)
+    profiles[0].memory
+    # {'input': {'peak': 0, 'net': 0}, 'pdf_read': {'peak': 52311, ...}, ...}
+    profiles[0].over_budget
+    # False
+
+tracemalloc traces all the threads of the process, so the memory figures
+are only meaningful when a single call runs at a time. It also slows down
+the code a lot: never enable it in production for all requests.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+import logging
+
+logger = logging.getLogger('factur-x')
+
+GENERATION_STAGES = (
+    'input',  # check and normalisation of the arguments
+    'xml_parse',
+    'detection',  # flavor, level and Order-X type autodetection
+    'xsd_check',
+    'metadata',  # extraction of the PDF metadata from the XML
+    'pdf_read',
+    'clone',
+    'attachments',  # embedding of the XML file and of the attachments
+    'xmp',
+    'write',
+    )
+EXTRACTION_STAGES = (
+    'input',
+    'pdf_read',
+    'attachments',  # listing and decompression of the embedded files
+    'xml_parse',
+    'xsd_check',
+    )
+
+_global_hooks = []
+_context_hooks = ContextVar('facturx_profiling_hooks', default=())
+_current_recorder = ContextVar('facturx_profiling_recorder', default=None)
+# None or the memory budget in bytes (0 for no budget) when memory
+# accounting is enabled
+_memory_budget = ContextVar('facturx_profiling_memory_budget', default=None)
+
+
+class _NullContext(object):
+    """Shared do-nothing context manager returned when profiling is off"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_CONTEXT = _NullContext()
+
+
+class Profile(object):
+    """Breakdown of one call of an instrumented function.
+    stages is a dict {stage name: duration in seconds}, ordered by first
+    execution of the stage. total is the duration of the whole call.
+    error is the name of the exception class if the call failed, else None.
+    info is a dict with the size of the inputs (xml_size, pdf_size, ...).
+    In memory accounting mode, memory is a dict {stage name: {'peak': bytes,
+    'net': bytes}} where peak is the maximum allocation during the stage
+    and net the memory still allocated at the end of the stage;
+    peak_memory is the peak allocation of the whole call and over_budget
+    tells if it crossed the budget. Otherwise, memory is an empty dict.
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.stages = {}
+        self.total = 0.0
+        self.error = None
+        self.info = {}
+        self.memory = {}
+        self.peak_memory = None
+        self.over_budget = False
+
+    def __repr__(self):
+        return '<Profile %s total=%.6fs stages=%s>' % (
+            self.operation, self.total, self.stages)
+
+    def as_dict(self):
+        """Return the profile as a JSON-serializable dict"""
+        return {
+            'operation': self.operation,
+            'total': self.total,
+            'stages': dict(self.stages),
+            'error': self.error,
+            'info': dict(self.info),
+            'memory': {
+                stage: dict(values) for (stage, values) in self.memory.items()},
+            'peak_memory': self.peak_memory,
+            'over_budget': self.over_budget,
+            }
+
+
+class _Span(object):
+    __slots__ = ('stages', 'name', 'start')
+
+    def __init__(self, stages, name):
+        self.stages = stages
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = perf_counter() - self.start
+        self.stages[self.name] = self.stages.get(self.name, 0.0) + duration
+        return False
+
+
+class _MemorySpan(_Span):
+    __slots__ = ('recorder', 'memory_start')
+
+    def __init__(self, recorder, name):
+        super().__init__(recorder.profile.stages, name)
+        self.recorder = recorder
+
+    def __enter__(self):
+        self.memory_start = self.recorder.reset_peak()
+        super().__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        import tracemalloc
+        super().__exit__(exc_type, exc_value, traceback)
+        current, peak = tracemalloc.get_traced_memory()
+        self.recorder.max_peak = max(self.recorder.max_peak, peak)
+        memory = self.recorder.profile.memory.setdefault(
+            self.name, {'peak': 0, 'net': 0})
+        memory['peak'] = max(memory['peak'], peak - self.memory_start)
+        memory['net'] += current - self.memory_start
+        return False
+
+
+class _Recorder(object):
+
+    def __init__(self, operation, hooks, memory_budget=None):
+        self.profile = Profile(operation)
+        self.hooks = hooks
+        self.memory_budget = memory_budget
+
+    def span(self, name):
+        if self.memory_budget is not None:
+            return _MemorySpan(self, name)
+        return _Span(self.profile.stages, name)
+
+    def reset_peak(self):
+        """Start a new peak measurement and return the current allocation.
+        The peak reached since the last reset is kept in max_peak."""
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        self.max_peak = max(self.max_peak, peak)
+        if hasattr(tracemalloc, 'reset_peak'):  # added in py3.9
+            tracemalloc.reset_peak()
+        return current
+
+    def __enter__(self):
+        self.token = _current_recorder.set(self)
+        if self.memory_budget is not None:
+            self.max_peak = 0
+            self.memory_start = self.reset_peak()
+            self.max_peak = 0
+        self.start = perf_counter()
+        return self.profile
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        profile = self.profile
+        profile.total = perf_counter() - self.start
+        _current_recorder.reset(self.token)
+        if exc_type is not None:
+            profile.error = exc_type.__name__
+        if self.memory_budget is not None:
+            self.reset_peak()
+            profile.peak_memory = self.max_peak - self.memory_start
+            if self.memory_budget and profile.peak_memory > self.memory_budget:
+                profile.over_budget = True
+                logger.warning(
+                    '%s allocated %d bytes, which is over the memory budget '
+                    'of %d bytes. Inputs: %s', profile.operation,
+                    profile.peak_memory, self.memory_budget, profile.info)
+        for callback in self.hooks:
+            try:
+                callback(self.profile)
+            except Exception as e:
+                logger.warning(
+                    'Profiling hook %s failed: %s', callback, e)
+        return False
+
+
+def record(operation):
+    """Context manager used by the instrumented functions around a call.
+    It does nothing when no hook is registered or when a call is already
+    being recorded (nested call: its stages go to the outer profile)."""
+    if _current_recorder.get() is not None:
+        return _NULL_CONTEXT
+    hooks = _context_hooks.get()
+    if _global_hooks:
+        hooks = tuple(_global_hooks) + hooks
+    if not hooks:
+        return _NULL_CONTEXT
+    return _Recorder(operation, hooks, memory_budget=_memory_budget.get())
+
+
+def span(name):
+    """Context manager that measures a stage of the call being recorded"""
+    recorder = _current_recorder.get()
+    if recorder is None:
+        return _NULL_CONTEXT
+    return recorder.span(name)
+
+
+def annotate(**info):
+    """Add information on the inputs to the profile of the current call"""
+    recorder = _current_recorder.get()
+    if recorder is not None:
+        recorder.profile.info.update(info)
+
+
+def add_hook(callback):
+    """Register a callback for all the threads of the process.
+    The callback is called with a Profile object at the end of each
+    instrumented call."""
+    if callback not in _global_hooks:
+        _global_hooks.append(callback)
+
+
+def remove_hook(callback):
+    if callback in _global_hooks:
+        _global_hooks.remove(callback)
+
+
+@contextmanager
+def hook(callback):
+    """Register a callback for the calls made in the current context only
+    (current thread or asyncio task) for the duration of the with block."""
+    token = _context_hooks.set(_context_hooks.get() + (callback,))
+    try:
+        yield callback
+    finally:
+        _context_hooks.reset(token)
+
+
+@contextmanager
+def collect_profiles():
+    """Return the list of the profiles of the calls made in the with block"""
+    profiles = []
+    with hook(profiles.append):
+        yield profiles
+
+
+@contextmanager
+def memory_accounting(budget=None):
+    """Return the list of the profiles of the calls made in the with block,
+    with the memory allocated by each stage. tracemalloc is started if it
+    is not already tracing, and stopped at the end of the block.
+    :param budget: if the peak allocation of a call is over budget (in bytes),
+    the profile is flagged as over_budget and a warning is logged.
+    :type budget: int
+    """
+    import tracemalloc
+    if budget is not None and (not isinstance(budget, int) or budget < 0):
+        raise ValueError('budget must be a positive integer or None')
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    token = _memory_budget.set(budget or 0)
+    try:
+        with collect_profiles() as profiles:
+            yield profiles
+    finally:
+        _memory_budget.reset(token)
+        if started:
+            tracemalloc.stop()
+
+
+def percentile(sorted_values, percent):
+    """Return the percentile of a sorted list of values, with the
+    nearest-rank method (p50, p90, p99 of the summaries)."""
+    index = max(0, -(-len(sorted_values) * percent // 100) - 1)
+    return sorted_values[int(index)]
+
+
+class ProfileAggregator(object):
+    """Hook that accumulates profiles to compute statistics on a batch.
+    It is not thread-safe: use one aggregator per thread or protect it."""
+
+    def __init__(self):
+        self.samples = {}
+
+    def __call__(self, profile):
+        self.add(profile)
+
+    def add(self, profile):
+        operation_samples = self.samples.setdefault(profile.operation, {})
+        operation_samples.setdefault('total', []).append(profile.total)
+        for stage, duration in profile.stages.items():
+            operation_samples.setdefault(stage, []).append(duration)
+
+    def summary(self):
+        """Return a dict {operation: {stage: stats}} where stats is a dict
+        with keys count, total, mean, p50, p90, p99 and max (in seconds).
+        The stage 'total' holds the duration of the whole calls."""
+        res = {}
+        for operation, operation_samples in self.samples.items():
+            res[operation] = {}
+            for stage, values in operation_samples.items():
+                values = sorted(values)
+                total = sum(values)
+                res[operation][stage] = {
+                    'count': len(values),
+                    'total': total,
+                    'mean': total / len(values),
+                    'p50': percentile(values, 50),
+                    'p90': percentile(values, 90),
+                    'p99': percentile(values, 99),
+                    'max': values[-1],
+                    }
+        return res
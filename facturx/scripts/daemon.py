@@ -0,0 +1,77 @@
+#! /usr/bin/env python
+# Published under the BSD licence
+# Daemon of warm workers for the command line tools, see facturx/daemon.py
+
+import argparse
+import sys
+from facturx import daemon, __version__ as fxversion
+from facturx.facturx import logger, FORMAT
+import logging
+import os
+
+__author__ = "Alexis de Lattre <alexis.delattre@akretion.com>"
+__date__ = "October 2026"
+__version__ = "0.1"
+
+
+def run_daemon(args):
+    logger.info('daemon version %s using factur-x lib version %s', __version__, fxversion)
+    if args.log_level:
+        log_level = args.log_level.lower()
+        log_map = {
+            'debug': logging.DEBUG,
+            'info': logging.INFO,
+            'warn': logging.WARN,
+            'error': logging.ERROR,
+        }
+        if log_level in log_map:
+            logger.setLevel(log_map[log_level])
+        else:
+            logger.error(
+                'Wrong value for log level (%s). Possible values: %s',
+                log_level, ', '.join(log_map.keys()))
+            sys.exit(1)
+    if not hasattr(os, 'fork') or not hasattr(os, 'getuid'):
+        logger.error('The factur-x daemon is not supported on this OS')
+        sys.exit(1)
+    try:
+        daemon.serve(args.socket, args.workers)
+    except daemon.DaemonError as e:
+        logger.error(e)
+        sys.exit(1)
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    logging.basicConfig(format=FORMAT)
+    usage = "facturx-daemon [options]"
+    epilog = "Author: %s - Version: %s" % (__author__, __version__)
+    description = "This script runs a daemon with worker processes that have "\
+                  "already loaded pypdf, lxml and the XSD schemas. When it runs, "\
+                  "facturx-pdfgen, facturx-pdfextractxml and facturx-xmlcheck "\
+                  "send their job to it on a Unix socket instead of loading "\
+                  "everything for a single file. Stop it with SIGTERM or Ctrl-C."
+    parser = argparse.ArgumentParser(
+        usage=usage, epilog=epilog, description=description)
+    parser.add_argument(
+        '-l', '--log-level', dest='log_level', default='info',
+        help="Set log level. Possible values: debug, info, warn, error. "
+        "Default value: info.")
+    parser.add_argument(
+        '-s', '--socket', dest='socket',
+        help="Path of the Unix socket of the daemon. Default: $%s, "
+        "$XDG_RUNTIME_DIR/facturx.sock or /tmp/facturx-<uid>.sock." % daemon.SOCKET_ENV)
+    parser.add_argument(
+        '-w', '--workers', dest='workers', type=int,
+        help="Number of worker processes. Default: number of CPUs.")
+    args = parser.parse_args(args)
+    run_daemon(args)
+
+
+def run():
+    if __name__ == '__main__':
+        main()
+
+
+run()
@@ -3,14 +3,14 @@
 
 import argparse
 import sys
-from facturx import get_xml_from_pdf, __version__ as fxversion
-from facturx.facturx import logger
+from facturx import daemon, get_xml_from_pdf, __version__ as fxversion
+from facturx.facturx import logger, FORMAT
 import logging
 from os.path import isfile, isdir
 
 __author__ = "Alexis de Lattre <alexis.delattre@akretion.com>"
-__date__ = "July 2025"
-__version__ = "0.3"
+__date__ = "October 2026"
+__version__ = "0.4"
 
 
 def pdfextractxml(args):
@@ -45,10 +45,18 @@ def pdfextractxml(args):
     check_xsd = True
     if args.disable_xsd_check:
         check_xsd = False
-    # The important line of code is below !
     try:
-        (xml_filename, xml_string) = get_xml_from_pdf(
-            pdf_file, check_xsd=check_xsd)
+        connection = daemon.connect_from_args(args)
+        if connection:
+            with connection:
+                header, parts = daemon.call(
+                    connection, 'get_xml_from_pdf', {'check_xsd': check_xsd},
+                    [pdf_file.read()])
+            (xml_filename, xml_string) = (header['xml_filename'], parts[0])
+        else:
+            # The important line of code is below !
+            (xml_filename, xml_string) = get_xml_from_pdf(
+                pdf_file, check_xsd=check_xsd)
     except Exception as e:
         logger.error(e)
         sys.exit(1)
@@ -68,6 +76,7 @@ def pdfextractxml(args):
 def main(args=None):
     if args is None:
         args = sys.argv[1:]
+    logging.basicConfig(format=FORMAT)
     usage = "facturx-pdfextractxml <facturx_orderx_file> <xml_file_to_create>"
     epilog = "Author: %s - Version: %s" % (__author__, __version__)
     description = "This extracts the XML file from a Factur-X or Order-X PDF file."
@@ -82,12 +91,13 @@ def main(args=None):
         action='store_true',
         help="De-activate XML Schema Definition check on Factur-X/Order-X XML file "
         "(the check is enabled by default)")
+    daemon.add_arguments(parser)
     parser.add_argument(
         "facturx_orderx_file", help="PDF Factur-X or Order-X file")
     parser.add_argument(
         "xml_file_to_create",
         help="Filename of the XML file that will be extracted from the PDF")
-    args = parser.parse_args()
+    args = parser.parse_args(args)
     pdfextractxml(args)
 
 
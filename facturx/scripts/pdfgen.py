@@ -3,14 +3,14 @@
 
 import argparse
 import sys
-from facturx import generate_from_file, __version__ as fxversion
-from facturx.facturx import logger
+from facturx import daemon, generate_from_file, __version__ as fxversion
+from facturx.facturx import logger, FORMAT
 import logging
-from os.path import isfile, isdir, basename
+from os.path import isfile, isdir, basename, getmtime
 
 __author__ = "Alexis de Lattre <alexis.delattre@akretion.com>"
-__date__ = "July 2025"
-__version__ = "0.7"
+__date__ = "October 2026"
+__version__ = "0.8"
 
 
 def pdfgen(args):
@@ -74,13 +74,39 @@ def pdfgen(args):
         attachments[basename(additional_attachment_filename)] = {
             'filepath': additional_attachment_filename}
     lang = args.lang or None
+    options = {
+        'check_xsd': check_xsd,
+        'flavor': args.flavor,
+        'level': args.level,
+        'orderx_type': args.orderx_type,
+        'pdf_metadata': pdf_metadata,
+        'lang': lang,
+        'afrelationship': args.afrelationship,
+        }
     try:
-        # The important line of code is below !
-        generate_from_file(
-            pdf_filename, xml_file, check_xsd=check_xsd,
-            flavor=args.flavor, level=args.level, orderx_type=args.orderx_type,
-            pdf_metadata=pdf_metadata, lang=lang, output_pdf_file=output_pdf_filename,
-            attachments=attachments, afrelationship=args.afrelationship)
+        connection = daemon.connect_from_args(args)
+        if connection:
+            # The files are sent to the daemon, which returns the PDF
+            parts = [xml_file.read()]
+            with open(pdf_filename, 'rb') as pdf_file:
+                parts.insert(0, pdf_file.read())
+            options['attachments'] = []
+            for filename, attachment in attachments.items():
+                options['attachments'].append({
+                    'filename': filename,
+                    'mtime': getmtime(attachment['filepath'])})
+                with open(attachment['filepath'], 'rb') as attachment_file:
+                    parts.append(attachment_file.read())
+            with connection:
+                header, parts = daemon.call(
+                    connection, 'generate_from_file', options, parts)
+            with open(output_pdf_filename, 'wb') as output_pdf_file:
+                output_pdf_file.write(parts[0])
+        else:
+            # The important line of code is below !
+            generate_from_file(
+                pdf_filename, xml_file, output_pdf_file=output_pdf_filename,
+                attachments=attachments, **options)
     except Exception as e:
         logger.error('factur-x lib call failed. Error: %s', e)
         sys.exit(1)
@@ -89,6 +115,7 @@ def pdfgen(args):
 def main(args=None):
     if args is None:
         args = sys.argv[1:]
+    logging.basicConfig(format=FORMAT)
     usage = "facturx-pdfgen <regular_pdf_file> <xml_file> "\
             "<facturx_orderx_pdf_file> <optional_attachments>"
     epilog = "Author: %s - Version: %s" % (__author__, __version__)
@@ -168,6 +195,7 @@ def main(args=None):
     parser.add_argument(
         '-w', '--overwrite', dest='overwrite', action='store_true',
         help="Overwrite output PDF file if it already exists.")
+    daemon.add_arguments(parser)
     parser.add_argument("regular_pdf_file", help="Regular PDF invoice")
     parser.add_argument("xml_file", help="Factur-X or Order-X XML file")
     parser.add_argument(
@@ -175,7 +203,7 @@ def main(args=None):
     parser.add_argument(
         "optional_attachments", nargs='*',
         help="Optional list of additionnal attachments")
-    args = parser.parse_args()
+    args = parser.parse_args(args)
     pdfgen(args)
 
 
@@ -13,67 +13,204 @@
 #   curl -X POST -F 'pdf=@/home/alexis/invoice_test.pdf'
 #        -F 'xml=@/home/alexis/factur-x.xml' -o result_facturx.pdf
 #        http://localhost:5000/generate_facturx
+#
+# Without a WSGI server, the webservice can run in several pre-forked
+# processes with the --workers option.
 
-from flask import Flask, request, send_file
-from tempfile import NamedTemporaryFile
-from facturx import generate_from_file, __version__ as fxversion
-from facturx.facturx import logger as fxlogger
+from flask import Flask, Request, abort, jsonify, request, send_file
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from facturx import (
+    daemon, generate_from_file, get_xml_from_pdf, xml_check_xsd,
+    __version__ as fxversion)
+from facturx.facturx import (
+    logger as fxlogger, FORMAT, get_flavor, get_level, get_orderx_type)
 import argparse
 import logging
+import os
 import sys
 from logging.handlers import RotatingFileHandler
 
-MAX_ATTACHMENTS = 3  # TODO make it a cmd line option
 __author__ = "Alexis de Lattre <alexis.delattre@akretion.com>"
-__date__ = "July 2025"
-__version__ = "0.2"
+__date__ = "October 2026"
+__version__ = "0.4"
+
+
+class SpooledRequest(Request):
+    """The uploaded files are kept in memory, and only written to a
+    temporary file above SPOOL_MAX_SIZE bytes."""
+
+    def _get_file_stream(
+            self, total_content_length, content_type, filename=None,
+            content_length=None):
+        return SpooledTemporaryFile(
+            max_size=app.config['SPOOL_MAX_SIZE'], prefix='fx-api-upload-')
+
+
 app = Flask(__name__)
+app.request_class = SpooledRequest
+app.config.update(
+    # Number of attachments (attachment1, attachment2...) read from the request
+    MAX_ATTACHMENTS=3,
+    # Size of the request body, in bytes, above which it is refused with
+    # an HTTP 413 error (None: no limit)
+    MAX_CONTENT_LENGTH=None,
+    # Size of an uploaded file, in bytes, above which it is written to a
+    # temporary file instead of being kept in memory
+    SPOOL_MAX_SIZE=1024 * 1024,
+    )
+# Under a WSGI server, set them with FACTURX_WEBSERVICE_MAX_ATTACHMENTS...
+app.config.from_prefixed_env('FACTURX_WEBSERVICE')
 
 
 @app.route('/generate_facturx', methods=['POST'])
 def generate_facturx():
     app.logger.debug('request.files=%s', request.files)
+    if 'pdf' not in request.files or 'xml' not in request.files:
+        abort(400, 'The pdf and xml files are required')
     attachments = {}
-    for i in range(MAX_ATTACHMENTS):
+    for i in range(app.config['MAX_ATTACHMENTS']):
         attach_key = 'attachment%d' % (i + 1)
         if request.files.get(attach_key):
-            with NamedTemporaryFile(prefix='fx-api-attach-') as attach_file:
-                request.files[attach_key].save(attach_file.name)
-                attach_file.seek(0)
-                attachments[request.files[attach_key].filename] = {
-                    'filedata': attach_file.read(),
-                    }
-                attach_file.close()
-
-    with NamedTemporaryFile(prefix='fx-api-xml-', suffix='.xml') as xml_file:
-        request.files['xml'].save(xml_file.name)
-        app.logger.debug('xml_file.name=%s', xml_file.name)
-        xml_file.seek(0)
-        xml_byte = xml_file.read()
-        xml_file.close()
-    res = ''
-    with NamedTemporaryFile(prefix='fx-api-pdf-', suffix='.pdf') as pdf_file:
-        with NamedTemporaryFile(
-                prefix='fx-api-outpdf-', suffix='.pdf') as output_pdf_file:
-            request.files['pdf'].save(pdf_file.name)
-            app.logger.debug('pdf_file.name=%s', pdf_file.name)
-            app.logger.debug('output_pdf_file.name=%s', output_pdf_file.name)
-            app.logger.debug('attachments keys=%s', attachments.keys())
-            generate_from_file(
-                pdf_file, xml_byte, output_pdf_file=output_pdf_file.name,
-                attachments=attachments)
-            output_pdf_file.seek(0)
-            res = send_file(output_pdf_file.name, as_attachment=True)
-            app.logger.info(
-                'Factur-X or Order-X document successfully returned by webservice')
-            output_pdf_file.close()
-        pdf_file.close()
+            attachments[request.files[attach_key].filename] = {
+                'filedata': request.files[attach_key].read(),
+                }
+    xml_byte = request.files['xml'].read()
+    # The uploaded PDF file is read where it is (in memory, or in its
+    # temporary file when it is big) and the result is written in memory
+    pdf_file = request.files['pdf'].stream
+    pdf_file.seek(0)
+    output_pdf_file = BytesIO()
+    app.logger.debug('attachments keys=%s', attachments.keys())
+    generate_from_file(
+        pdf_file, xml_byte, output_pdf_file=output_pdf_file,
+        attachments=attachments)
+    output_pdf_file.seek(0)
+    app.logger.info(
+        'Factur-X or Order-X document successfully returned by webservice')
+    return send_file(
+        output_pdf_file, mimetype='application/pdf', as_attachment=True,
+        download_name=request.files['pdf'].filename or 'facturx.pdf')
+
+
+def _json_error(status, message):
+    response = jsonify({'error': message})
+    response.status_code = status
+    return response
+
+
+def _xml_from_request():
+    """Return the filename and the content of the XML file sent in the xml
+    key of the request, or embedded in the PDF file sent in the pdf key."""
+    if request.files.get('xml'):
+        return request.files['xml'].filename, request.files['xml'].read()
+    pdf_file = request.files['pdf'].stream
+    pdf_file.seek(0)
+    return get_xml_from_pdf(pdf_file, check_xsd=False)
+
+
+def _classify(xml_bytes):
+    from lxml import etree
+    xml_root = etree.fromstring(xml_bytes)
+    flavor = get_flavor(xml_root)
+    res = {'flavor': flavor, 'level': get_level(xml_root, flavor)}
+    if flavor == 'order-x':
+        res['orderx_type'] = get_orderx_type(xml_root)
     return res
 
 
+@app.route('/extract_xml', methods=['POST'])
+def extract_xml():
+    """Return the XML file embedded in the PDF file, with its flavor and
+    level. Add check_xsd=1 to the form to validate it."""
+    if not request.files.get('pdf'):
+        abort(400, 'The pdf file is required')
+    pdf_file = request.files['pdf'].stream
+    pdf_file.seek(0)
+    check_xsd = request.form.get('check_xsd') in ('1', 'true')
+    try:
+        xml_filename, xml_bytes = get_xml_from_pdf(
+            pdf_file, check_xsd=check_xsd)
+    except Exception as e:
+        return _json_error(422, str(e))
+    if not xml_bytes:
+        return _json_error(
+            422, 'No Factur-X, Order-X or ZUGFeRD XML file in the PDF file')
+    try:
+        res = _classify(xml_bytes)
+        res.update(filename=xml_filename, xml=xml_bytes.decode('utf-8'))
+    except Exception as e:
+        return _json_error(422, str(e))
+    return jsonify(res)
+
+
+@app.route('/validate', methods=['POST'])
+def validate():
+    """Validate against the XSD the XML file sent in the xml key, or
+    embedded in the PDF file sent in the pdf key."""
+    if not request.files.get('xml') and not request.files.get('pdf'):
+        abort(400, 'A pdf or xml file is required')
+    try:
+        xml_filename, xml_bytes = _xml_from_request()
+    except Exception as e:
+        return _json_error(422, str(e))
+    if not xml_bytes:
+        return _json_error(
+            422, 'No Factur-X, Order-X or ZUGFeRD XML file in the PDF file')
+    res = {'filename': xml_filename}
+    try:
+        res.update(_classify(xml_bytes))
+        xml_check_xsd(xml_bytes, flavor=res['flavor'], level=res['level'])
+    except Exception as e:
+        res.update(valid=False, error=str(e))
+    else:
+        res['valid'] = True
+    return jsonify(res)
+
+
+@app.route('/classify', methods=['POST'])
+def classify():
+    """Return the flavor, level (and Order-X type) of the XML file sent in
+    the xml key, or embedded in the PDF file sent in the pdf key, without
+    validating it."""
+    if not request.files.get('xml') and not request.files.get('pdf'):
+        abort(400, 'A pdf or xml file is required')
+    try:
+        xml_filename, xml_bytes = _xml_from_request()
+        if not xml_bytes:
+            return _json_error(
+                422, 'No Factur-X, Order-X or ZUGFeRD XML file in the PDF file')
+        res = _classify(xml_bytes)
+    except Exception as e:
+        return _json_error(422, str(e))
+    res['filename'] = xml_filename
+    return jsonify(res)
+
+
+def serve_prefork(host, port, workers):
+    """Serve the webservice in several worker processes, forked once the
+    XSD schemas are compiled and which share the listening socket. A worker
+    that dies is replaced. On SIGTERM or SIGINT, the workers finish their
+    current request and stop."""
+    from werkzeug.serving import make_server
+    xsd_files = daemon.warm_up()
+    app.logger.info('%d XSD schemas compiled', len(xsd_files))
+    # The socket listens once the schemas are compiled: the requests wait
+    # in its backlog while the workers are forked
+    server = make_server(host, port, app)
+    app.logger.info(
+        'Webservice listening on http://%s:%d with %d workers',
+        host, server.server_port, workers)
+    try:
+        daemon.serve_prefork(server, workers, log=app.logger)
+    finally:
+        server.server_close()
+
+
 def main(args=None):
     if args is None:
         args = sys.argv[1:]
+    logging.basicConfig(format=FORMAT)
     usage = "facturx_webservice.py [options]"
     epilog = "Script written by Alexis de Lattre. "\
         "Published under the BSD licence."
@@ -103,7 +240,34 @@ def main(args=None):
         '-n', '--loglevel', dest='loglevel', default='info',
         help="Log level. Possible values: critical, error, warning, "
              "info (default), debug.")
-    args = parser.parse_args()
+    parser.add_argument(
+        '-w', '--workers', dest='workers', type=int, default=0,
+        help="Number of worker processes: the webservice runs in this "
+             "number of processes, pre-forked once the XSD schemas are "
+             "loaded, which can serve real traffic. By default, it runs in "
+             "the development server of Flask.")
+    parser.add_argument(
+        '-a', '--max-attachments', dest='max_attachments', type=int,
+        default=app.config['MAX_ATTACHMENTS'],
+        help="Maximum number of attachments (attachment1, attachment2...) "
+             "embedded in the PDF. Default: %(default)s.")
+    parser.add_argument(
+        '-m', '--max-upload-size', dest='max_upload_size', type=int,
+        default=app.config['MAX_CONTENT_LENGTH'],
+        help="Maximum size of a request, in bytes: bigger uploads are "
+             "refused with an HTTP 413 error. No limit by default.")
+    parser.add_argument(
+        '--spool-size', dest='spool_size', type=int,
+        default=app.config['SPOOL_MAX_SIZE'],
+        help="Size of an uploaded file, in bytes, above which it is written "
+             "to a temporary file instead of being kept in memory. "
+             "Default: %(default)s.")
+    args = parser.parse_args(args)
+    app.config.update(
+        MAX_ATTACHMENTS=args.max_attachments,
+        MAX_CONTENT_LENGTH=args.max_upload_size,
+        SPOOL_MAX_SIZE=args.spool_size,
+        )
     if args.logfile:
         formatter = logging.Formatter(
             "[%(asctime)s] %(levelname)s %(message)s")
@@ -125,7 +289,14 @@ def main(args=None):
         app.logger.addHandler(handler)
         app.logger.info('Start webservice to generate Factur-X invoices')
     fxlogger.info('webservice version %s using factur-x lib version %s', __version__, fxversion)
-    app.run(debug=args.debug, port=args.port, host=args.host)
+    if args.workers > 0:
+        if not hasattr(os, 'fork'):
+            fxlogger.error('The --workers option is not supported on this OS')
+            sys.exit(1)
+        app.logger.setLevel(logging.INFO)
+        serve_prefork(args.host, args.port, args.workers)
+    else:
+        app.run(debug=args.debug, port=args.port, host=args.host)
 
 
 def run():
@@ -3,14 +3,14 @@
 
 import argparse
 import sys
-from facturx import xml_check_xsd, __version__ as fxversion
-from facturx.facturx import logger
+from facturx import daemon, xml_check_xsd, __version__ as fxversion
+from facturx.facturx import logger, FORMAT
 import logging
 from os.path import isfile
 
 __author__ = "Alexis de Lattre <alexis.delattre@akretion.com>"
-__date__ = "July 2025"
-__version__ = "0.4"
+__date__ = "October 2026"
+__version__ = "0.5"
 
 
 def xmlcheck(args):
@@ -35,10 +35,18 @@ def xmlcheck(args):
         logger.error('%s is not a filename', args.xml_file)
         sys.exit(1)
     xml_file = open(args.xml_file, 'rb')
-    # The important line of code is below !
     try:
-        xml_check_xsd(
-            xml_file, flavor=args.flavor, level=args.level)
+        connection = daemon.connect_from_args(args)
+        if connection:
+            with connection:
+                daemon.call(
+                    connection, 'xml_check_xsd',
+                    {'flavor': args.flavor, 'level': args.level},
+                    [xml_file.read()])
+        else:
+            # The important line of code is below !
+            xml_check_xsd(
+                xml_file, flavor=args.flavor, level=args.level)
     except Exception as e:
         logger.error(e)
         sys.exit(1)
@@ -47,6 +55,7 @@ def xmlcheck(args):
 def main(args=None):
     if args is None:
         args = sys.argv[1:]
+    logging.basicConfig(format=FORMAT)
     usage = "facturx-xmlcheck <xml_file>"
     epilog = "Author: %s - Version: %s" % (__author__, __version__)
     description = "This script checks the Factur-X or Order-XML XML against the XML "\
@@ -70,9 +79,10 @@ def main(args=None):
         "(less than 1 millisecond). "
         "Possible values for Factur-X: minimum, basicwl, basic, en16931, extended. "
         "Possible values for Order-X: basic, comfort, extended.")
+    daemon.add_arguments(parser)
     parser.add_argument(
         "xml_file", help="Factur-X or Order-X XML file to check")
-    args = parser.parse_args()
+    args = parser.parse_args(args)
     xmlcheck(args)
 
 
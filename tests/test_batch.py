@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+from copy import deepcopy
+from io import BytesIO
+import json
+from pathlib import Path
+import sys
+import zipfile
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from facturx import get_xml_from_pdf
+
+from app.batch import iter_json_array
+from app.main import app
+from app.models import INVOICE_EXAMPLE
+
+
+def _invoices():
+    invoices = []
+    for number in ("INV-1", "INV-2", "INV-1"):
+        invoice = deepcopy(INVOICE_EXAMPLE)
+        invoice["invoice_number"] = number
+        invoices.append(invoice)
+    invalid = deepcopy(INVOICE_EXAMPLE)
+    invalid["invoice_number"] = "INV-BAD"
+    invalid["line_items"] = []
+    invoices.insert(1, invalid)
+    return invoices
+
+
+def _check_zip(content):
+    archive = zipfile.ZipFile(BytesIO(content))
+    manifest = json.loads(archive.read("manifest.json"))
+    assert [entry["index"] for entry in manifest] == [0, 1, 2, 3]
+    assert [entry["status"] for entry in manifest] == ["ok", "invalid", "ok", "ok"]
+    assert manifest[1]["invoice_number"] == "INV-BAD"
+    assert manifest[1]["error"][0]["loc"] == ["line_items"]
+    files = [entry["file"] for entry in manifest if entry["status"] == "ok"]
+    assert len(set(files)) == 3
+    for name in files:
+        _, xml_bytes = get_xml_from_pdf(archive.read(name))
+        assert xml_bytes
+
+
+def test_batch_json_array():
+    response = TestClient(app).post("/invoices/pdf:batch", json=_invoices())
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+    _check_zip(response.content)
+
+
+def test_batch_ndjson():
+    body = "\n".join(json.dumps(invoice) for invoice in _invoices()) + "\n"
+    response = TestClient(app).post(
+        "/invoices/pdf:batch", content=body, headers={"Content-Type": "application/x-ndjson"}
+    )
+    assert response.status_code == 200
+    _check_zip(response.content)
+
+
+def test_batch_wrong_media_type():
+    response = TestClient(app).post("/invoices/pdf:batch", content=b"x", headers={"Content-Type": "text/plain"})
+    assert response.status_code == 415
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 1024])
+def test_iter_json_array(chunk_size):
+    data = [{"a": "é", "b": [1, 2.5, None]}, 123456, "x"]
+    assert list(iter_json_array(BytesIO(json.dumps(data).encode()), chunk_size)) == data
+    with pytest.raises(ValueError):
+        list(iter_json_array(BytesIO(b'{"a": 1}'), chunk_size))
+    with pytest.raises(ValueError):
+        list(iter_json_array(BytesIO(b"[1, 2"), chunk_size))
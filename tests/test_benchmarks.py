@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from facturx import get_flavor, get_level, xml_check_xsd
+from lxml import etree
+
+from benchmarks import corpus
+from benchmarks.suite import compare, run_suite
+
+
+def test_corpus_documents_are_valid():
+    for level in corpus.FACTURX_LEVELS:
+        xml_bytes = corpus.facturx_xml(level=level, lines=3)
+        assert xml_check_xsd(xml_bytes, flavor="factur-x", level=level)
+        assert get_level(etree.fromstring(xml_bytes)) == level
+    for level in corpus.ORDERX_LEVELS:
+        xml_bytes = corpus.orderx_xml(level=level, lines=3)
+        assert get_flavor(etree.fromstring(xml_bytes)) == "order-x"
+        assert xml_check_xsd(xml_bytes, flavor="order-x", level=level)
+
+
+def test_suite_and_baseline_comparison():
+    results = run_suite(
+        quick=True, filters=["[level=factur-x-minimum]"], runs=3, max_seconds=0.1
+    )
+    assert len(results["results"]) == 4
+    stats = results["results"]["xml_check_xsd[level=factur-x-minimum]"]
+    assert stats["runs"] >= 3
+    assert stats["p50"] <= stats["p99"] <= stats["max"]
+    assert stats["peak_memory"] is not None
+
+    assert compare(results, results) == []
+    faster = {
+        "results": {
+            name: dict(res, p50=res["p50"] / 2)
+            for (name, res) in results["results"].items()
+        }
+    }
+    assert len(compare(results, faster, tolerance=0.2)) == 4
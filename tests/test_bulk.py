@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import csv
+from io import BytesIO, StringIO
+import json
+from pathlib import Path
+import sys
+import zipfile
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from facturx import get_xml_from_pdf
+
+from app.bulk import iter_rows, import_invoices, main
+from app.models import INVOICE_EXAMPLE
+
+
+def _rows(numbers):
+    rows = []
+    for number in numbers:
+        header = {
+            "invoice_number": number,
+            "issue_date": INVOICE_EXAMPLE["issue_date"],
+            "due_date": "",
+            "currency": "EUR",
+            "seller_bank_iban": INVOICE_EXAMPLE["seller_bank_iban"],
+        }
+        for party in ("seller", "buyer"):
+            values = INVOICE_EXAMPLE[party]
+            header.update({f"{party}_{name}": values.get(name, "") for name in ("name", "vat_identifier", "email")})
+            header.update({f"{party}_{name}": value for name, value in values["address"].items()})
+        for line in INVOICE_EXAMPLE["line_items"]:
+            rows.append(dict(header, **line))
+    return rows
+
+
+def _csv(rows):
+    output = StringIO()
+    writer = csv.DictWriter(output, fieldnames=list(rows[0]))
+    writer.writeheader()
+    writer.writerows(rows)
+    return output.getvalue().encode("utf-8")
+
+
+def test_import_to_directory(tmp_path):
+    rows = _rows(["INV-1", "INV-2", "INV-3"])
+    rows[2]["vat_rate"] = "-5"
+    rows.append(dict(rows[0], description="Late line"))
+    summary = import_invoices(iter_rows(BytesIO(_csv(rows)), "csv"), tmp_path, workers=0, chunk_size=2)
+    assert summary["count"] == 4
+    assert (summary["ok"], summary["invalid"]) == (2, 2)
+
+    manifest = [json.loads(line) for line in (tmp_path / "manifest.jsonl").read_text().splitlines()]
+    assert [entry["status"] for entry in manifest] == ["ok", "invalid", "ok", "invalid"]
+    assert manifest[1]["error"][0]["loc"] == ["line_items", 0, "vat_rate"]
+    assert "not consecutive" in manifest[3]["error"]
+    _, xml_bytes = get_xml_from_pdf((tmp_path / manifest[0]["file"]).read_bytes(), check_xsd=True)
+    assert b"<ram:DueDateDateTime>" not in xml_bytes
+
+
+def test_import_ndjson_to_zip_with_workers(tmp_path):
+    numbers = [f"INV-{index}" for index in range(10)]
+    ndjson = "".join(json.dumps(row) + "\n" for row in _rows(numbers))
+    input_path = tmp_path / "export.ndjson"
+    input_path.write_text(ndjson)
+    output_path = tmp_path / "invoices.zip"
+    main([str(input_path), "-o", str(output_path), "--workers", "2", "--chunk-size", "3"])
+
+    archive = zipfile.ZipFile(output_path)
+    manifest = [json.loads(line) for line in archive.read("manifest.jsonl").splitlines()]
+    assert [entry["invoice_number"] for entry in manifest] == numbers
+    assert archive.namelist()[-1] == "manifest.jsonl"
+    for entry in manifest:
+        assert entry["lines"] == 2
+        _, xml_bytes = get_xml_from_pdf(archive.read(entry["file"]))
+        assert entry["invoice_number"].encode() in xml_bytes
@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import asyncio
+from copy import deepcopy
+import os
+from pathlib import Path
+import sys
+import time
+
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app import main
+from app import cache as cache_module
+from app.cache import ResultCache, content_key, result_key
+from app.models import INVOICE_EXAMPLE, Invoice
+
+
+def test_result_key_is_canonical():
+    invoice = Invoice.model_validate(deepcopy(INVOICE_EXAMPLE))
+    reordered = Invoice.model_validate(dict(reversed(list(deepcopy(INVOICE_EXAMPLE).items()))))
+    assert result_key(invoice, "pdf") == result_key(reordered, "pdf")
+    assert result_key(invoice, "pdf") != result_key(invoice, "xml")
+
+
+def test_keys_change_with_the_cache_version(monkeypatch):
+    invoice = Invoice.model_validate(deepcopy(INVOICE_EXAMPLE))
+    keys = result_key(invoice, "pdf"), content_key("pdf:columns", b"lines")
+    monkeypatch.setattr(cache_module, "_KEY_PREFIX", f"{cache_module.CACHE_VERSION + 1}/3.8")
+    assert result_key(invoice, "pdf") != keys[0]
+    assert content_key("pdf:columns", b"lines") != keys[1]
+
+
+def test_lru_byte_budget_and_disk_tier(tmp_path):
+    cache = ResultCache(max_bytes=10, directory=tmp_path)
+    cache.put("aa01", b"12345")
+    cache.put("aa02", b"12345")
+    cache.get("aa01")
+    cache.put("aa03", b"12345")
+    assert list(cache._entries) == ["aa01", "aa03"]
+    assert cache.size == 10
+
+    # The evicted entry is still on disk, also for a new process
+    assert ResultCache(max_bytes=10, directory=tmp_path).get("aa02") == b"12345"
+
+
+def test_disk_tier_age_budget(tmp_path):
+    cache = ResultCache(max_bytes=0, directory=tmp_path, max_age=3600)
+    cache.put("aa01", b"old")
+    cache.put("aa02", b"recent")
+    old = time.time() - 7200
+    os.utime(tmp_path / "aa" / "01", (old, old))
+    assert cache.get("aa01") is None
+    assert cache.prune() == 1
+    assert [path.name for path in tmp_path.glob("*/*")] == ["02"]
+    assert ResultCache(max_bytes=0, directory=tmp_path, max_age=0).prune() == 0
+
+
+def test_concurrent_requests_create_once():
+    cache = ResultCache()
+    calls = []
+
+    async def create():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return b"pdf"
+
+    async def scenario():
+        return await asyncio.gather(*(cache.get_or_create("key", create) for _ in range(3)))
+
+    results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert sorted(hit for _, hit in results) == [False, True, True]
+
+
+def test_cancelled_creation_is_taken_over():
+    cache = ResultCache()
+    calls = []
+
+    async def create():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return b"pdf"
+
+    async def scenario():
+        leader = asyncio.create_task(cache.get_or_create("key", create))
+        await asyncio.sleep(0)
+        followers = [asyncio.create_task(cache.get_or_create("key", create)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        # The client of the first request went away
+        leader.cancel()
+        return await asyncio.gather(*followers), leader.cancelled()
+
+    results, cancelled = asyncio.run(scenario())
+    assert cancelled
+    assert len(calls) == 2
+    assert sorted(results) == [(b"pdf", False), (b"pdf", True)]
+
+
+def test_endpoint_cache_etag_and_idempotency_key(monkeypatch):
+    monkeypatch.setattr(main, "cache", ResultCache())
+    client = TestClient(main.app)
+    payload = deepcopy(INVOICE_EXAMPLE)
+
+    first = client.post("/invoices/pdf", json=payload, headers={"Idempotency-Key": "abc"})
+    assert first.headers["x-cache"] == "miss"
+    second = client.post("/invoices/pdf", json=payload, headers={"Idempotency-Key": "abc"})
+    assert second.headers["x-cache"] == "hit"
+    assert second.content == first.content
+
+    etag = first.headers["etag"]
+    response = client.post("/invoices/pdf", json=payload, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    # The same key for the XML of the invoice
+    response = client.post("/invoices/xml", json=payload, headers={"Idempotency-Key": "abc"})
+    assert response.status_code == 200
+
+    payload["invoice_number"] = "INV-OTHER"
+    response = client.post("/invoices/pdf", json=payload, headers={"Idempotency-Key": "abc"})
+    assert response.status_code == 422
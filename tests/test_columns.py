@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+from copy import deepcopy
+from io import BytesIO
+import json
+from pathlib import Path
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from facturx import get_xml_from_pdf
+
+from app.columns import COLUMNS, LineColumns
+from app.main import app
+from app.models import INVOICE_EXAMPLE, Invoice, InvoiceHeader
+from app.totals import compute_totals
+from app.xml_builder import build_facturx_xml, build_facturx_xml_from_columns
+
+
+def _invoice():
+    invoice = deepcopy(INVOICE_EXAMPLE)
+    invoice["line_items"] = [
+        {"description": "Consulting", "quantity": "3", "unit_price": "1.15", "vat_rate": "20"},
+        {"description": "Licence, yearly", "quantity": "2.5", "unit_price": "0.3333", "vat_rate": "5.5"},
+        {"description": "Support", "quantity": 7, "unit_price": 19.99, "vat_rate": 10},
+        {"description": "Postage", "quantity": "0.001", "unit_price": "0.005", "vat_rate": "20.00"},
+        # int64 would overflow on quantity x unit price
+        {"description": "Plant", "quantity": "999999999.999", "unit_price": "99999999.9999", "vat_rate": "20"},
+    ]
+    return invoice
+
+
+def _columns(invoice):
+    return {name: [line[name] for line in invoice["line_items"]] for name in COLUMNS}
+
+
+def test_columns_give_the_same_xml():
+    invoice = _invoice()
+    columns = LineColumns.from_mapping(_columns(invoice))
+    header = InvoiceHeader.model_validate(invoice)
+    assert build_facturx_xml_from_columns(header, columns) == build_facturx_xml(invoice)
+
+
+def test_columns_give_the_same_vat_rates():
+    invoice = _invoice()
+    expected = compute_totals(Invoice.model_validate(invoice).line_items).vat_groups
+    vat_groups = LineColumns.from_mapping(_columns(invoice)).totals().vat_groups
+    # As shown in the PDF: "VAT 20% on ..."
+    assert [str(group.rate) for group in vat_groups] == [str(group.rate) for group in expected] == ["20", "5.5", "10"]
+
+
+def test_csv_and_ndjson_columns():
+    invoice = _invoice()
+    csv = "vat_rate,description,quantity,unit_price,note\n" + "".join(
+        f'{line["vat_rate"]},"{line["description"]}",{line["quantity"]},{line["unit_price"]},x\n'
+        for line in invoice["line_items"]
+    )
+    ndjson = "".join(json.dumps(line) + "\n" for line in invoice["line_items"])
+    expected = LineColumns.from_mapping(_columns(invoice)).totals()
+    for columns in (LineColumns.from_csv(BytesIO(csv.encode())), LineColumns.from_ndjson(BytesIO(ndjson.encode()))):
+        totals = columns.totals()
+        assert (totals.line_total, totals.tax_total) == (expected.line_total, expected.tax_total)
+        assert columns.description.tolist()[1] == "Licence, yearly"
+
+
+@pytest.mark.parametrize(
+    "column, value, message",
+    [
+        ("quantity", "0", "Line 2: quantity must be greater than 0"),
+        ("quantity", "1.0001", "Line 2: quantity must be a decimal number"),
+        ("unit_price", "-1", "Line 2: unit_price must be a decimal number"),
+        ("unit_price", "1e3", "Line 2: unit_price must be a decimal number"),
+        ("vat_rate", None, "Line 2: vat_rate must be a decimal number"),
+        ("description", "", "Line 2: description must not be empty"),
+    ],
+)
+def test_invalid_columns(column, value, message):
+    columns = _columns(_invoice())
+    columns[column][1] = value
+    with pytest.raises(ValueError, match=message):
+        LineColumns.from_mapping(columns)
+
+
+def test_columns_endpoint():
+    invoice = _invoice()
+    columns = _columns(invoice)
+    expected_xml = build_facturx_xml(invoice)
+    del invoice["line_items"]
+    client = TestClient(app)
+
+    response = client.post("/invoices/pdf:columns", json=dict(invoice, lines=columns))
+    assert response.status_code == 200, response.text
+    assert get_xml_from_pdf(response.content)[1] == expected_xml
+
+    ndjson = "".join(json.dumps(dict(zip(COLUMNS, line))) + "\n" for line in zip(*columns.values()))
+    response = client.post(
+        "/invoices/pdf:columns",
+        params={"invoice": json.dumps(invoice)},
+        content=ndjson,
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    assert response.status_code == 200, response.text
+    assert get_xml_from_pdf(response.content)[1] == expected_xml
+
+    columns["quantity"][0] = "-3"
+    response = client.post("/invoices/pdf:columns", json=dict(invoice, lines=columns))
+    assert response.status_code == 400
+    assert "Line 1: quantity" in response.json()["detail"]
+    response = client.post("/invoices/pdf:columns", content=ndjson, headers={"Content-Type": "text/csv"})
+    assert response.status_code == 400
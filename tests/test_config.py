@@ -0,0 +1,25 @@
+from __future__ import annotations
+
+from pathlib import Path
+import sys
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.config import env_float, env_int
+
+
+def test_env_settings(monkeypatch):
+    monkeypatch.setenv("FACTURX_TEST_INT", "")
+    monkeypatch.setenv("FACTURX_TEST_FLOAT", "0.25")
+    assert env_int("FACTURX_TEST_INT", 3) == 3
+    assert env_int("FACTURX_TEST_MISSING", 3) == 3
+    assert env_float("FACTURX_TEST_FLOAT", 1) == 0.25
+    for value, message in (("two", "must be an integer"), ("-1", "must be positive")):
+        monkeypatch.setenv("FACTURX_TEST_INT", value)
+        with pytest.raises(ValueError, match=f"FACTURX_TEST_INT {message}"):
+            env_int("FACTURX_TEST_INT", 3)
+    monkeypatch.setenv("FACTURX_TEST_FLOAT", "1s")
+    with pytest.raises(ValueError, match="FACTURX_TEST_FLOAT must be a number"):
+        env_float("FACTURX_TEST_FLOAT", 1)
@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import json
+from pathlib import Path
+import sys
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from facturx import get_xml_from_pdf, xml_check_xsd
+
+from app.corpus import CorpusOptions, iter_documents, write_corpus
+
+
+def _is_valid(xml_bytes, level):
+    try:
+        xml_check_xsd(xml_bytes, flavor="factur-x", level=level)
+    except Exception:
+        return False
+    return True
+
+
+def test_xml_corpus_is_deterministic_and_flags_invalid_documents():
+    options = CorpusOptions(
+        count=12,
+        seed=7,
+        mode="xml",
+        levels=["minimum", "basicwl", "basic", "en16931", "extended"],
+        max_lines=20,
+        invalid_ratio=0.5,
+    )
+    documents = list(iter_documents(options))
+    assert documents == list(iter_documents(options))
+    assert any(entry["defect"] for (_, _, entry) in documents)
+
+    for _, xml_bytes, entry in documents:
+        assert entry["valid"] == (entry["defect"] is None)
+        xsd_valid = entry["defect"] in (None, "wrong_totals")
+        assert _is_valid(xml_bytes, entry["level"]) == xsd_valid
+
+
+def test_write_facturx_corpus_with_workers(tmp_path):
+    options = CorpusOptions(count=4, seed=1, mode="facturx", max_lines=5, max_attachments=2)
+    summary = write_corpus(tmp_path, options, workers=2)
+    assert summary["count"] == 4
+
+    entries = [json.loads(line) for line in (tmp_path / "manifest.jsonl").read_text().splitlines()]
+    assert [entry["index"] for entry in entries] == [0, 1, 2, 3]
+    for entry in entries:
+        pdf_bytes = (tmp_path / entry["file"]).read_bytes()
+        assert len(pdf_bytes) == entry["size"]
+        _, xml_bytes = get_xml_from_pdf(pdf_bytes)
+        assert _is_valid(xml_bytes, entry["level"])
+
+
+def test_invalid_options():
+    with pytest.raises(ValueError):
+        CorpusOptions(levels=["comfort"])
+    with pytest.raises(ValueError):
+        CorpusOptions(mode="zip")
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import logging
+import os
+from pathlib import Path
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from facturx import get_xml_from_pdf
+from facturx.daemon import connect, run_command
+from facturx.scripts import pdfextractxml, pdfgen, xmlcheck
+from pypdf import PdfReader
+
+from app.models import INVOICE_EXAMPLE, Invoice
+from app.utils import _render_invoice_pdf
+from app.xml_builder import build_facturx_xml
+
+INVALID_XML = b'<x/>'
+
+
+def test_run_command():
+    xml_bytes = build_facturx_xml(INVOICE_EXAMPLE)
+    header, parts = run_command({"command": "xml_check_xsd", "options": {"level": "en16931"}, "log_level": logging.INFO}, [xml_bytes])
+    assert (header["ok"], header["valid"], parts) == (True, True, [])
+    assert [logging.INFO, "factur-x XML file successfully validated against XSD"] in header["logs"]
+    header, parts = run_command({"command": "xml_check_xsd", "log_level": logging.ERROR}, [INVALID_XML])
+    assert header["ok"] is False
+    assert "Could not detect" in header["error"]
+    assert run_command({"command": "rm"}, [])[0]["error"] == "Unknown command rm"
+
+
+@pytest.fixture
+def files(tmp_path):
+    invoice = Invoice.model_validate(INVOICE_EXAMPLE)
+    (tmp_path / "invoice.pdf").write_bytes(_render_invoice_pdf(invoice))
+    (tmp_path / "factur-x.xml").write_bytes(build_facturx_xml(INVOICE_EXAMPLE))
+    (tmp_path / "delivery.txt").write_bytes(b"delivery note")
+    (tmp_path / "invalid.xml").write_bytes(INVALID_XML)
+    return tmp_path
+
+
+def test_cli_with_daemon(files, caplog):
+    socket_path = str(files / "facturx.sock")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "facturx.scripts.daemon", "--workers", "2", "--socket", socket_path],
+        cwd=Path(__file__).resolve().parents[1],
+    )
+    try:
+        deadline = time.monotonic() + 20
+        while (sock := connect(socket_path)) is None:
+            assert time.monotonic() < deadline and process.poll() is None, "The daemon didn't start"
+            time.sleep(0.05)
+        sock.close()
+        assert os.stat(socket_path).st_mode & 0o077 == 0
+        options = ["--daemon", "--daemon-socket", socket_path]
+
+        pdfgen.main(options + [str(files / name) for name in ("invoice.pdf", "factur-x.xml", "out.pdf", "delivery.txt")])
+        pdf_bytes = (files / "out.pdf").read_bytes()
+        assert get_xml_from_pdf(pdf_bytes)[1] == build_facturx_xml(INVOICE_EXAMPLE)
+        assert set(PdfReader(files / "out.pdf").attachments) == {"factur-x.xml", "delivery.txt"}
+        # The messages of the lib are logged by the client
+        assert "factur-x PDF generated" in caplog.text
+
+        pdfextractxml.main(options + [str(files / "out.pdf"), str(files / "out.xml")])
+        assert (files / "out.xml").read_bytes() == build_facturx_xml(INVOICE_EXAMPLE)
+        xmlcheck.main(options + [str(files / "out.xml")])
+        with pytest.raises(SystemExit):
+            xmlcheck.main(options + [str(files / "invalid.xml")])
+    finally:
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(timeout=10) == 0
+    assert not os.path.exists(socket_path)
+
+
+def test_cli_without_daemon(files):
+    socket_path = str(files / "missing.sock")
+    assert connect(socket_path) is None
+    xmlcheck.main(["--daemon-socket", socket_path, str(files / "factur-x.xml")])
+    with pytest.raises(SystemExit):
+        xmlcheck.main(["--daemon", "--daemon-socket", socket_path, str(files / "factur-x.xml")])
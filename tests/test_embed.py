@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+from copy import deepcopy
+from io import BytesIO
+from pathlib import Path
+import sys
+
+import pytest
+from pypdf import PdfReader
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import facturx
+from app.models import INVOICE_EXAMPLE, Invoice
+from app import utils
+from app.metrics import profiled_call
+from app.utils import generate_facturx_pdf
+from app.xml_builder import build_facturx_xml
+
+
+def test_generated_pdf_is_facturx():
+    invoice = Invoice.model_validate(deepcopy(INVOICE_EXAMPLE))
+    pdf_bytes = generate_facturx_pdf(invoice)
+
+    filename, xml_bytes = facturx.get_xml_from_pdf(BytesIO(pdf_bytes), check_xsd=True)
+    assert filename == "factur-x.xml"
+    assert xml_bytes == build_facturx_xml(invoice.model_dump(mode="python"))
+
+    reader = PdfReader(BytesIO(pdf_bytes))
+    root = reader.trailer["/Root"]
+    assert root["/PageMode"] == "/UseAttachments"
+    filespec = root["/AF"][0].get_object()
+    assert filespec["/AFRelationship"] == "/Data"
+    assert filespec["/EF"]["/F"].get_object()["/Subtype"] == "/text/xml"
+    assert list(reader.attachments) == ["factur-x.xml"]
+    output_intent = root["/OutputIntents"][0].get_object()
+    assert output_intent["/S"] == "/GTS_PDFA1"
+    assert output_intent["/DestOutputProfile"].get_object()["/N"] == 3
+    xmp = root["/Metadata"].get_object().get_data()
+    assert b"<fx:ConformanceLevel>EN 16931</fx:ConformanceLevel>" in xmp
+    assert b"<pdf:Producer>%s</pdf:Producer>" % reader.metadata["/Producer"].encode() in xmp
+    assert reader.metadata["/Title"] == "ACME Corp: Invoice INV-2024-0001"
+    assert reader.metadata["/CreationDate"] == reader.metadata["/ModDate"]
+
+    # The other reportlab documents of the process are not changed
+    from reportlab.pdfbase.pdfdoc import PDFCatalog
+    from reportlab.pdfgen.canvas import Canvas
+
+    assert "AF" not in PDFCatalog.__NoDefault__ + PDFCatalog.__Refs__
+    output = BytesIO()
+    pdf_canvas = Canvas(output)
+    pdf_canvas.showPage()
+    pdf_canvas.save()
+    reader = PdfReader(output)
+    assert "/OutputIntents" not in reader.trailer["/Root"]
+
+
+def test_xml_built_while_rendering(monkeypatch):
+    monkeypatch.setattr(utils, "_CPU_COUNT", 2)
+    monkeypatch.setattr(utils, "XML_THREAD_MIN_LINES", 0)
+    invoice = Invoice.model_validate(deepcopy(INVOICE_EXAMPLE))
+    pdf_bytes, profile = profiled_call(generate_facturx_pdf, invoice)
+    assert utils._executor is not None
+    _, xml_bytes = facturx.get_xml_from_pdf(BytesIO(pdf_bytes), check_xsd=True)
+    assert xml_bytes == build_facturx_xml(invoice)
+    assert {"render", "xml_build", "xsd_check", "embed"} <= set(profile["stages"])
+
+    def invalid(*args, **kwargs):
+        raise ValueError("Invalid XML")
+
+    # The errors of the XML thread are raised by generate_facturx_pdf()
+    monkeypatch.setattr(utils, "xml_check_xsd", invalid)
+    with pytest.raises(ValueError, match="Invalid XML"):
+        generate_facturx_pdf(invoice)
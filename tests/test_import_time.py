@@ -0,0 +1,28 @@
+from __future__ import annotations
+
+from pathlib import Path
+import subprocess
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from benchmarks.import_time import ROOT_DIR, measure
+
+
+def test_import_facturx_is_lazy():
+    assert measure("facturx", runs=1)["heavy_modules"] == []
+
+
+def test_xmlcheck_does_not_load_pypdf():
+    assert "pypdf" not in measure("facturx.scripts.xmlcheck", runs=1)["heavy_modules"]
+
+
+def test_import_does_not_configure_logging():
+    code = "import logging, facturx; assert not logging.getLogger().handlers"
+    subprocess.run([sys.executable, "-c", code], check=True, cwd=ROOT_DIR)
+
+
+def test_invoice_api_does_not_load_numpy():
+    # NumPy is only imported by the columnar invoices (app.columns)
+    code = "import sys, app.main; assert 'numpy' not in sys.modules"
+    subprocess.run([sys.executable, "-c", code], check=True, cwd=ROOT_DIR)
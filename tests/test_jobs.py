@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+from copy import deepcopy
+from io import BytesIO
+import json
+from pathlib import Path
+import sys
+import time
+
+from fastapi.testclient import TestClient
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from facturx import get_facturx_xml_from_pdf
+
+from app import jobs as jobs_module
+from app import main
+from app.jobs import IdempotencyConflict, JobQueue, JobStore
+from app.models import INVOICE_EXAMPLE
+from app.pool import InvoicePool
+
+
+def _wait(client, job_id):
+    deadline = time.monotonic() + 10
+    while True:
+        job = client.get(f"/jobs/{job_id}").json()
+        if job["status"] not in ("queued", "running") or time.monotonic() > deadline:
+            return job
+        time.sleep(0.01)
+
+
+def test_store_lanes_leases_and_expiry(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    store.open()
+    bulk, _ = store.submit('{"n": 1}', "bulk", now=100)
+    normal, _ = store.submit('{"n": 2}', "normal", now=101)
+    high, _ = store.submit('{"n": 3}', "high", now=102)
+    assert store.claim(lease=10, now=103) == (high["id"], '{"n": 3}', 1)
+    assert store.claim(lease=10, now=103)[0] == normal["id"]
+    assert store.retry(normal["id"], 1, delay=5, error="boom", now=104)
+    assert store.claim(lease=10, now=105)[0] == bulk["id"]
+    assert store.claim(lease=10, now=105) is None
+    # The retry is due, then the lease of the first job ends
+    assert store.claim(lease=10, now=109) == (normal["id"], '{"n": 2}', 2)
+    assert store.claim(lease=10, now=113) == (high["id"], '{"n": 3}', 2)
+    # The first attempt is stale: only the second one renews and finishes
+    assert not store.renew(high["id"], 1, lease=10, now=114)
+    assert not store.finish(high["id"], 1, "failed", ttl=60, error="lost", now=114)
+    assert not store.retry(high["id"], 1, delay=0, now=114)
+    assert store.renew(high["id"], 2, lease=10, now=114)
+    assert store.finish(high["id"], 2, "done", ttl=60, result=b"%PDF", invoice_number="INV-1", now=114)
+    store.close()
+    # The jobs survive a restart
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    store.open()
+    job, data = store.result(high["id"], now=115)
+    assert (job["status"], job["invoice_number"], data) == ("done", "INV-1", b"%PDF")
+    assert store.counts() == {"done": 1, "running": 2}
+    assert store.purge(now=174) == 1
+    assert store.get(high["id"], now=174) is None
+
+    first, created = store.submit('{"n": 4}', idempotency_key="key-1")
+    assert created
+    assert store.submit('{"n": 4}', idempotency_key="key-1") == (first, False)
+    with pytest.raises(IdempotencyConflict):
+        store.submit('{"n": 5}', idempotency_key="key-1")
+
+
+def test_queue_settings_from_env(monkeypatch):
+    monkeypatch.setenv("FACTURX_JOB_RETRY_DELAY", "0.5")
+    monkeypatch.setenv("FACTURX_JOB_RESULT_TTL", "3600")
+    monkeypatch.setenv("FACTURX_JOB_LEASE", "90.5")
+    queue = JobQueue.from_env(workers=2)
+    assert (queue.workers, queue.retry_delay, queue.result_ttl, queue.lease) == (2, 0.5, 3600, 90.5)
+
+
+def test_job_api(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "pool", InvoicePool(workers=0))
+    monkeypatch.setattr(main, "jobs", JobQueue(str(tmp_path / "jobs.sqlite3"), workers=2))
+    invalid = deepcopy(INVOICE_EXAMPLE)
+    invalid["line_items"][0]["vat_rate"] = -5
+    with TestClient(main.app) as client:
+        response = client.post("/jobs?lane=high", json=INVOICE_EXAMPLE)
+        assert response.status_code == 202
+        job_id = response.json()["id"]
+        assert response.headers["location"] == f"/jobs/{job_id}"
+        invalid_id = client.post("/jobs", json=invalid).json()["id"]
+
+        job = _wait(client, job_id)
+        assert (job["status"], job["lane"], job["attempts"]) == ("done", "high", 1)
+        response = client.get(f"/jobs/{job_id}/result")
+        assert response.status_code == 200
+        assert response.headers["content-disposition"] == f"attachment; filename=invoice-{INVOICE_EXAMPLE['invoice_number']}.pdf"
+        _, xml_bytes = get_facturx_xml_from_pdf(BytesIO(response.content))
+        assert INVOICE_EXAMPLE["invoice_number"].encode() in xml_bytes
+
+        job = _wait(client, invalid_id)
+        assert job["status"] == "invalid"
+        assert job["error"][0]["loc"] == ["line_items", 0, "vat_rate"]
+        assert client.get(f"/jobs/{invalid_id}/result").status_code == 409
+
+        assert client.get("/jobs/unknown").status_code == 404
+        assert client.get("/jobs/unknown/result").status_code == 404
+        assert client.post("/jobs?lane=urgent", json=INVOICE_EXAMPLE).status_code == 400
+        assert client.post("/jobs", json=[INVOICE_EXAMPLE]).status_code == 400
+        utf16 = json.dumps(INVOICE_EXAMPLE).encode("utf-16")
+        assert client.post("/jobs", content=utf16, headers={"Content-Type": "application/json"}).status_code == 400
+
+
+def test_job_lease_renewed(monkeypatch, tmp_path):
+    generate = jobs_module.generate_from_payload
+
+    def slow(payload):
+        time.sleep(1)
+        return generate(payload)
+
+    monkeypatch.setattr(jobs_module, "generate_from_payload", slow)
+    monkeypatch.setattr(jobs_module, "POLL_INTERVAL", 0.05)
+    monkeypatch.setattr(main, "pool", InvoicePool(workers=0))
+    monkeypatch.setattr(main, "jobs", JobQueue(workers=2, lease=0.3))
+    with TestClient(main.app) as client:
+        job = _wait(client, client.post("/jobs", json=INVOICE_EXAMPLE).json()["id"])
+        # Without the heartbeat, the other dispatcher claims it at the end
+        # of the lease and runs it again
+        assert (job["status"], job["attempts"]) == ("done", 1)
+
+
+def test_job_retries(monkeypatch, tmp_path):
+    calls = []
+    generate = jobs_module.generate_from_payload
+
+    def flaky(payload):
+        calls.append(payload["invoice_number"])
+        if payload["invoice_number"] == "ALWAYS" or len(calls) == 1:
+            raise RuntimeError("worker crashed")
+        return generate(payload)
+
+    monkeypatch.setattr(jobs_module, "generate_from_payload", flaky)
+    monkeypatch.setattr(main, "pool", InvoicePool(workers=0))
+    monkeypatch.setattr(main, "jobs", JobQueue(workers=1, max_attempts=2, retry_delay=0))
+    with TestClient(main.app) as client:
+        job = _wait(client, client.post("/jobs", json=INVOICE_EXAMPLE).json()["id"])
+        assert (job["status"], job["attempts"]) == ("done", 2)
+        failing = dict(INVOICE_EXAMPLE, invoice_number="ALWAYS")
+        job = _wait(client, client.post("/jobs", json=failing).json()["id"])
+        assert (job["status"], job["attempts"], job["error"]) == ("failed", 2, "worker crashed")
+        assert "facturx_jobs_retries_total 2" in client.get("/metrics").text
@@ -1,10 +1,14 @@
 from __future__ import annotations
 
+import asyncio
 from copy import deepcopy
 from io import BytesIO
 from pathlib import Path
 import sys
 
+from fastapi import Request
+from fastapi.testclient import TestClient
+
 sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
 
 from facturx import get_facturx_xml_from_pdf, xml_check_xsd
@@ -30,7 +34,8 @@ def test_generate_invoice_pdf():
     invoice = Invoice.model_validate(deepcopy(INVOICE_EXAMPLE))
     payload = deepcopy(INVOICE_EXAMPLE)
 
-    response = create_invoice_pdf(invoice)
+    request = Request({"type": "http", "method": "POST", "headers": []})
+    response = asyncio.run(create_invoice_pdf(request, invoice))
 
     assert response.status_code == 200
     assert response.media_type == "application/pdf"
@@ -45,3 +50,25 @@ def test_generate_invoice_pdf():
     assert xml_bytes and len(xml_bytes) > 0
 
     xml_check_xsd(xml_bytes, flavor="factur-x", level="en16931")
+
+
+def test_generate_invoice_xml():
+    client = TestClient(app)
+
+    response = client.post(
+        "/invoices/xml?check_xsd=true", json=INVOICE_EXAMPLE, headers={"Accept-Encoding": "identity"}
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/xml"
+    assert "content-encoding" not in response.headers
+    assert xml_check_xsd(response.content, flavor="factur-x", level="en16931")
+
+    response = client.post("/invoices/xml", json=INVOICE_EXAMPLE, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.content.startswith(b"<?xml")  # decoded by the client
+    for accept_encoding in ("gzip;q=0", "br, gzip;q=0.0, *;q=0.5", "*;q=0"):
+        response = client.post("/invoices/xml", json=INVOICE_EXAMPLE, headers={"Accept-Encoding": accept_encoding})
+        assert "content-encoding" not in response.headers, accept_encoding
+    for accept_encoding in ("br;q=1.0, GZIP;q=0.5", "*"):
+        response = client.post("/invoices/xml", json=INVOICE_EXAMPLE, headers={"Accept-Encoding": accept_encoding})
+        assert response.headers["content-encoding"] == "gzip", accept_encoding
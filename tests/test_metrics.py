@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+from copy import deepcopy
+from pathlib import Path
+import sys
+
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app import main
+from app.cache import ResultCache
+from app.metrics import Histogram
+from app.models import INVOICE_EXAMPLE
+
+
+def test_histogram_text_format():
+    histogram = Histogram("test_seconds", "Test.", labels=("stage",), buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value, stage='a"b')
+    assert histogram.render().splitlines() == [
+        "# HELP test_seconds Test.",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{stage="a\\"b",le="0.1"} 2',
+        'test_seconds_bucket{stage="a\\"b",le="1"} 3',
+        'test_seconds_bucket{stage="a\\"b",le="+Inf"} 4',
+        'test_seconds_sum{stage="a\\"b"} 3.65',
+        'test_seconds_count{stage="a\\"b"} 4',
+    ]
+
+
+def test_metrics_endpoint(monkeypatch):
+    monkeypatch.setattr(main, "cache", ResultCache())
+    client = TestClient(main.app)
+    payload = deepcopy(INVOICE_EXAMPLE)
+    payload["invoice_number"] = "INV-METRICS"
+    assert client.post("/invoices/pdf", json=payload).status_code == 200
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = response.text.splitlines()
+    for stage in ("render", "xml_build", "xsd_check", "embed"):
+        assert any(line.startswith(f'facturx_stage_duration_seconds_count{{stage="{stage}"}}') for line in lines)
+    assert any(
+        line.startswith('facturx_http_request_duration_seconds_count{endpoint="/invoices/pdf",status="200"}')
+        for line in lines
+    )
+    assert any(line.startswith('facturx_output_size_bytes_count{kind="pdf"}') for line in lines)
+    assert any(line.startswith("facturx_xsd_schema_cache_total{result=") for line in lines)
+    assert "facturx_pool_queue_depth 0" in lines
@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import asyncio
+from copy import deepcopy
+from pathlib import Path
+import sys
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app import main
+from app.cache import ResultCache
+from app.models import INVOICE_EXAMPLE
+from app.pool import InvoicePool, PoolSaturated
+
+
+def _slow(value):
+    time.sleep(0.2)
+    return value
+
+
+def test_queue_full_is_refused_at_once():
+    pool = InvoicePool(workers=1, queue_depth=1)
+
+    async def scenario():
+        return await asyncio.gather(*(pool.run(_slow, i) for i in range(3)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert results[:2] == [0, 1]
+    assert isinstance(results[2], PoolSaturated)
+    assert not results[2].draining
+    assert results[2].retry_after >= 1
+    assert pool.pending == 0
+
+
+def test_process_pool_drains_on_shutdown():
+    pool = InvoicePool(workers=2, queue_depth=0, warm_up=False)
+    pool.start()
+
+    async def scenario():
+        jobs = [asyncio.ensure_future(pool.run(_slow, i)) for i in range(2)]
+        await asyncio.sleep(0.05)
+        await pool.shutdown()
+        with pytest.raises(PoolSaturated) as exc_info:
+            await pool.run(_slow, 3)
+        assert exc_info.value.draining
+        return [job.result() for job in jobs]
+
+    assert asyncio.run(scenario()) == [0, 1]
+
+
+@pytest.mark.parametrize("draining, status", [(False, 429), (True, 503)])
+def test_endpoint_returns_retry_after(monkeypatch, draining, status):
+    # a cached invoice would be served even when the pool is saturated
+    monkeypatch.setattr(main, "cache", ResultCache())
+    monkeypatch.setattr(main.pool, "draining", draining)
+    monkeypatch.setattr(main.pool, "pending", main.pool.capacity)
+    client = TestClient(main.app)
+
+    response = client.post("/invoices/pdf", json=deepcopy(INVOICE_EXAMPLE))
+
+    assert response.status_code == status
+    assert int(response.headers["retry-after"]) >= 1
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+from copy import deepcopy
+from io import BytesIO
+from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from facturx import generate_from_file, get_xml_from_pdf
+from facturx.profiling import (
+    EXTRACTION_STAGES,
+    GENERATION_STAGES,
+    ProfileAggregator,
+    collect_profiles,
+    hook,
+    memory_accounting,
+)
+
+from app.models import INVOICE_EXAMPLE, Invoice
+from app.utils import _render_invoice_pdf
+from app.xml_builder import build_facturx_xml
+
+
+def _generate():
+    invoice = Invoice.model_validate(deepcopy(INVOICE_EXAMPLE))
+    pdf_buffer = BytesIO(_render_invoice_pdf(invoice))
+    generate_from_file(pdf_buffer, build_facturx_xml(INVOICE_EXAMPLE))
+    return pdf_buffer
+
+
+def test_profile_has_all_generation_stages():
+    with collect_profiles() as profiles:
+        _generate()
+
+    assert len(profiles) == 1
+    profile = profiles[0]
+    assert profile.operation == "generate_from_file"
+    assert profile.error is None
+    assert set(profile.stages) == set(GENERATION_STAGES)
+    assert 0 < sum(profile.stages.values()) <= profile.total
+
+
+def test_no_profile_outside_of_hook():
+    with collect_profiles() as profiles:
+        pass
+    _generate()
+    assert profiles == []
+
+
+def test_aggregator_summary():
+    aggregator = ProfileAggregator()
+    with hook(aggregator):
+        for _ in range(3):
+            _generate()
+
+    summary = aggregator.summary()["generate_from_file"]
+    assert summary["total"]["count"] == 3
+    assert summary["write"]["p50"] <= summary["write"]["max"]
+
+
+def test_memory_accounting_flags_over_budget():
+    pdf_bytes = _generate().getvalue()
+    with memory_accounting(budget=1) as profiles:
+        get_xml_from_pdf(pdf_bytes)
+
+    profile = profiles[0]
+    assert profile.operation == "get_xml_from_pdf"
+    assert set(profile.memory) == set(EXTRACTION_STAGES)
+    assert profile.memory["pdf_read"]["peak"] > 0
+    assert profile.peak_memory >= profile.memory["pdf_read"]["peak"]
+    assert profile.over_budget
+    assert profile.as_dict()["info"]["pdf_size"] == len(pdf_bytes)
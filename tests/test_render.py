@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+from copy import deepcopy
+from io import BytesIO
+from pathlib import Path
+import sys
+
+from pypdf import PdfReader
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from facturx import get_xml_from_pdf
+
+from app.models import INVOICE_EXAMPLE, Invoice
+from app.render import FIRST_PAGE_ROWS, NEXT_PAGE_ROWS, _page_template, paginate
+from app.utils import generate_facturx_pdf
+
+
+def _invoice(line_count):
+    invoice = deepcopy(INVOICE_EXAMPLE)
+    invoice["line_items"] = [
+        {"description": f"Item {index}", "quantity": "2", "unit_price": "1.25", "vat_rate": "20" if index % 2 else "5.5"}
+        for index in range(line_count)
+    ]
+    return Invoice.model_validate(invoice)
+
+
+def test_paginate():
+    assert paginate(2, 1) == [2]
+    assert paginate(FIRST_PAGE_ROWS, 1) == [FIRST_PAGE_ROWS, 0]
+    pages = paginate(200, 2)
+    assert sum(pages) == 200
+    assert pages[0] == FIRST_PAGE_ROWS
+    assert all(count <= NEXT_PAGE_ROWS for count in pages[1:])
+
+
+def test_multi_page_invoice():
+    _page_template.cache_clear()
+    pdf_bytes = generate_facturx_pdf(_invoice(200))
+    reader = PdfReader(BytesIO(pdf_bytes))
+    pages = reader.pages
+    assert len(pages) == len(paginate(200, 2))
+    texts = [page.extract_text() for page in pages]
+    assert f"Page 1/{len(pages)}" in texts[0]
+    assert "Carried forward to next page" in texts[0]
+    assert "Item 199" in texts[-1]
+
+    assert "Total due: 563.75 EUR" in texts[-1]
+    # One form for the letterhead and the footer, shown on every page
+    for page, text in zip(pages, texts):
+        assert list(page["/Resources"]["/XObject"]) == ["/FormXob.PageTemplate"]
+        assert INVOICE_EXAMPLE["seller"]["name"] in text
+    get_xml_from_pdf(pdf_bytes, check_xsd=True)
+
+    generate_facturx_pdf(_invoice(3))
+    assert _page_template.cache_info().hits >= 1
+
+
+def test_page_template_matches_reportlab():
+    # The cached template is the form that reportlab draws in the document
+    from app.fonts import prepare_fonts
+    from app.render import TEMPLATE_FORM, _draw_page_template, new_canvas
+
+    invoice = _invoice(3)
+    output = BytesIO()
+    pdf_canvas = new_canvas(output)
+    prepare_fonts(pdf_canvas)
+    pdf_canvas.beginForm(TEMPLATE_FORM)
+    _draw_page_template(pdf_canvas, invoice.seller, invoice.seller_bank_iban)
+    pdf_canvas.endForm()
+    pdf_canvas.doForm(TEMPLATE_FORM)
+    pdf_canvas.save()
+    expected = PdfReader(output).pages[0]["/Resources"]["/XObject"]["/FormXob.PageTemplate"]
+    form = PdfReader(BytesIO(generate_facturx_pdf(invoice))).pages[0]["/Resources"]["/XObject"]["/FormXob.PageTemplate"]
+    assert form.get_data() == expected.get_data()
+    assert form["/BBox"] == expected["/BBox"]
+
+
+def test_fonts_are_embedded():
+    from app.fonts import _subset_objects
+
+    invoice = _invoice(3)
+    invoice.seller.name = "Łódz Éditions"
+    invoice.line_items[0].description = "Café crème à 5€ – Ωmega"
+    generate_facturx_pdf(invoice)
+    hits = _subset_objects.cache_info().hits
+    reader = PdfReader(BytesIO(generate_facturx_pdf(invoice)))
+    assert _subset_objects.cache_info().hits > hits
+    page = reader.pages[0]
+    fonts = list(page["/Resources"]["/Font"].values())
+    fonts += page["/Resources"]["/XObject"]["/FormXob.PageTemplate"]["/Resources"]["/Font"].values()
+    for font in fonts:
+        font = font.get_object()
+        assert font["/Subtype"] == "/TrueType"
+        assert "/FontFile2" in font["/FontDescriptor"]
+    text = page.extract_text()
+    assert "Łódz Éditions" in text
+    assert "Café crème à 5€ – Ωmega" in text
+    assert "/OutputIntents" in reader.trailer["/Root"]
+
+
+def _font_objects(pdf_bytes):
+    fonts = {}
+    for name, font in PdfReader(BytesIO(pdf_bytes)).pages[0]["/Resources"]["/Font"].items():
+        font = font.get_object()
+        descriptor = dict(font["/FontDescriptor"].get_object())
+        font_file = descriptor.pop("/FontFile2").get_object()
+        fonts[name] = (
+            {key: value for key, value in font.items() if key not in ("/FontDescriptor", "/ToUnicode")},
+            descriptor,
+            font_file["/Length1"],
+            font_file.get_data(),
+            font["/ToUnicode"].get_object().get_data(),
+        )
+    return fonts
+
+
+def test_font_objects_match_reportlab(monkeypatch):
+    # EmbeddedFont.addObjects() replaces a method of reportlab: it must be
+    # called, and write the same font objects as reportlab does
+    from reportlab.pdfbase.ttfonts import TTFont
+
+    from app.fonts import EmbeddedFont
+
+    calls = []
+    add_objects = EmbeddedFont.addObjects
+
+    def spy(self, doc):
+        calls.append(self.fontName)
+        add_objects(self, doc)
+
+    invoice = _invoice(3)
+    invoice.line_items[0].description = "Café crème à 5€ – Ωmega"
+    monkeypatch.setattr(EmbeddedFont, "addObjects", spy)
+    cached = _font_objects(generate_facturx_pdf(invoice))
+    assert sorted(calls) == ["FacturX", "FacturX-Bold"]
+    monkeypatch.setattr(EmbeddedFont, "addObjects", TTFont.addObjects)
+    assert cached == _font_objects(generate_facturx_pdf(invoice))
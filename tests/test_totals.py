@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+from copy import deepcopy
+from decimal import Decimal
+from io import BytesIO
+from pathlib import Path
+import sys
+
+from lxml import etree
+from pypdf import PdfReader
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.models import INVOICE_EXAMPLE, Invoice
+from app.totals import InvoiceTotals, format_amount, round_half_up
+from app.utils import generate_facturx_pdf
+from app.xml_builder import NSMAP, build_facturx_xml
+
+
+def test_rounding():
+    assert [round_half_up(n, 10) for n in (14, 15, 16, -15)] == [1, 2, 2, -2]
+    assert [format_amount(cents) for cents in (0, 5, 1234, -1234)] == ["0.00", "0.05", "12.34", "-12.34"]
+    totals = InvoiceTotals()
+    assert totals.add_line(Decimal("3"), Decimal("1.15"), Decimal("20")) == (345, 69)
+    assert totals.add_line(Decimal("0.333"), Decimal("10.01"), Decimal("5.5")) == (333, 18)
+    assert totals.add_line(Decimal("2.5"), Decimal("0.01"), Decimal("20")) == (3, 1)
+    assert totals.line_total == 681
+
+
+def test_vat_is_rounded_per_category():
+    totals = InvoiceTotals()
+    for _ in range(3):
+        # 0.03 x 20% = 0.006: 0.01 per line, but 0.02 for the category
+        assert totals.add_line(Decimal("1"), Decimal("0.03"), Decimal("20")) == (3, 1)
+    [group] = totals.vat_groups
+    assert (group.rate, group.basis, group.tax) == (Decimal("20"), 9, 2)
+    assert (totals.tax_total, totals.grand_total) == (2, 11)
+
+
+def test_pdf_and_xml_show_the_same_totals():
+    data = deepcopy(INVOICE_EXAMPLE)
+    data["line_items"] = [
+        {"description": f"Item {index}", "quantity": "1", "unit_price": "0.03", "vat_rate": "20"} for index in range(3)
+    ]
+    invoice = Invoice.model_validate(data)
+    xml = etree.fromstring(build_facturx_xml(data))
+    grand_total = xml.findtext(".//ram:SpecifiedTradeSettlementHeaderMonetarySummation/ram:GrandTotalAmount", namespaces=NSMAP)
+    assert grand_total == "0.11"
+    text = PdfReader(BytesIO(generate_facturx_pdf(invoice))).pages[0].extract_text()
+    assert "VAT: 0.02 EUR" in text
+    assert f"Total due: {grand_total} EUR" in text
@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+from copy import deepcopy
+import json
+import logging
+from pathlib import Path
+import sys
+
+from fastapi.testclient import TestClient
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app import main
+from app.cache import ResultCache
+from app.models import INVOICE_EXAMPLE
+from app.tracing import TracingMiddleware, get_trace
+
+
+def _timings(header):
+    return {item.split(";")[0].strip(): item for item in header.split(",")}
+
+
+def test_server_timing_and_request_id(monkeypatch):
+    monkeypatch.setattr(main, "cache", ResultCache())
+    client = TestClient(main.app)
+
+    response = client.post("/invoices/pdf", json=deepcopy(INVOICE_EXAMPLE), headers={"X-Request-Id": "req-42"})
+    assert response.headers["x-request-id"] == "req-42"
+    timings = _timings(response.headers["server-timing"])
+    assert set(timings) >= {"cache", "render", "xml", "validation", "embed", "total"}
+    assert 'desc="miss"' in timings["cache"]
+
+    response = client.post("/invoices/pdf", json=deepcopy(INVOICE_EXAMPLE))
+    assert len(response.headers["x-request-id"]) == 32
+    timings = _timings(response.headers["server-timing"])
+    assert set(timings) == {"cache", "total"}
+
+    assert "server-timing" not in client.get("/").headers
+
+
+def test_slow_request_log(monkeypatch, caplog):
+    async def endpoint(request):
+        trace = get_trace(request.scope)
+        trace.info["lines"] = 3
+        trace.add_profile({"stages": {"render": 0.01}, "info": {"attachments_size": 100}, "total": 0.01}, 0.02)
+        return PlainTextResponse("ok")
+
+    monkeypatch.setenv("FACTURX_SLOW_REQUEST_SECONDS", "0")
+    client = TestClient(TracingMiddleware(Starlette(routes=[Route("/", endpoint)])))
+    with caplog.at_level(logging.WARNING, logger="app.tracing"):
+        response = client.get("/", headers={"X-Request-Id": "slow-1"})
+
+    assert "render;dur=10.0" in response.headers["server-timing"]
+    record = json.loads(caplog.records[-1].getMessage().split(": ", 1)[1])
+    assert record["request_id"] == "slow-1"
+    assert record["lines"] == 3
+    assert record["attachment_bytes"] == 100
+    assert record["stages"]["wait"] == 0.01
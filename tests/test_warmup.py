@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+from pathlib import Path
+import sys
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import facturx
+from facturx import facturx as facturx_module
+from app import main, warmup
+from app.pool import InvoicePool
+from app.warmup import Readiness
+
+
+def _wait_ready(client, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        response = client.get("/ready")
+        if response.status_code == 200 or time.monotonic() > deadline:
+            return response
+        time.sleep(0.05)
+
+
+def test_preload_xsd_schemas(monkeypatch):
+    monkeypatch.setattr(facturx_module, "_xsd_schemas", {})
+    xsd_files = facturx.preload_xsd_schemas("factur-x", ["en16931", "en16931"])
+    assert xsd_files == ["xsd/" + facturx.facturx.FACTURX_LEVEL2xsd["en16931"]]
+    assert len(facturx_module._xsd_schemas[xsd_files[0]]) == 1
+    with pytest.raises(ValueError):
+        facturx.preload_xsd_schemas("factur-x", ["comfort"])
+
+
+def test_not_ready_before_warm_up(monkeypatch):
+    monkeypatch.setattr(main, "readiness", Readiness())
+    response = TestClient(main.app).get("/ready")
+    assert response.status_code == 503
+    assert response.json() == {"status": "starting"}
+    assert response.headers["retry-after"] == "1"
+
+
+def test_ready_after_warm_up(monkeypatch):
+    monkeypatch.setattr(main, "readiness", Readiness())
+    monkeypatch.setattr(main, "pool", InvoicePool(workers=0))
+    with TestClient(main.app) as client:
+        response = _wait_ready(client)
+        assert response.status_code == 200
+        assert response.json() == {"status": "ready"}
+    assert main.readiness.status == "draining"
+
+
+def test_failed_warm_up_is_not_ready(monkeypatch):
+    def fail():
+        raise RuntimeError("no fonts")
+
+    monkeypatch.setattr(main, "readiness", Readiness())
+    monkeypatch.setattr(main, "pool", InvoicePool(workers=0))
+    monkeypatch.setattr(warmup, "warm_up_process", fail)
+    with TestClient(main.app) as client:
+        deadline = time.monotonic() + 10
+        while main.readiness.status == "starting" and time.monotonic() < deadline:
+            time.sleep(0.01)
+        response = client.get("/ready")
+    assert response.status_code == 503
+    assert response.json() == {"status": "failed", "error": "no fonts"}
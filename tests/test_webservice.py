@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+from io import BytesIO
+from pathlib import Path
+import signal
+import socket
+import subprocess
+import sys
+from tempfile import SpooledTemporaryFile
+import time
+import urllib.request
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# The webservice is optional
+pytest.importorskip("flask")
+
+from facturx import get_xml_from_pdf
+from pypdf import PdfReader
+
+from app.models import INVOICE_EXAMPLE, Invoice
+from app.utils import _render_invoice_pdf
+from app.xml_builder import build_facturx_xml
+from facturx.scripts import webservice
+from facturx.scripts.webservice import app
+
+
+@pytest.fixture
+def client():
+    config = dict(app.config)
+    yield app.test_client()
+    app.config.update(config)
+
+
+def _files():
+    return {
+        "pdf": (BytesIO(_render_invoice_pdf(Invoice.model_validate(INVOICE_EXAMPLE))), "invoice.pdf"),
+        "xml": (BytesIO(build_facturx_xml(INVOICE_EXAMPLE)), "factur-x.xml"),
+        "attachment1": (BytesIO(b"delivery note"), "delivery.txt"),
+        "attachment2": (BytesIO(b"timesheet"), "timesheet.txt"),
+    }
+
+
+@pytest.mark.parametrize("spool_size", [1024 * 1024, 1])
+def test_generate_facturx(client, spool_size):
+    app.config.update(SPOOL_MAX_SIZE=spool_size, MAX_ATTACHMENTS=1)
+    response = client.post("/generate_facturx", data=_files(), content_type="multipart/form-data")
+    assert response.status_code == 200
+    assert response.mimetype == "application/pdf"
+    assert "invoice.pdf" in response.headers["Content-Disposition"]
+    assert get_xml_from_pdf(response.data)[1] == build_facturx_xml(INVOICE_EXAMPLE)
+    assert set(PdfReader(BytesIO(response.data)).attachments) == {"factur-x.xml", "delivery.txt"}
+
+
+def test_upload_limits(client):
+    app.config.update(MAX_CONTENT_LENGTH=1000)
+    response = client.post("/generate_facturx", data=_files(), content_type="multipart/form-data")
+    assert response.status_code == 413
+    app.config.update(MAX_CONTENT_LENGTH=None)
+    files = _files()
+    del files["xml"]
+    response = client.post("/generate_facturx", data=files, content_type="multipart/form-data")
+    assert response.status_code == 400
+
+
+def _facturx_pdf(client):
+    response = client.post("/generate_facturx", data=_files(), content_type="multipart/form-data")
+    return response.data
+
+
+def test_extract_validate_classify(client):
+    xml_bytes = build_facturx_xml(INVOICE_EXAMPLE)
+    pdf_bytes = _facturx_pdf(client)
+
+    response = client.post("/extract_xml", data={"pdf": (BytesIO(pdf_bytes), "invoice.pdf"), "check_xsd": "1"})
+    assert response.status_code == 200
+    assert response.json == {
+        "filename": "factur-x.xml", "flavor": "factur-x", "level": "en16931", "xml": xml_bytes.decode("utf-8")
+    }
+    response = client.post("/extract_xml", data={"pdf": _files()["pdf"]})
+    assert response.status_code == 422
+    assert "No Factur-X" in response.json["error"]
+
+    for key, content, filename in (("pdf", pdf_bytes, "invoice.pdf"), ("xml", xml_bytes, "factur-x.xml")):
+        response = client.post("/validate", data={key: (BytesIO(content), filename)})
+        assert response.json == {"filename": "factur-x.xml", "flavor": "factur-x", "level": "en16931", "valid": True}
+        response = client.post("/classify", data={key: (BytesIO(content), filename)})
+        assert response.json == {"filename": "factur-x.xml", "flavor": "factur-x", "level": "en16931"}
+
+    invalid = xml_bytes.replace(b"<ram:TypeCode>380</ram:TypeCode>", b"<ram:TypeCode>380</ram:TypeCode><ram:Foo/>")
+    response = client.post("/validate", data={"xml": (BytesIO(invalid), "factur-x.xml")})
+    assert response.json["valid"] is False
+    assert "Foo" in response.json["error"]
+    response = client.post("/classify", data={"xml": (BytesIO(b"<Invoice/>"), "invoice.xml")})
+    assert response.status_code == 422
+    assert client.post("/classify", data={}).status_code == 400
+
+
+class _FileLike:
+    """A file object that doesn't inherit from IOBase, like the
+    SpooledTemporaryFile of Python < 3.11."""
+
+    def __init__(self, *args, **kwargs):
+        self._file = SpooledTemporaryFile(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+@pytest.mark.parametrize("spool_size", [1024 * 1024, 1])
+def test_extract_from_spooled_upload(client, monkeypatch, spool_size):
+    monkeypatch.setattr(webservice, "SpooledTemporaryFile", _FileLike)
+    app.config.update(SPOOL_MAX_SIZE=spool_size)
+    pdf_bytes = _facturx_pdf(client)
+    response = client.post("/extract_xml", data={"pdf": (BytesIO(pdf_bytes), "invoice.pdf")})
+    assert response.status_code == 200
+    assert response.json["xml"] == build_facturx_xml(INVOICE_EXAMPLE).decode("utf-8")
+    response = client.post("/validate", data={"pdf": (BytesIO(pdf_bytes), "invoice.pdf")})
+    assert response.json["valid"] is True
+
+
+def test_prefork_workers(tmp_path):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen(
+        [sys.executable, "-m", "facturx.scripts.webservice", "--workers", "2", "--port", str(port)],
+        cwd=Path(__file__).resolve().parents[1],
+    )
+    try:
+        boundary = "facturx-boundary"
+        body = b"".join(
+            [
+                f'--{boundary}\r\nContent-Disposition: form-data; name="xml"; filename="factur-x.xml"\r\n\r\n'.encode(),
+                build_facturx_xml(INVOICE_EXAMPLE),
+                f"\r\n--{boundary}--\r\n".encode(),
+            ]
+        )
+        request = urllib.request.Request(
+            f"http://127.0.0.1:{port}/classify",
+            data=body,
+            headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+        )
+        for _ in range(100):
+            try:
+                with urllib.request.urlopen(request, timeout=5) as response:
+                    assert b'"level":"en16931"' in response.read()
+                break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            raise AssertionError("The webservice didn't start")
+    finally:
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(timeout=10) == 0
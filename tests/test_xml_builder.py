@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+from copy import deepcopy
+from io import BytesIO
+from pathlib import Path
+import sys
+
+import pytest
+from lxml import etree
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import facturx
+from app import xml_builder
+from app.models import INVOICE_EXAMPLE, Invoice
+from app.xml_builder import build_facturx_xml, write_facturx_xml
+
+
+def _canonical(xml_bytes):
+    parser = etree.XMLParser(remove_blank_text=True)
+    return etree.tostring(etree.fromstring(xml_bytes, parser), method="c14n")
+
+
+def test_streamed_xml_is_the_built_xml():
+    invoice = deepcopy(INVOICE_EXAMPLE)
+    invoice["line_items"] = [
+        {"description": f"Line {index}", "quantity": "3", "unit_price": "1.15", "vat_rate": rate}
+        for index, rate in enumerate(["20", "5.5", "20", "10"] * 5)
+    ]
+    consumed = []
+
+    def lines():
+        for line in invoice["line_items"]:
+            consumed.append(line)
+            yield line
+
+    output = BytesIO()
+    assert write_facturx_xml(output, invoice, lines(), flush_every=7) == 20
+    assert len(consumed) == 20
+    assert _canonical(output.getvalue()) == _canonical(build_facturx_xml(invoice))
+    assert facturx.xml_check_xsd(output.getvalue(), flavor="factur-x", level="en16931")
+
+
+def test_streamed_xml_to_file(tmp_path):
+    path = tmp_path / "factur-x.xml"
+    write_facturx_xml(str(path), INVOICE_EXAMPLE, iter(INVOICE_EXAMPLE["line_items"]))
+    assert _canonical(path.read_bytes()) == _canonical(build_facturx_xml(INVOICE_EXAMPLE))
+
+
+def test_streamed_xml_without_lines():
+    with pytest.raises(ValueError):
+        write_facturx_xml(BytesIO(), INVOICE_EXAMPLE, iter([]))
+
+
+def test_party_elements_are_cached():
+    invoice = Invoice.model_validate(INVOICE_EXAMPLE)
+    expected = build_facturx_xml(invoice)
+    seller = xml_builder._create_trade_party("SellerTradeParty", invoice.seller)
+    seller[0].text = "Changed"
+    hits = xml_builder._cached_trade_party.cache_info().hits
+    assert build_facturx_xml(invoice) == expected
+    assert xml_builder._cached_trade_party.cache_info().hits == hits + 2
+
+    other = deepcopy(INVOICE_EXAMPLE)
+    other["seller"]["address"]["city"] = "Lyon"
+    assert b"<ram:CityName>Lyon</ram:CityName>" in build_facturx_xml(other)
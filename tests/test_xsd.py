@@ -0,0 +1,30 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from facturx import facturx, xml_check_xsd
+
+from app.corpus import add_defect
+from benchmarks.corpus import facturx_xml
+
+
+def _check(xml_bytes):
+    try:
+        return xml_check_xsd(xml_bytes, flavor="factur-x", level="en16931")
+    except Exception as exc:
+        return "InvoiceCurrencyCode" in str(exc)
+
+
+def test_cached_schemas_are_thread_safe():
+    valid = facturx_xml("en16931", lines=50)
+    invalid = add_defect(valid, "missing_element")
+    documents = [valid, invalid] * 20
+    with ThreadPoolExecutor(4) as executor:
+        assert all(executor.map(_check, documents))
+
+    schemas = facturx._xsd_schemas["xsd/" + facturx.FACTURX_LEVEL2xsd["en16931"]]
+    assert 1 <= len(schemas) <= 4